@@ -21,7 +21,7 @@ from gluon.http import content_disposition_header
 from gluon.restricted import safe_load, safe_loads, TicketStorage
 from gluon.utils import web2py_uuid
 from gluon.tools import Config, prevent_open_redirect
-from gluon.compileapp import find_exposed_functions
+from gluon.compileapp import find_exposed_functions, forget_models_manifest
 from glob import glob
 
 import gluon.rewrite
@@ -573,6 +573,7 @@ def delete():
         try:
             lineno = count_lines(safe_open(full_path, 'r').read())
             os.unlink(full_path)
+            forget_models_manifest(apath(app, r=request))
             log_progress(app, 'DELETE', filename, progress=-lineno)
             session.flash = T('file "%(filename)s" deleted',
                               dict(filename=filename))
@@ -714,6 +715,7 @@ def edit():
                 redirect(URL('site'))
 
         safe_write(path, data)
+        forget_models_manifest(apath(app, r=request))
         file_hash = md5_hash(data)
         saved_on = time.ctime(os.stat(path)[stat.ST_MTIME])
         safe_write(path + '.bak', data1)
@@ -746,6 +748,7 @@ def edit():
             safe_write(path + '.bak', data)
             data = request.vars.data.replace('\r\n', '\n').strip() + '\n'
             safe_write(path, data)
+            forget_models_manifest(apath(app, r=request))
             lineno_new = count_lines(data)
             log_progress(
                 app, 'EDIT', filename, progress=lineno_new - lineno_old)
@@ -1496,6 +1499,7 @@ def create_file():
             raise SyntaxError
 
         safe_write(full_filename, text)
+        forget_models_manifest(apath(app, r=request))
         log_progress(app, 'CREATE', filename)
         if request.vars.dir:
             result = T('file "%(filename)s" created',
@@ -1602,6 +1606,7 @@ def upload_file():
         data = request.vars.file.file.read()
         lineno = count_lines(data)
         safe_write(filename, data, 'wb')
+        forget_models_manifest(apath(app, r=request))
         log_progress(app, 'UPLOAD', filename, lineno)
         session.flash = T('file "%(filename)s" uploaded',
                           dict(filename=filename[len(path):]))
@@ -12,6 +12,7 @@ Basic caching classes and methods
 - Cache - The generic caching object interfacing with the others
 - CacheInRam - providing caching in ram
 - CacheOnDisk - provides caches on disk
+- CacheOnSQLite - provides caches on disk in a single SQLite file
 
 Memcache is also available via a different module (see gluon.contrib.memcache)
 
@@ -24,15 +25,20 @@ import copyreg
 import datetime
 import gc
 import hashlib
+import heapq
+import itertools
 import logging
 import os
 import pickle
 import random
 import re
+import sqlite3
 import sys
 import tempfile
+import threading
 import time
 from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
 
 from gluon import recfile
 
@@ -82,6 +88,346 @@ def remove_oldest_entries(storage, percentage=90):
         old_mem = new_mem
 
 
+def approximate_size(obj, seen=None):
+    """
+    Returns the approximate size in bytes of `obj`, including the items
+    of containers. Other objects are measured by their pickled length, so
+    that e.g. a Rows is not measured with the DAL it refers to.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj, 64)
+    if isinstance(obj, dict):
+        size += sum(
+            approximate_size(k, seen) + approximate_size(v, seen)
+            for k, v in obj.items()
+        )
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approximate_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__") or hasattr(obj, "__slots__"):
+        try:
+            size = len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            pass
+    return size
+
+
+use_clock = itertools.count()  # orders the uses of cache.ram entries across shards
+
+
+class LRUStorage(OrderedDict):
+    """
+    The cache.ram storage of an application: key -> (time, value) in least
+    recently used order, keeping track of when values were last used, of
+    their (approximate) size and of their expiration times.
+    """
+
+    def __init__(self):
+        OrderedDict.__init__(self)
+        self.used = {}  # key -> tick of use_clock when last stored or read
+        self.sizes = {}
+        self.bytes = 0
+        self.expirations = []  # heap of (expiration time, n, time, key)
+        self.counter = itertools.count()
+        self.stats = {"hit_total": 0, "misses": 0, "evictions": 0}
+
+    def set(self, key, item, expire_at=None, size=0):
+        if key in self:
+            del self[key]
+        OrderedDict.__setitem__(self, key, item)
+        self.used[key] = next(use_clock)
+        self.sizes[key] = size
+        self.bytes += size
+        if expire_at is not None:
+            heapq.heappush(
+                self.expirations, (expire_at, next(self.counter), item[0], key)
+            )
+
+    def __setitem__(self, key, item):
+        self.set(key, item)
+
+    def touch(self, key):
+        """Marks `key` as the most recently used"""
+        self.move_to_end(key)
+        self.used[key] = next(use_clock)
+
+    def oldest(self):
+        """Returns when the least recently used key was used, None if empty"""
+        for key in self:
+            return self.used.get(key, -1)
+        return None
+
+    def __delitem__(self, key):
+        OrderedDict.__delitem__(self, key)
+        self.used.pop(key, None)
+        self.bytes -= self.sizes.pop(key, 0)
+
+    def popitem(self, last=True):
+        key, item = OrderedDict.popitem(self, last)
+        self.used.pop(key, None)
+        self.bytes -= self.sizes.pop(key, 0)
+        return key, item
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self.used.clear()
+        self.sizes.clear()
+        self.bytes = 0
+        del self.expirations[:]
+
+    def expire(self, now):
+        """Removes the entries expired before `now`, returns how many"""
+        expirations, n = self.expirations, 0
+        while expirations and expirations[0][0] < now:
+            expire_at, _, t, key = heapq.heappop(expirations)
+            item = self.get(key, None)
+            # skip keys that have been updated since
+            if item is not None and item[0] == t:
+                del self[key]
+                n += 1
+        if len(expirations) > 2 * len(self) + 64:
+            # drop the stale heap entries
+            self.expirations = [
+                e for e in expirations if e[3] in self and self[e[3]][0] == e[2]
+            ]
+            heapq.heapify(self.expirations)
+        return n
+
+
+class RamStorage(object):
+    """
+    The cache.ram storage of an application, split in shards by key hash.
+    Each shard is an LRUStorage with its own lock and counters, so threads
+    working on different keys do not contend.
+    """
+
+    def __init__(self, shards=16):
+        self.shards = [LRUStorage() for i in range(shards)]
+        self.locks = [thread.allocate_lock() for i in range(shards)]
+
+    def shard(self, key):
+        """Returns the (lock, LRUStorage) holding `key`"""
+        i = hash(key) % len(self.shards)
+        return self.locks[i], self.shards[i]
+
+    @property
+    def bytes(self):
+        return sum(shard.bytes for shard in self.shards)
+
+    def __getitem__(self, key):
+        lock, shard = self.shard(key)
+        with lock:
+            return shard[key]
+
+    def __setitem__(self, key, item):
+        lock, shard = self.shard(key)
+        with lock:
+            shard[key] = item
+
+    def __delitem__(self, key):
+        lock, shard = self.shard(key)
+        with lock:
+            del shard[key]
+
+    def __contains__(self, key):
+        lock, shard = self.shard(key)
+        with lock:
+            return key in shard
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def __iter__(self):
+        for key, item in self.items():
+            yield key
+
+    def get(self, key, default=None):
+        lock, shard = self.shard(key)
+        with lock:
+            return shard.get(key, default)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        items = []
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                items.extend(shard.items())
+        return items
+
+    def evict(self, max_entries=None, max_bytes=None):
+        """
+        Removes the least recently used entries of the whole storage (the
+        oldest of the ones at the head of the shards) until it is within
+        the limits
+        """
+        entries, size = len(self), self.bytes
+        while (max_entries is not None and entries > max_entries) or (
+            max_bytes is not None and size > max_bytes
+        ):
+            victim = None
+            for i, (lock, shard) in enumerate(zip(self.locks, self.shards)):
+                with lock:
+                    used = shard.oldest()
+                if used is not None and (victim is None or used < victim[0]):
+                    victim = (used, i)
+            if victim is None:
+                break
+            used, i = victim
+            with self.locks[i]:
+                shard = self.shards[i]
+                if shard.oldest() != used:
+                    continue  # used meanwhile, look again
+                size -= shard.sizes.get(next(iter(shard)), 0)
+                shard.popitem(last=False)
+                shard.stats["evictions"] += 1
+            entries -= 1
+
+    def clear(self, regex=None):
+        """Removes all the keys, or only the ones matching `regex`"""
+        r = re.compile(regex) if regex is not None else None
+        for lock, shard in zip(self.locks, self.shards):
+            with lock:
+                if r is None:
+                    shard.clear()
+                else:
+                    for key in [key for key in shard if r.match(str(key))]:
+                        del shard[key]
+
+
+class RamStats(Mapping):
+    """The hit/miss/eviction counters of a RamStorage, summed over shards"""
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __getitem__(self, name):
+        return sum(shard.stats[name] for shard in self.storage.shards)
+
+    def __iter__(self):
+        return iter(self.storage.shards[0].stats)
+
+    def __len__(self):
+        return len(self.storage.shards[0].stats)
+
+
+class KeyLocks(object):
+    """
+    Per key locks, created on demand and discarded once released.
+    Used to make sure only one caller at a time recomputes a given key.
+    """
+
+    def __init__(self):
+        self.locker = thread.allocate_lock()
+        self.locks = {}
+
+    def acquire(self, key, blocking=True):
+        self.locker.acquire()
+        item = self.locks.get(key, None)
+        if item is None:
+            item = self.locks[key] = [thread.allocate_lock(), 0]
+        item[1] += 1
+        self.locker.release()
+        if item[0].acquire(blocking):
+            return True
+        self._discard(key, item)
+        return False
+
+    def release(self, key):
+        self.locker.acquire()
+        item = self.locks[key]
+        self.locker.release()
+        item[0].release()
+        self._discard(key, item)
+
+    def _discard(self, key, item):
+        self.locker.acquire()
+        item[1] -= 1
+        if not item[1]:
+            del self.locks[key]
+        self.locker.release()
+
+
+class FileKeyLocks(object):
+    """
+    Per key locks across threads and processes.
+    Each key has its own lock file in `folder`, named after a hash of the
+    key and removed on release, so that unrelated keys never wait for each
+    other.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.flights = KeyLocks()
+
+    def acquire(self, key, blocking=True):
+        """
+        Returns an handle to be passed to `release` or None if `blocking` is
+        False and the key is already locked.
+        """
+        if not self.flights.acquire(key, blocking):
+            return None
+        name = hashlib.md5(key.encode("utf-8")).hexdigest()
+        path = os.path.join(self.folder, name)
+        flags = portalocker.LOCK_EX
+        if not blocking:
+            flags |= portalocker.LOCK_NB
+        while True:
+            try:
+                if not os.path.exists(self.folder):
+                    os.mkdir(self.folder)
+                lock_file = open(path, "ab")
+            except OSError:
+                # no cross process locking available
+                return (key, path, None)
+            try:
+                portalocker.lock(lock_file, flags)
+            except:
+                lock_file.close()
+                self.flights.release(key)
+                if blocking:
+                    raise
+                return None
+            try:
+                # the holder before us may have removed the file meanwhile
+                if os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path)):
+                    return (key, path, lock_file)
+            except OSError:
+                pass
+            lock_file.close()
+
+    def release(self, handle):
+        key, path, lock_file = handle
+        if lock_file is not None:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            portalocker.unlock(lock_file)
+            lock_file.close()
+        self.flights.release(key)
+
+
+def regex_prefix(regex):
+    """
+    Returns a literal prefix of all the strings matched (by re.match) by the
+    regular expression `regex`, possibly empty
+    """
+    if "|" in regex:
+        return ""
+    if regex.startswith("^"):
+        regex = regex[1:]
+    prefix = re.match(r"[^\\.^$*+?{}\[\]|()]*", regex).group()
+    if regex[len(prefix) : len(prefix) + 1] in ("*", "?", "{"):
+        # the quantifier applies to the last character
+        prefix = prefix[:-1]
+    return prefix
+
+
 logger = logging.getLogger("web2py.cache")
 
 __all__ = ["Cache", "lazy_cache"]
@@ -121,13 +467,16 @@ class CacheAbstract(object):
         """
         raise NotImplementedError
 
-    def __call__(self, key, f, time_expire=DEFAULT_TIME_EXPIRE):
+    def __call__(self, key, f, time_expire=DEFAULT_TIME_EXPIRE, stale_ttl=None):
         """
         Tries to retrieve the value corresponding to `key` from the cache if the
         object exists and if it did not expire, else it calls the function `f`
         and stores the output in the cache corresponding to `key`. It always
         returns the function that is returned.
 
+        Only one caller at a time computes `f` for a given `key`, the others
+        wait for its result instead of recomputing it.
+
         Args:
             key(str): the key of the object to be stored or retrieved
             f(function): the function whose output is to be cached.
@@ -139,6 +488,9 @@ class CacheAbstract(object):
                 when the requested object was last saved in cache. It does not
                 affect future requests. Setting `time_expire` to 0 or negative
                 value forces the cache to refresh.
+            stale_ttl(int): for how many seconds after expiration the old
+                value can still be returned. While a caller recomputes the
+                value, the other callers get the stale one instead of waiting.
         """
         raise NotImplementedError
 
@@ -180,18 +532,28 @@ class CacheInRam(CacheAbstract):
     Ram based caching
 
     This is implemented as global (per process, shared by all threads)
-    dictionary.
-    A mutex-lock mechanism avoid conflicts.
+    dictionary, split in `shards` by key hash.
+    A mutex-lock per shard avoid conflicts.
+
+    The storage of each application can be bounded setting `max_entries`
+    and/or `max_bytes` (approximate size of the cached values): least
+    recently used entries are evicted first, and expired entries are
+    removed as soon as they can no longer be returned. Limits apply to all
+    the shards together, evicting the least recently used entry of all.
     """
 
     locker = thread.allocate_lock()
+    flights = KeyLocks()
     meta_storage = {}
     stats = {}
+    shards = 16
+    max_entries = None  # per application
+    max_bytes = None  # per application
 
     def __init__(self, request=None):
         self.initialized = False
         self.request = request
-        self.storage = OrderedDict() if HAVE_PSUTIL else {}
+        self.storage = RamStorage(self.shards)
         self.app = request.application if request else ""
 
     def initialize(self):
@@ -201,29 +563,35 @@ class CacheInRam(CacheAbstract):
             self.initialized = True
         self.locker.acquire()
         if self.app not in self.meta_storage:
-            self.storage = self.meta_storage[self.app] = (
-                OrderedDict() if HAVE_PSUTIL else {}
-            )
-            self.stats[self.app] = {"hit_total": 0, "misses": 0}
+            self.storage = self.meta_storage[self.app] = RamStorage(self.shards)
+            self.stats[self.app] = RamStats(self.storage)
         else:
             self.storage = self.meta_storage[self.app]
         self.locker.release()
 
     def clear(self, regex=None):
         self.initialize()
-        self.locker.acquire()
-        storage = self.storage
-        if regex is None:
-            storage.clear()
-        else:
-            self._clear(storage, regex)
-
-        if self.app not in self.stats:
-            self.stats[self.app] = {"hit_total": 0, "misses": 0}
-
-        self.locker.release()
-
-    def __call__(self, key, f, time_expire=DEFAULT_TIME_EXPIRE, destroyer=None):
+        self.storage.clear(regex)
+
+    def _store(self, shard, key, now, value, time_expire=None, stale_ttl=None):
+        """Stores the value and drops expired entries, to be called locked"""
+        bounded = self.max_entries is not None or self.max_bytes is not None
+        expire_at = None
+        if bounded and time_expire is not None:
+            expire_at = now + max(time_expire, 0) + (stale_ttl or 0)
+        size = approximate_size(value) if self.max_bytes is not None else 0
+        shard.set(key, (now, value), expire_at, size)
+        if bounded:
+            shard.stats["evictions"] += shard.expire(time.time())
+
+    def _evict(self):
+        """Enforces the limits, to be called unlocked"""
+        if self.max_entries is not None or self.max_bytes is not None:
+            self.storage.evict(self.max_entries, self.max_bytes)
+
+    def __call__(
+        self, key, f, time_expire=DEFAULT_TIME_EXPIRE, destroyer=None, stale_ttl=None
+    ):
         """
         Attention! cache.ram does not copy the cached object.
         It just stores a reference to it. Turns out the deepcopying the object
@@ -241,47 +609,70 @@ class CacheInRam(CacheAbstract):
 
         dt = time_expire
         now = time.time()
+        lock, shard = self.storage.shard(key)
 
-        self.locker.acquire()
-        item = self.storage.get(key, None)
+        lock.acquire()
+        item = shard.get(key, None)
         if item and f is None:
-            del self.storage[key]
+            del shard[key]
             if destroyer:
                 destroyer(item[1])
-        self.stats[self.app]["hit_total"] += 1
-        self.locker.release()
+        elif item:
+            shard.touch(key)
+        shard.stats["hit_total"] += 1
+        lock.release()
 
         if f is None:
             return None
         if item and (dt is None or item[0] > now - dt):
             return item[1]
-        elif item and (item[0] < now - dt) and destroyer:
-            destroyer(item[1])
-        value = f()
+        stale = item and stale_ttl and item[0] > now - dt - stale_ttl
+        flight_key = (self.app, key)
+        if not self.flights.acquire(flight_key, blocking=not stale):
+            # somebody else is refreshing the value
+            return item[1]
+        try:
+            if dt and dt > 0:
+                # the value may have been refreshed while we were waiting
+                lock.acquire()
+                item = shard.get(key, None)
+                lock.release()
+                if item and item[0] > now - dt:
+                    return item[1]
+            if item and destroyer and not stale:
+                destroyer(item[1])
+            value = f()
 
-        self.locker.acquire()
-        self.storage[key] = (now, value)
-        self.stats[self.app]["misses"] += 1
-        if (
-            HAVE_PSUTIL
-            and self.max_ram_utilization is not None
-            and random.random() < 0.10
-        ):
-            remove_oldest_entries(self.storage, percentage=self.max_ram_utilization)
-        self.locker.release()
+            lock.acquire()
+            try:
+                self._store(shard, key, now, value, dt, stale_ttl)
+                shard.stats["misses"] += 1
+                if (
+                    HAVE_PSUTIL
+                    and self.max_ram_utilization is not None
+                    and random.random() < 0.10
+                ):
+                    remove_oldest_entries(shard, percentage=self.max_ram_utilization)
+            finally:
+                lock.release()
+            self._evict()
+        finally:
+            self.flights.release(flight_key)
+        if item and destroyer and stale:
+            destroyer(item[1])
         return value
 
     def increment(self, key, value=1):
         self.initialize()
-        self.locker.acquire()
+        lock, shard = self.storage.shard(key)
+        lock.acquire()
         try:
-            if key in self.storage:
-                value = self.storage[key][1] + value
-            self.storage[key] = (time.time(), value)
-        except BaseException as e:
-            self.locker.release()
-            raise e
-        self.locker.release()
+            if key in shard:
+                value = shard[key][1] + value
+            self._store(shard, key, time.time(), value)
+        finally:
+            lock.release()
+        self._evict()
         return value
 
 
@@ -305,6 +696,7 @@ class CacheOnDisk(CacheAbstract):
 
         def __init__(self, folder, file_lock_time_wait=0.1):
             self.folder = folder
+            self.key_locks = FileKeyLocks(os.path.join(folder, ".locks"))
             self.key_filter_in = lambda key: key
             self.key_filter_out = lambda key: key
             self.file_lock_time_wait = file_lock_time_wait
@@ -349,6 +741,17 @@ class CacheOnDisk(CacheAbstract):
         def release(self, key):
             self.file_locks[key].release()
 
+        def lock_key(self, key, blocking=True):
+            """
+            Locks `key` for recomputation, across threads and processes.
+            Returns an handle to be passed to `unlock_key` or None if
+            `blocking` is False and the key is already locked.
+            """
+            return self.key_locks.acquire(key, blocking)
+
+        def unlock_key(self, handle):
+            self.key_locks.release(handle)
+
         def __setitem__(self, key, value):
             key = self.key_filter_in(key)
             val_file = recfile.open(key, mode="wb", path=self.folder)
@@ -383,6 +786,8 @@ class CacheOnDisk(CacheAbstract):
 
         def __iter__(self):
             for dirpath, dirnames, filenames in os.walk(self.folder):
+                # skip the folder of the lock files
+                dirnames[:] = [d for d in dirnames if not d.startswith(".")]
                 for filename in filenames:
                     yield self.key_filter_out(filename)
 
@@ -446,61 +851,72 @@ class CacheOnDisk(CacheAbstract):
 
         self.storage = CacheOnDisk.PersistentStorage(folder)
 
-    def __call__(self, key, f, time_expire=DEFAULT_TIME_EXPIRE):
-        self.initialize()
-
-        def inc_hit_total(v):
-            v["hit_total"] += 1
-            return v
+    def _get(self, key, delete=False):
+        storage = self.storage
+        storage.acquire(key)
+        try:
+            try:
+                item = storage.get(key)
+            except:
+                del storage[key]
+                item = storage.get(key)
+            if item and delete:
+                del storage[key]
+        finally:
+            storage.release(key)
+        return item
 
-        def inc_misses(v):
-            v["misses"] += 1
+    def _inc_stats(self, name):
+        def inc(v):
+            v[name] += 1
             return v
 
-        dt = time_expire
-        self.storage.acquire(key)
-        self.storage.acquire(CacheAbstract.cache_stats_name)
-
+        storage = self.storage
+        storage.acquire(CacheAbstract.cache_stats_name)
         try:
-            item = self.storage.get(key)
-        except:
-            del self.storage[key]
-            item = self.storage.get(key)
-
-        self.storage.safe_apply(
-            CacheAbstract.cache_stats_name,
-            inc_hit_total,
-            default_value={"hit_total": 0, "misses": 0},
-        )
+            storage.safe_apply(
+                CacheAbstract.cache_stats_name,
+                inc,
+                default_value={"hit_total": 0, "misses": 0},
+            )
+        finally:
+            storage.release(CacheAbstract.cache_stats_name)
 
-        if item and f is None:
-            del self.storage[key]
+    def __call__(self, key, f, time_expire=DEFAULT_TIME_EXPIRE, stale_ttl=None):
+        self.initialize()
+
+        dt = time_expire
+        storage = self.storage
+        item = self._get(key, delete=f is None)
+        self._inc_stats("hit_total")
 
         if f is None:
-            self.storage.release(CacheAbstract.cache_stats_name)
-            self.storage.release(key)
             return None
 
         now = time.time()
 
         if item and ((dt is None) or (item[0] > now - dt)):
-            value = item[1]
-        else:
+            return item[1]
+        stale = item and stale_ttl and item[0] > now - dt - stale_ttl
+        handle = storage.lock_key(key, blocking=not stale)
+        if handle is None:
+            # somebody else is refreshing the value
+            return item[1]
+        try:
+            if dt and dt > 0:
+                # the value may have been refreshed while we were waiting
+                item = self._get(key)
+                if item and item[0] > now - dt:
+                    return item[1]
+            value = f()
+            storage.acquire(key)
             try:
-                value = f()
-            except:
-                self.storage.release(CacheAbstract.cache_stats_name)
-                self.storage.release(key)
-                raise
-            self.storage[key] = (now, value)
-            self.storage.safe_apply(
-                CacheAbstract.cache_stats_name,
-                inc_misses,
-                default_value={"hit_total": 0, "misses": 0},
-            )
-
-        self.storage.release(CacheAbstract.cache_stats_name)
-        self.storage.release(key)
+                storage[key] = (now, value)
+            finally:
+                storage.release(key)
+            self._inc_stats("misses")
+        finally:
+            storage.unlock_key(handle)
         return value
 
     def clear(self, regex=None):
@@ -527,8 +943,271 @@ class CacheOnDisk(CacheAbstract):
         return value
 
 
+class CacheOnSQLite(CacheAbstract):
+    """
+    Disk based cache storing all the keys of an application in a single
+    SQLite file, an alternative to `CacheOnDisk` for multi-process
+    deployments. Use it in a model with::
+
+        cache.disk = CacheOnSQLite(request)
+
+    Keys are indexed, so clearing keys matching a regex with a literal
+    prefix only scans that range. Values stored with a positive
+    `time_expire` are purged, in small batches while writing, once they
+    can no longer be returned. Hit/miss counters are kept in memory by each
+    process and periodically added to a per process row.
+
+    Values stored in the cache must be pickable.
+    """
+
+    class SQLiteStorage(object):
+        """
+        Implements a key based thread/process-safe storage in a SQLite file.
+        """
+
+        stats_interval = 10  # seconds between flushes of the counters
+        purge_probability = 0.01
+        purge_batch = 500
+        timeout = 30
+
+        connections = threading.local()
+        counters = {}  # filename -> [hit_total, misses, last flush]
+        counters_locker = thread.allocate_lock()
+
+        def __init__(self, filename):
+            self.filename = filename
+            self.key_locks = FileKeyLocks(
+                os.path.join(os.path.dirname(filename), ".locks")
+            )
+
+        @property
+        def db(self):
+            # connections are per thread and cannot be shared with forks
+            key = (self.filename, os.getpid())
+            connections = self.connections.__dict__
+            db = connections.get(key)
+            if db is None:
+                db = sqlite3.connect(
+                    self.filename, timeout=self.timeout, isolation_level=None
+                )
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute("PRAGMA synchronous=NORMAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY,"
+                    " time REAL, expire_at REAL, value BLOB)"
+                )
+                db.execute(
+                    "CREATE INDEX IF NOT EXISTS cache_expire_at ON cache (expire_at)"
+                )
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS stats (pid INTEGER PRIMARY KEY,"
+                    " hit_total INTEGER, misses INTEGER)"
+                )
+                db.create_function(
+                    "regexp", 2, lambda regex, key: re.match(regex, key) is not None
+                )
+                connections[key] = db
+            return db
+
+        def get(self, key, default=None):
+            row = self.db.execute(
+                "SELECT time, value FROM cache WHERE key=?", (key,)
+            ).fetchone()
+            if row is None:
+                return default
+            try:
+                return (row[0], pickle.loads(row[1]))
+            except:
+                # corrupted value
+                self.db.execute("DELETE FROM cache WHERE key=?", (key,))
+                return default
+
+        def set(self, key, item, expire_at=None):
+            value = pickle.dumps(item[1], pickle.HIGHEST_PROTOCOL)
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, item[0], expire_at, sqlite3.Binary(value)),
+            )
+            if random.random() < self.purge_probability:
+                self.purge()
+
+        def purge(self, now=None):
+            """Removes a batch of expired values"""
+            self.db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache"
+                " WHERE expire_at < ? LIMIT ?)",
+                (now or time.time(), self.purge_batch),
+            )
+
+        def __getitem__(self, key):
+            if key == CacheAbstract.cache_stats_name:
+                return (time.time(), self.stats())
+            item = self.get(key)
+            if item is None:
+                raise KeyError(key)
+            return item
+
+        def __setitem__(self, key, item):
+            self.set(key, item)
+
+        def __delitem__(self, key):
+            cursor = self.db.execute("DELETE FROM cache WHERE key=?", (key,))
+            if not cursor.rowcount:
+                raise KeyError(key)
+
+        def __contains__(self, key):
+            return (
+                self.db.execute("SELECT 1 FROM cache WHERE key=?", (key,)).fetchone()
+                is not None
+            )
+
+        def __iter__(self):
+            yield CacheAbstract.cache_stats_name
+            for row in self.db.execute("SELECT key FROM cache").fetchall():
+                yield row[0]
+
+        def keys(self):
+            return list(self.__iter__())
+
+        def clear(self, regex=None):
+            if regex is None:
+                self.db.execute("DELETE FROM cache")
+                return
+            prefix = regex_prefix(regex)
+            if prefix:
+                # the index on key limits the scan to the keys with the prefix
+                upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                self.db.execute(
+                    "DELETE FROM cache WHERE key >= ? AND key < ? AND key REGEXP ?",
+                    (prefix, upper, regex),
+                )
+            else:
+                self.db.execute("DELETE FROM cache WHERE key REGEXP ?", (regex,))
+
+        def increment(self, key, value=1):
+            db = self.db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT value FROM cache WHERE key=?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value = pickle.loads(row[0]) + value
+                db.execute(
+                    "INSERT OR REPLACE INTO cache VALUES (?, ?, NULL, ?)",
+                    (key, time.time(), sqlite3.Binary(pickle.dumps(value))),
+                )
+            except:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            return value
+
+        def count(self, name):
+            """Counts an hit (name='hit_total') or a miss (name='misses')"""
+            self.counters_locker.acquire()
+            counters = self.counters.get(self.filename)
+            if counters is None:
+                counters = self.counters[self.filename] = [0, 0, time.time()]
+            counters[0 if name == "hit_total" else 1] += 1
+            flush = counters[2] < time.time() - self.stats_interval
+            self.counters_locker.release()
+            if flush:
+                self.flush_stats()
+
+        def flush_stats(self):
+            self.counters_locker.acquire()
+            counters = self.counters.get(self.filename) or [0, 0, 0]
+            hit_total, misses = counters[0], counters[1]
+            self.counters[self.filename] = [0, 0, time.time()]
+            self.counters_locker.release()
+            if hit_total or misses:
+                self.db.execute(
+                    "INSERT INTO stats VALUES (?, ?, ?) ON CONFLICT(pid) DO UPDATE"
+                    " SET hit_total=hit_total+excluded.hit_total,"
+                    " misses=misses+excluded.misses",
+                    (os.getpid(), hit_total, misses),
+                )
+
+        def stats(self):
+            """Returns the counters summed over all processes"""
+            self.flush_stats()
+            row = self.db.execute(
+                "SELECT SUM(hit_total), SUM(misses) FROM stats"
+            ).fetchone()
+            return {"hit_total": row[0] or 0, "misses": row[1] or 0}
+
+    filename = os.path.join(".sqlite", "cache.sqlite")
+
+    def __init__(self, request=None, folder=None):
+        self.initialized = False
+        self.request = request
+        self.folder = folder
+        self.storage = None
+
+    def initialize(self):
+        if self.initialized:
+            return
+        else:
+            self.initialized = True
+        folder = os.path.join(self.folder or self.request.folder, "cache")
+        filename = os.path.join(folder, self.filename)
+        if not os.path.exists(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        self.storage = CacheOnSQLite.SQLiteStorage(filename)
+
+    def __call__(self, key, f, time_expire=DEFAULT_TIME_EXPIRE, stale_ttl=None):
+        self.initialize()
+
+        dt = time_expire
+        storage = self.storage
+        item = storage.get(key)
+        if item and f is None:
+            storage.db.execute("DELETE FROM cache WHERE key=?", (key,))
+        storage.count("hit_total")
+
+        if f is None:
+            return None
+
+        now = time.time()
+
+        if item and ((dt is None) or (item[0] > now - dt)):
+            return item[1]
+        stale = item and stale_ttl and item[0] > now - dt - stale_ttl
+        handle = storage.key_locks.acquire(key, blocking=not stale)
+        if handle is None:
+            # somebody else is refreshing the value
+            return item[1]
+        try:
+            if dt and dt > 0:
+                # the value may have been refreshed while we were waiting
+                item = storage.get(key)
+                if item and item[0] > now - dt:
+                    return item[1]
+            value = f()
+            expire_at = now + dt + (stale_ttl or 0) if dt and dt > 0 else None
+            storage.set(key, (now, value), expire_at)
+            storage.count("misses")
+        finally:
+            storage.key_locks.release(handle)
+        return value
+
+    def clear(self, regex=None):
+        self.initialize()
+        self.storage.clear(regex)
+
+    def increment(self, key, value=1):
+        self.initialize()
+        return self.storage.increment(key, value)
+
+    @property
+    def stats(self):
+        self.initialize()
+        return self.storage.stats()
+
+
 class CacheAction(object):
-    def __init__(self, func, key, time_expire, cache, cache_model):
+    def __init__(self, func, key, time_expire, cache, cache_model, stale_ttl=None):
         self.__name__ = func.__name__
         self.__doc__ = func.__doc__
         self.func = func
@@ -536,6 +1215,7 @@ class CacheAction(object):
         self.time_expire = time_expire
         self.cache = cache
         self.cache_model = cache_model
+        self.stale_ttl = stale_ttl
 
     def __call__(self, *a, **b):
         if not self.key:
@@ -549,7 +1229,11 @@ class CacheAction(object):
         cache_model = self.cache_model
         if not cache_model or isinstance(cache_model, str):
             cache_model = getattr(self.cache, cache_model or "ram")
-        return cache_model(key2, lambda a=a, b=b: self.func(*a, **b), self.time_expire)
+        # only pass stale_ttl when used, not all cache models support it
+        kwargs = {"stale_ttl": self.stale_ttl} if self.stale_ttl else {}
+        return cache_model(
+            key2, lambda a=a, b=b: self.func(*a, **b), self.time_expire, **kwargs
+        )
 
 
 class Cache(object):
@@ -598,6 +1282,7 @@ class Cache(object):
         public=True,
         valid_statuses=None,
         quick=None,
+        stale_ttl=None,
     ):
         """Better fit for caching an action
 
@@ -623,6 +1308,8 @@ class Cache(object):
                 pass an explicit list of statuses on which turn the cache on
             quick: Session,Vars,Lang,User-agent,Public:
                 fast overrides with initials, e.g. 'SVLP' or 'VLP', or 'VLP'
+            stale_ttl(int): serve the expired page for this many seconds while
+                it is being regenerated (only used with a cache_model)
         """
         from gluon import current
         from gluon.http import HTTP
@@ -684,16 +1371,17 @@ class Cache(object):
                     ).hexdigest()
                     if prefix:
                         cache_key = prefix + cache_key
+                    kwargs = {"stale_ttl": stale_ttl} if stale_ttl else {}
                     try:
                         # action returns something
                         rtn = cache_model(
-                            cache_key, lambda: func(), time_expire=time_expire
+                            cache_key, lambda: func(), time_expire=time_expire, **kwargs
                         )
                         http, status = None, current.response.status
                     except HTTP as e:
                         # action raises HTTP (can still be valid)
                         rtn = cache_model(
-                            cache_key, lambda: e.body, time_expire=time_expire
+                            cache_key, lambda: e.body, time_expire=time_expire, **kwargs
                         )
                         http, status = HTTP(e.status, rtn, **e.headers), e.status
                     else:
@@ -741,7 +1429,13 @@ class Cache(object):
 
         return wrap
 
-    def __call__(self, key=None, time_expire=DEFAULT_TIME_EXPIRE, cache_model=None):
+    def __call__(
+        self,
+        key=None,
+        time_expire=DEFAULT_TIME_EXPIRE,
+        cache_model=None,
+        stale_ttl=None,
+    ):
         """
         Decorator function that can be used to cache any function/method.
 
@@ -755,6 +1449,9 @@ class Cache(object):
                 refresh.
             cache_model(str): can be "ram", "disk" or other (like "memcache").
                 Defaults to "ram"
+            stale_ttl(int): for how many seconds after expiration the old value
+                is returned while another caller recomputes it
+                (supported by "ram" and "disk")
 
         When the function `f` is called, web2py tries to retrieve
         the value corresponding to `key` from the cache if the
@@ -774,7 +1471,7 @@ class Cache(object):
         """
 
         def tmp(func, cache=self, cache_model=cache_model):
-            return CacheAction(func, key, time_expire, self, cache_model)
+            return CacheAction(func, key, time_expire, self, cache_model, stale_ttl)
 
         return tmp
 
@@ -785,13 +1482,13 @@ class Cache(object):
         it will add prefix to all the cache keys used.
         """
         return (
-            lambda key, f, time_expire=DEFAULT_TIME_EXPIRE, prefix=prefix: cache_model(
-                prefix + key, f, time_expire
+            lambda key, f, time_expire=DEFAULT_TIME_EXPIRE, prefix=prefix, **kwargs: (
+                cache_model(prefix + key, f, time_expire, **kwargs)
             )
         )
 
 
-def lazy_cache(key=None, time_expire=None, cache_model="ram"):
+def lazy_cache(key=None, time_expire=None, cache_model="ram", stale_ttl=None):
     """
     Can be used to cache any function including ones in modules,
     as long as the cached function is only called within a web2py request
@@ -800,6 +1497,7 @@ def lazy_cache(key=None, time_expire=None, cache_model="ram"):
     `time_expire` defaults to None (no cache expiration)
 
     If cache_model is "ram" then the model is current.cache.ram, etc.
+    `stale_ttl` is the same as for @cache
     """
 
     def decorator(f, key=key, time_expire=time_expire, cache_model=cache_model):
@@ -808,7 +1506,7 @@ def lazy_cache(key=None, time_expire=None, cache_model="ram"):
         def g(*c, **d):
             from gluon import current
 
-            return current.cache(key, time_expire, cache_model)(f)(*c, **d)
+            return current.cache(key, time_expire, cache_model, stale_ttl)(f)(*c, **d)
 
         g.__name__ = f.__name__
         return g
@@ -22,7 +22,7 @@ cfs = {}  # for speed-up
 cfs_lock = thread.allocate_lock()  # and thread safety
 
 
-def getcfs(key, filename, filter=None):
+def getcfs(key, filename, filter=None, check=True):
     """
     Caches the *filtered* file `filename` with `key` until the file is
     modified.
@@ -33,9 +33,17 @@ def getcfs(key, filename, filter=None):
         filter: is the function used for filtering. Normally `filename` is a
             .py file and `filter` is a function that bytecode compiles the file.
             In this way the bytecode compiled file is cached. (Default = None)
+        check(bool): if False, a cached item is returned without checking
+            whether the file was modified
 
     This is used on Google App Engine since pyc files cannot be saved.
     """
+    if not check:
+        cfs_lock.acquire()
+        item = cfs.get(key, None)
+        cfs_lock.release()
+        if item:
+            return item[1]
     try:
         t = stat(filename).st_mtime
     except OSError:
@@ -12,6 +12,7 @@ Note:
     FOR INTERNAL USE ONLY
 """
 
+import _thread as thread
 import copy
 import fnmatch
 import importlib
@@ -24,6 +25,7 @@ import shutil
 import sys
 import types
 from functools import reduce
+from io import BytesIO
 from os.path import exists
 from os.path import join as pjoin
 
@@ -542,6 +544,7 @@ def compile_models(folder):
         write_file(filename, data)
         save_pyc(filename)
         os.unlink(filename)
+    forget_models_manifest(folder)
 
 
 REGEX_LONG_STRING = re.compile(r'(""".*?"""|' "'''.*?''')", re.DOTALL)
@@ -578,6 +581,80 @@ REGEX_COMPILED_MODEL = r"models[_.][\w.-]+\.pyc$"
 REGEX_MODEL = r"[\w-]+\.py$"
 
 
+model_manifests = {}  # per application sorted list of models
+model_manifests_lock = thread.allocate_lock()
+
+
+def _changed(signature):
+    try:
+        return any(os.stat(d).st_mtime_ns != t for d, t in signature)
+    except OSError:
+        return True
+
+
+def forget_models_manifest(folder):
+    """
+    Drops the cached models manifest of the application in `folder`, to be
+    called whenever its models are compiled, removed, created or edited
+    """
+    folder = os.path.normpath(folder)
+    model_manifests_lock.acquire()
+    for key in [k for k in model_manifests if os.path.normpath(k) == folder]:
+        del model_manifests[key]
+    model_manifests_lock.release()
+
+
+def get_models_manifest(folder):
+    """
+    Returns a tuple (compiled, models) for the application in `folder` where
+    `models` is the sorted list of (filename, name) of its models and `name`
+    is the path matched against `response.models_to_run`.
+
+    The list is cached per application and refreshed only when the models
+    (or compiled) folder or any of its subfolders changes, or when it is
+    dropped by `forget_models_manifest`.
+    """
+    path = pjoin(folder, "models")
+    cpath = pjoin(folder, "compiled")
+    compiled = exists(cpath)
+    model_manifests_lock.acquire()
+    item = model_manifests.get(folder, None)
+    model_manifests_lock.release()
+    if item and item[0] == compiled and not _changed(item[1]):
+        return compiled, item[2]
+    if compiled:
+        dirs = [cpath]
+    else:
+        # the folder itself followed by all its subfolders
+        dirs = [path] + listdir(path, "^$", 0, add_dirs=True, sort=False)[1:]
+    try:
+        signature = [(d, os.stat(d).st_mtime_ns) for d in dirs]
+    except OSError:
+        signature = [(path, None)]
+    if compiled:
+        n = len(cpath) + 8
+        models = [
+            (model, model[n:-4].replace(".", "/") + ".py")
+            for model in sorted(
+                listdir(cpath, REGEX_COMPILED_MODEL, 0),
+                key=lambda f: "{0:03d}".format(f.count(".")) + f,
+            )
+        ]
+    else:
+        n = len(path) + 1
+        models = [
+            (model, model[n:].replace(os.sep, "/"))
+            for model in sorted(
+                listdir(path, REGEX_MODEL, 0, sort=False),
+                key=lambda f: "{0:03d}".format(f.count(os.sep)) + f,
+            )
+        ]
+    model_manifests_lock.acquire()
+    model_manifests[folder] = (compiled, signature, models)
+    model_manifests_lock.release()
+    return compiled, models
+
+
 def run_models_in(environment):
     """
     Runs all models (in the app specified by the current folder)
@@ -589,33 +666,15 @@ def run_models_in(environment):
     # f = environment['request'].function
     response = current.response
 
-    path = pjoin(folder, "models")
-    cpath = pjoin(folder, "compiled")
-    compiled = exists(cpath)
-    if compiled:
-        models = sorted(
-            listdir(cpath, REGEX_COMPILED_MODEL, 0),
-            key=lambda f: "{0:03d}".format(f.count(".")) + f,
-        )
-    else:
-        models = sorted(
-            listdir(path, REGEX_MODEL, 0, sort=False),
-            key=lambda f: "{0:03d}".format(f.count(os.sep)) + f,
-        )
+    compiled, models = get_models_manifest(folder)
 
     models_to_run = None
-    for model in models:
+    for model, fname in models:
         if response.models_to_run != models_to_run:
             regex = models_to_run = response.models_to_run[:]
             if isinstance(regex, list):
                 regex = re_compile("|".join(regex))
         if models_to_run:
-            if compiled:
-                n = len(cpath) + 8
-                fname = model[n:-4].replace(".", "/") + ".py"
-            else:
-                n = len(path) + 1
-                fname = model[n:].replace(os.sep, "/")
             if not regex.search(fname) and c != "appadmin":
                 continue
             elif compiled:
@@ -731,6 +790,72 @@ def run_controller_in(controller, function, environment):
     return vars
 
 
+REGEX_VIEW_DIRECTIVE = r"%s\s*(?:extend|include)\s+(.*?)\s*%s"
+REGEX_LITERAL_FILENAME = re.compile(r"^(\"[^\"]*\"|'[^']*')$")
+
+cached_views = {}  # process-wide cache of parsed and compiled views
+cached_views_lock = thread.allocate_lock()
+
+
+def _read_view(filename, delimiters, dependencies):
+    """
+    Reads a view file recording its mtime in `dependencies`.
+    Returns the text and whether all its extend/include directives are
+    string literals (otherwise the parsed view depends on the context).
+    """
+    mtime = os.stat(filename).st_mtime
+    text = read_file(filename, "rb")
+    dependencies.append((filename, mtime))
+    regex = re_compile(REGEX_VIEW_DIRECTIVE % tuple(map(re.escape, delimiters)))
+    static = all(
+        REGEX_LITERAL_FILENAME.match(arg)
+        for arg in regex.findall(text.decode("utf8", "replace"))
+    )
+    return text, static
+
+
+def get_view_code(filename, path, environment):
+    """
+    Parses and compiles the non-compiled view `filename` found in `path`.
+    The code is cached until the view or any of the files it extends or
+    includes is modified. Views extending or including files whose name is
+    computed at runtime are never cached.
+
+    Returns:
+        a (code object, python source) tuple
+    """
+    delimiters = tuple(environment["response"].delimiters or ("{{", "}}"))
+    key = (filename, delimiters)
+    cached_views_lock.acquire()
+    item = cached_views.get(key, None)
+    cached_views_lock.release()
+    if item:
+        dependencies, ccode, scode = item
+        try:
+            if all(os.stat(f).st_mtime == t for f, t in dependencies):
+                return ccode, scode
+        except OSError:
+            pass
+    dependencies = []
+    text, cacheable = _read_view(filename, delimiters, dependencies)
+
+    def reader(filepath, mode="rb"):
+        nonlocal cacheable
+        data, static = _read_view(filepath, delimiters, dependencies)
+        cacheable = cacheable and static
+        return data
+
+    scode = parse_template(BytesIO(text), path, context=environment, reader=reader)
+    ccode = compile2(scode, filename)
+    cached_views_lock.acquire()
+    if cacheable:
+        cached_views[key] = (dependencies, ccode, scode)
+    else:
+        cached_views.pop(key, None)
+    cached_views_lock.release()
+    return ccode, scode
+
+
 def run_view_in(environment):
     """
     Executes the view for the requested action.
@@ -789,10 +914,8 @@ def run_view_in(environment):
                     rewrite.THREAD_LOCAL.routes.error_message % badv,
                     web2py_error=badv,
                 )
-            # Parse template
-            scode = parse_template(view, pjoin(folder, "views"), context=environment)
-            # Compile template
-            ccode = compile2(scode, filename)
+            # Parse and compile template (cached until a dependency changes)
+            ccode, scode = get_view_code(filename, pjoin(folder, "views"), environment)
             layer = filename
     restricted(ccode, environment, layer=layer, scode=scode)
     # parse_template saves everything in response body
@@ -813,6 +936,7 @@ def remove_compiled_application(folder):
             os.unlink(file)
     except OSError:
         pass
+    forget_models_manifest(folder)
 
 
 def compile_application(folder, skip_failed_views=False):
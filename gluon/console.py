@@ -118,6 +118,8 @@ def console(version):
             "--with-scheduler",
             "--with-cron",
             "--cron-threads",
+            "--cron-in-process",
+            "--cron-timeout",
             "--soft-cron",
             "--cron-run",
             "--run-doctests",
@@ -679,6 +681,26 @@ web2py will attempt to run a GUI to ask for it when starting the web server
         metavar="NUM",
         help="maximum number of cron threads (5)",
     )
+    g.add_argument(
+        "--cron_in_process",
+        "--cron-in-process",
+        default=False,
+        action="store_true",
+        help="run the * and ** crontab entries in long-lived processes that "
+        "keep the application environments, instead of starting web2py for "
+        "each of them",
+    )
+
+    def cron_timeout(v):
+        return positive_int(v, err_label="cron_timeout")
+
+    g.add_argument(
+        "--cron_timeout",
+        "--cron-timeout",
+        type=cron_timeout,
+        metavar="SECONDS",
+        help="stop the jobs run by --cron_in_process after SECONDS",
+    )
     g.add_argument(
         "--soft_cron",
         "--soft-cron",
@@ -944,6 +966,8 @@ def parse_args(parser, cli_args, deprecated_opts, integer_log_level, namespace=N
             "with_cron": store_true,
             "crontab": list_or_default,
             "cron_threads": str_or_default,
+            "cron_in_process": store_true,
+            "cron_timeout": str_or_default,
             "soft_cron": store_true,
             "cron_run": store_true,
             # test options
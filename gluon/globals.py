@@ -44,12 +44,14 @@ Usage:
 
 import copy
 import copyreg
+import decimal
 
 # from types import DictionaryType
 import datetime
 import hashlib
 import io
 import json as json_parser
+import logging
 import os
 import pickle
 import re
@@ -64,6 +66,7 @@ from urllib import parse as urlparse
 from urllib.parse import parse_qs
 
 from pydal.contrib import portalocker
+from pydal.helpers.classes import BasicStorage
 from pydal.utils import utcnow
 
 import gluon.settings as settings
@@ -85,6 +88,8 @@ FMT = "%a, %d-%b-%Y %H:%M:%S PST"
 PAST = "Sat, 1-Jan-1971 00:00:00"
 FUTURE = "Tue, 1-Dec-2999 23:59:59"
 
+logger = logging.getLogger("web2py")
+
 try:
     # FIXME PY3
     from gluon.contrib.minify import minify
@@ -295,6 +300,11 @@ class Request(Storage):
     - is_local
     - is_https
     - restful()
+
+    Uploaded files larger than `multipart_spool_limit` bytes are spooled to
+    temporary files. Setting `multipart_streaming` to True (before accessing
+    request.vars) parses multipart bodies directly from the input stream,
+    without copying them first into request.body, which is then empty.
     """
 
     def __init__(self, env):
@@ -320,6 +330,8 @@ class Request(Storage):
         self.is_local = False
         self.global_settings = settings.global_settings
         self._uuid = None
+        self.multipart_streaming = False
+        self.multipart_spool_limit = 64 * 1024
 
     def parse_get_vars(self):
         """Takes the QUERY_STRING and unpacks it to get_vars"""
@@ -337,6 +349,16 @@ class Request(Storage):
         """
         env = self.env
         post_vars = self._post_vars = Storage()
+        streaming = (
+            self.multipart_streaming
+            and self._body is None
+            and env.get("CONTENT_LENGTH")
+            and env.get("CONTENT_TYPE", "").startswith("multipart/form-data")
+            and "X-Progress-ID" not in self.get_vars
+        )
+        if streaming:
+            # the body is parsed from the input stream and not kept
+            self._body = BytesIO()
         body = self.body
 
         # if content-type is application/json, we must read the body
@@ -391,10 +413,11 @@ class Request(Storage):
                 if boundary:
                     parser = iter(
                         MultipartParser(
-                            body,
+                            env["wsgi.input"] if streaming else body,
                             boundary,
                             content_length=content_length,
                             charset=charset,
+                            spool_limit=self.multipart_spool_limit,
                         )
                     )
                 else:
@@ -403,9 +426,10 @@ class Request(Storage):
                     try:
                         part = next(parser)
                         if part.filename:  # file upload
+                            # large files are already spooled to a temporary file
                             file_storage = Storage(
                                 filename=part.filename,  # already decoded properly
-                                file=BytesIO(part.raw),
+                                file=part.file,
                             )
                             post_vars[part.name] = (
                                 file_storage
@@ -1122,11 +1146,47 @@ class Response(Storage):
         )
 
 
+IMMUTABLE_TYPES = (
+    str,
+    bytes,
+    int,
+    float,
+    complex,
+    bool,
+    type(None),
+    datetime.date,
+    datetime.time,
+    datetime.timedelta,
+    decimal.Decimal,
+)
+
+
+def fingerprint(value):
+    """
+    Returns a snapshot of a session value made of tuples, compared with ==
+    to detect in place changes without pickling it. Objects of other types
+    than the builtin containers, Storage and Row are pickled.
+    """
+    if isinstance(value, float):
+        return (type(value), value.hex())
+    if isinstance(value, IMMUTABLE_TYPES):
+        return (type(value), value)
+    if isinstance(value, dict):
+        return (type(value), tuple((k, fingerprint(v)) for k, v in value.items()))
+    if isinstance(value, BasicStorage):
+        return (type(value), fingerprint(value.__dict__))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(fingerprint(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (type(value), frozenset(fingerprint(v) for v in value))
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
 class Session(Storage):
     """
     Defines the session object and the default values of its members (None)
 
-    - session_storage_type   : 'file', 'db', or 'cookie'
+    - session_storage_type   : 'file', 'db', 'redis' or 'cookie'
     - session_cookie_compression_level :
     - session_cookie_expires : cookie expiration
     - session_cookie_key     : for encrypted sessions in cookies
@@ -1137,6 +1197,8 @@ class Session(Storage):
     - session_new            : a new session obj is being created
     - session_hash           : hash of the pickled loaded session
     - session_pickled        : picked session
+    - session_fingerprints   : snapshots of the mutable values of the
+                               loaded session (if track_changes)
 
     if session in cookie:
 
@@ -1152,10 +1214,87 @@ class Session(Storage):
 
     - session_file
     - session_filename
+
+    if session in redis:
+
+    - session_redis          : the redis connection
+    - session_expiry         : seconds of inactivity before the key expires,
+                               None for keys that never expire
+    - session_version        : version of the loaded data, saved only if
+                               still current
+    - session_loaded         : shallow copy of the loaded session
+    - session_flash_name     : name of the cookie telling a flash is waiting
     """
 
     REGEX_SESSION_FILE = r"^(?:[\w-]+/)?[\w.-]+$"
 
+    # saves the session only if nobody saved it since it was loaded
+    REDIS_SAVE_SCRIPT = """
+if (redis.call("hget", KEYS[1], "version") or "") ~= ARGV[1] then
+    return 0
+end
+redis.call("hset", KEYS[1], "version", ARGV[2], "data", ARGV[3])
+if tonumber(ARGV[4]) > 0 then
+    redis.call("expire", KEYS[1], ARGV[4])
+end
+return 1
+"""
+
+    # change tracking: assignments and deletions of keys set _changed,
+    # in place changes of mutable values are detected by their fingerprints
+
+    def __setitem__(self, key, value):
+        if not (
+            isinstance(value, IMMUTABLE_TYPES)
+            and key in self
+            and type(dict.get(self, key)) is type(value)
+            and dict.get(self, key) == value
+        ):
+            self._set_changed()
+        dict.__setitem__(self, key, value)
+
+    __setattr__ = __setitem__
+
+    def __delitem__(self, key):
+        self._set_changed()
+        dict.__delitem__(self, key)
+
+    __delattr__ = __delitem__
+
+    def update(self, *args, **kwargs):
+        self._set_changed()
+        dict.update(self, *args, **kwargs)
+
+    def __ior__(self, other):
+        self._set_changed()
+        return dict.__ior__(self, other)
+
+    def pop(self, *args):
+        self._set_changed()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._set_changed()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._set_changed()
+        return dict.setdefault(self, key, default)
+
+    def _set_changed(self, changed=True):
+        object.__setattr__(self, "_changed", changed)
+
+    def _fingerprints(self):
+        try:
+            return dict(
+                (key, fingerprint(value))
+                for key, value in self.items()
+                if not isinstance(value, IMMUTABLE_TYPES)
+            )
+        except RecursionError:
+            return pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+
     def connect(
         self,
         request=None,
@@ -1171,6 +1310,9 @@ class Session(Storage):
         compression_level=None,
         safe_unpickle=False,
         pickle_allowed_classes=None,
+        track_changes=True,
+        redis_conn=None,
+        session_expiry=None,
     ):
         """
         Used in models, allows to customize Session handling
@@ -1198,6 +1340,18 @@ class Session(Storage):
                 is used for compatibility.
             pickle_allowed_classes(dict): allowed classes for restricted
                 unpickling when safe_unpickle=True.
+            track_changes(bool): if True (default) changes to the session are
+                detected tracking assignments plus a structural hash of its
+                mutable values, so unchanged sessions are never pickled.
+                With False the whole pickled session is compared instead.
+            redis_conn: to store/retrieve sessions in redis (a StrictRedis
+                or any object with its hmget, expire, delete and
+                register_script).
+                The session is fetched on first use and saved only if changed,
+                without locks: concurrent changes to different keys are merged
+            session_expiry(int): seconds after which an unused session
+                expires in redis, counted from the last request reading or
+                saving it. None (default) means sessions never expire
         """
         request = request or current.request
         response = response or current.response
@@ -1205,6 +1359,8 @@ class Session(Storage):
         cookies = request.cookies
 
         self._unlock(response)
+        if type(self) is LazySession:
+            object.__setattr__(self, "__class__", Session)
 
         response.session_masterapp = masterapp
         response.session_id_name = "session_id_%s" % masterapp.lower()
@@ -1213,6 +1369,13 @@ class Session(Storage):
         response.session_client = str(request.client).replace(":", ".")
         current._session_cookie_key = cookie_key
         response.session_cookie_compression_level = compression_level
+        response.session_track_changes = track_changes
+        if safe_unpickle:
+            response.session_loads = lambda data: safe_loads(
+                data, allowed_classes=pickle_allowed_classes
+            )
+        else:
+            response.session_loads = pickle.loads
 
         # check if there is a session_id in cookies
         try:
@@ -1224,6 +1387,8 @@ class Session(Storage):
         # if we are supposed to use cookie based session data
         if cookie_key:
             response.session_storage_type = "cookie"
+        elif redis_conn is not None:
+            response.session_storage_type = "redis"
         elif db:
             response.session_storage_type = "db"
         else:
@@ -1310,6 +1475,36 @@ class Session(Storage):
                 )
                 response.session_new = True
 
+        # else if the session goes in redis
+        elif response.session_storage_type == "redis":
+            # if had a session on file already, close it
+            if response.session_file:
+                self._close(response)
+            response.session_redis = redis_conn
+            response.session_expiry = session_expiry
+            response.session_flash_name = "session_flash_%s" % masterapp.lower()
+            if response.session_id and (
+                not re.match(self.REGEX_SESSION_FILE, response.session_id)
+                or check_client
+                and response.session_client
+                != os.path.basename(response.session_id).split("-")[0]
+            ):
+                response.session_id = None
+            if not response.session_id:
+                response.session_id = "%s-%s" % (response.session_client, web2py_uuid())
+                response.session_new = True
+                response.session_version = None
+                response.session_loaded = {}
+            elif response.session_flash_name in cookies:
+                # a flash is waiting for this request
+                response.session_new = False
+                self._redis_load(response)
+            else:
+                # fetched on first use
+                response.session_new = False
+                object.__setattr__(self, "_response", response)
+                object.__setattr__(self, "__class__", LazySession)
+
         # else the session goes in db
         elif response.session_storage_type == "db":
             if global_settings.db_sessions is not True:
@@ -1404,12 +1599,77 @@ class Session(Storage):
                     cookie_expires.strftime(FMT)
                 )
 
-        session_pickled = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
-        response.session_hash = hashlib.md5(session_pickled).hexdigest()
+        if type(self) is not LazySession:
+            self._loaded(response)
+
+    def _loaded(self, response):
+        """Takes note of the loaded session, to tell later if it changed"""
+        if response.session_track_changes:
+            response.session_hash = None
+            response.session_fingerprints = self._fingerprints()
+            self._set_changed(False)
+        else:
+            session_pickled = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+            response.session_hash = hashlib.md5(session_pickled).hexdigest()
+            response.session_fingerprints = None
 
         if self.flash:
             (response.flash, self.flash) = (self.flash, None)
 
+    def _load(self):
+        """Fetches the session data if not done yet (see LazySession)"""
+
+    def _redis_key(self, response):
+        return "w2p:session:%s:%s" % (response.session_masterapp, response.session_id)
+
+    def _redis_load(self, response):
+        key = self._redis_key(response)
+        version, data = response.session_redis.hmget(key, "version", "data")
+        if data is not None:
+            try:
+                dict.update(self, response.session_loads(data))
+            except (
+                pickle.UnpicklingError,
+                EOFError,
+                ValueError,
+                AttributeError,
+                ImportError,
+            ):
+                version = None
+        if version is None:
+            # expired or never existed, do not take the id from the client
+            response.session_id = "%s-%s" % (response.session_client, web2py_uuid())
+            response.session_new = True
+        elif response.session_expiry:
+            # used again: restart the inactivity timeout
+            response.session_redis.expire(key, response.session_expiry)
+        response.session_version = version and int(version)
+        response.session_loaded = dict(self)
+
+    def _changes(self, response):
+        """Returns the items set and the keys deleted since the session was loaded"""
+        loaded = response.session_loaded or {}
+        fingerprints = response.session_fingerprints
+        if not isinstance(fingerprints, dict):
+            fingerprints = {}
+        changed = {}
+        for key, value in self.items():
+            if key not in loaded:
+                changed[key] = value
+            elif isinstance(value, IMMUTABLE_TYPES):
+                if type(value) is not type(loaded[key]) or value != loaded[key]:
+                    changed[key] = value
+            else:
+                try:
+                    if value is not loaded[key] or fingerprint(
+                        value
+                    ) != fingerprints.get(key):
+                        changed[key] = value
+                except RecursionError:
+                    changed[key] = value
+        deleted = [key for key in loaded if key not in self]
+        return changed, deleted
+
     def renew(self, clear_session=False):
         if clear_session:
             self.clear()
@@ -1469,6 +1729,15 @@ class Session(Storage):
             else:
                 response.session_new = True
 
+        # else the session goes in redis
+        elif response.session_storage_type == "redis":
+            self._load()
+            if not response.session_new:
+                response.session_redis.delete(self._redis_key(response))
+            response.session_id = "%s-%s" % (response.session_client, web2py_uuid())
+            response.session_version = None
+            response.session_new = True
+
     def _set_cookie_security_attrs(self, scookies):
         if self.get("httponly_cookies", True):
             scookies["HttpOnly"] = True
@@ -1488,8 +1757,12 @@ class Session(Storage):
     def _fixup_before_save(self):
         response = current.response
         rcookies = response.cookies
+        if type(self) is LazySession and not response.session_cookie_expires:
+            # not used, the client has the session cookie already
+            rcookies.pop(response.session_id_name, None)
+            return
         scookies = rcookies.get(response.session_id_name)
-        if self._forget:
+        if dict.get(self, "_forget"):
             if scookies:
                 del rcookies[response.session_id_name]
             return
@@ -1555,6 +1828,10 @@ class Session(Storage):
                 (record_id, sep, unique_key) = response.session_id.partition(":")
                 if record_id.isdigit() and int(record_id) > 0:
                     table._db(table.id == record_id).delete()
+        elif response.session_storage_type == "redis":
+            response.session_redis.delete(self._redis_key(response))
+            response.session_version = None
+        self._set_changed()
         Storage.clear(self)
 
     def is_new(self):
@@ -1613,6 +1890,11 @@ class Session(Storage):
                 if item not in internal:
                     return False
             return True
+        if response.session_fingerprints is not None:
+            return (
+                not self.__dict__.get("_changed")
+                and self._fingerprints() == response.session_fingerprints
+            )
         session_pickled = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
         response.session_pickled = session_pickled
         session_hash = hashlib.md5(session_pickled).hexdigest()
@@ -1672,6 +1954,53 @@ class Session(Storage):
             return self._try_store_in_file(request, response)
         if response.session_storage_type == "cookie":
             return self._try_store_in_cookie(request, response)
+        if response.session_storage_type == "redis":
+            return self._try_store_in_redis(request, response)
+
+    def _try_store_in_redis(self, request, response):
+        if type(self) is LazySession:
+            # never used, nothing to save
+            return False
+        if self._forget or self._unchanged(response):
+            self.save_session_id_cookie()
+            return False
+        key = self._redis_key(response)
+        changed, deleted = self._changes(response)
+        version = response.session_version
+        save = response.session_redis.register_script(self.REDIS_SAVE_SCRIPT)
+        for attempt in range(3):
+            session_pickled = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+            args = [version or "", (version or 0) + 1, session_pickled]
+            if save(keys=[key], args=args + [response.session_expiry or 0]):
+                response.session_version = (version or 0) + 1
+                break
+            # saved meanwhile by another request: apply our changes to that
+            version, data = response.session_redis.hmget(key, "version", "data")
+            if version is None:
+                # deleted meanwhile (renewed, cleared or expired): not revived
+                return False
+            version = int(version)
+            session_data = response.session_loads(data) if data else {}
+            for name in deleted:
+                session_data.pop(name, None)
+            session_data.update(changed)
+            dict.clear(self)
+            dict.update(self, session_data)
+        else:
+            logger.warning("session %s not saved, concurrently changed" % key)
+            return False
+        # tell the next request to fetch the session for the flash
+        rcookies = response.cookies
+        name = response.session_flash_name
+        if self.flash:
+            rcookies[name] = "1"
+            rcookies[name]["path"] = "/"
+        elif name in request.cookies:
+            rcookies[name] = "expired"
+            rcookies[name]["path"] = "/"
+            rcookies[name]["expires"] = PAST
+        self.save_session_id_cookie()
+        return True
 
     def _try_store_in_file(self, request, response):
         try:
@@ -1723,6 +2052,62 @@ class Session(Storage):
                 pass
 
 
+class LazySession(Session):
+    """
+    A Session stored in redis whose data are not fetched yet: the first use
+    fetches them and turns it back into a Session, so requests that do not
+    use the session do not query redis.
+    """
+
+    def forget(self, response=None):
+        # does not need the data, so does not fetch them
+        self._close(response)
+        dict.__setitem__(self, "_forget", True)
+
+    def _load(self):
+        response = self.__dict__.pop("_response")
+        object.__setattr__(self, "__class__", Session)
+        self._redis_load(response)
+        self._loaded(response)
+
+
+def _lazy_method(name):
+    def method(self, *args, **kwargs):
+        self._load()
+        return getattr(self, name)(*args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+for _name in (
+    "__getitem__",
+    "__getattr__",
+    "__setitem__",
+    "__setattr__",
+    "__delitem__",
+    "__delattr__",
+    "__contains__",
+    "__iter__",
+    "__len__",
+    "__eq__",
+    "__ne__",
+    "__repr__",
+    "__ior__",
+    "get",
+    "keys",
+    "values",
+    "items",
+    "copy",
+    "update",
+    "pop",
+    "popitem",
+    "setdefault",
+    "clear",
+):
+    setattr(LazySession, _name, _lazy_method(_name))
+
+
 def pickle_session(s):
     return Session, (dict(s),)
 
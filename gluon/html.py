@@ -14,6 +14,7 @@ import base64
 import copy
 import copyreg
 import functools
+import hashlib
 import itertools
 import os
 import pickle
@@ -127,9 +128,14 @@ __all__ = [
     "SAFEJSON",
     "xmlescape",
     "embed64",
+    "cached_fragment",
 ]
 
 DEFAULT_PASSWORD_DISPLAY = "*" * 8
+XML_BUFFER_SIZE = 65536  # chars per piece of XmlComponent.xml_chunks()
+XML_MAX_DEPTH = 10000  # nesting of helpers rendered by DIV._xml_walk
+NONCE_MARK = ' nonce="\x00"'  # stands for the CSP nonce in a FrozenXML
+_xml_walkable = {}  # DIV classes rendered by DIV._xml_walk, see there
 
 
 def xmlescape(data, quote=True):
@@ -592,6 +598,29 @@ class XmlComponent(object):
     def xml(self):
         raise NotImplementedError
 
+    def xml_chunks(self, size=XML_BUFFER_SIZE):
+        """
+        Generates the xml of the component in pieces of about size chars,
+        "".join()ed they make up xml()
+        """
+        yield self.xml()
+
+    def xml_stream(self, size=XML_BUFFER_SIZE):
+        """
+        Generates the xml of the component utf8 encoded, for streaming big
+        trees of helpers (e.g. returning it from a controller)
+        """
+        for chunk in self.xml_chunks(size):
+            yield chunk.encode("utf8")
+
+    def freeze(self):
+        """
+        Returns the component rendered once, as a `FrozenXML` that can be
+        kept and used in other helpers without being rendered again (the
+        CSP nonce of its scripts and styles follows the current response)
+        """
+        return FrozenXML(self.xml(), csp_nonce())
+
     def __mul__(self, n):
         return CAT(*[self for i in range(n)])
 
@@ -762,6 +791,93 @@ def XML_pickle(data):
 copyreg.pickle(XML, XML_pickle, XML_unpickle)
 
 
+def csp_nonce():
+    """Returns the nonce of the current response if it enabled CSP, else None"""
+    from gluon import current
+
+    response = getattr(current, "response", None)
+    if response is not None and response._csp_enabled:
+        return response.nonce
+    return None
+
+
+class FrozenXML(XML):
+    """
+    The xml of a frozen helper (see `XmlComponent.freeze`), with the hash of
+    its content (e.g. for an ETag)
+
+    The nonce given to scripts and styles while rendering (see
+    `Response.enable_csp`) is not frozen: it is stored as NONCE_MARK and
+    xml() writes the nonce of the response using the fragment, or drops the
+    attribute if that response has CSP disabled.
+    """
+
+    def __init__(self, text, nonce=None):
+        XML.__init__(self, text)
+        if nonce:
+            self.text = self.text.replace(' nonce="%s"' % nonce, NONCE_MARK)
+        self.nonced = NONCE_MARK in self.text
+        self.hash = hashlib.sha1(self.text.encode("utf8")).hexdigest()
+
+    def xml(self):
+        if not self.nonced:
+            return self.text
+        nonce = csp_nonce()
+        return self.text.replace(NONCE_MARK, ' nonce="%s"' % nonce if nonce else "")
+
+    __str__ = __repr__ = xml
+
+    def freeze(self):
+        return self
+
+
+def cached_fragment(key=None, time_expire=300, vary=None, cache_model=None):
+    """
+    Decorator for functions building helpers that rarely change (menus,
+    navbars, footers...): their result is frozen and kept in cache.ram (or
+    cache_model) for time_expire seconds, by key (the function name if None),
+    arguments and what vary() returns, if given.
+
+    Example::
+
+        @cached_fragment(vary=lambda: (T.accepted_language, auth.is_logged_in()))
+        def navbar():
+            return MENU(response.menu)
+
+    and `{{=navbar()}}` in the layout. The fragment is a `FrozenXML`, so it
+    can be placed in helpers rebuilt at each request, and its scripts and
+    styles get the CSP nonce of the request showing it, not of the one that
+    built it.
+    """
+
+    def decorator(f):
+        name = key or "%s.%s" % (f.__module__, f.__name__)
+
+        @functools.wraps(f)
+        def fragment(*args, **kwargs):
+            from gluon import current
+
+            cache = cache_model or getattr(current, "cache", None)
+            if cache is None:
+                return FrozenXML(xmlescape(f(*args, **kwargs)), csp_nonce())
+            cache = getattr(cache, "ram", cache)
+            fragment_key = "fragment:%s:%r:%r:%r" % (
+                name,
+                args,
+                sorted(kwargs.items()),
+                vary() if vary else None,
+            )
+            return cache(
+                fragment_key,
+                lambda: FrozenXML(xmlescape(f(*args, **kwargs)), csp_nonce()),
+                time_expire,
+            )
+
+        return fragment
+
+    return decorator
+
+
 class DIV(XmlComponent):
     """
     HTML helper, for easy generating and manipulating a DOM structure.
@@ -1037,12 +1153,113 @@ class DIV(XmlComponent):
         co = "".join([xmlescape(component) for component in self.components])
         return (fa, co)
 
+    def _xml_attributes(self):
+        """
+        Returns the xml of the component attributes, as rendered by `_xml`
+        (where it is inlined, being the hot path of xml())
+        """
+        # get the attributes for this component
+        # (they start with '_', others may have special meanings)
+        attr = []
+        for key, value in self.attributes.items():
+            if key[:1] != "_":
+                continue
+            name = key[1:]
+            if value is True:
+                value = name
+            elif value is False or value is None:
+                continue
+            attr.append((name, value))
+        data = self.attributes.get("data", {})
+        for key, value in data.items():
+            name = "data-" + key
+            value = data[key]
+            attr.append((name, value))
+        attr.sort()
+        fa = ""
+        for name, value in attr:
+            fa += f' {name}="{xmlescape(value, True)}"'
+        return fa
+
+    def _xml_walk(self, stack, out, size=0):
+        """
+        Appends to out the xml of the components in stack, a list of
+        (iterator of components, closing tag), starting with [(iter([self]),
+        "")]. The tree of the components using `DIV.xml` is walked
+        iteratively, so that it can be rendered in pieces and at any depth;
+        the others are rendered calling their xml().
+        With size, stops once about size chars were appended: returns whether
+        the walk is over, otherwise it goes on calling again with the stack.
+        """
+        append = out.append
+        length = 0
+        while stack:
+            components, closing = stack[-1]
+            for component in components:
+                cls = type(component)
+                walk = _xml_walkable.get(cls)
+                if walk is None:
+                    walk = _xml_walkable[cls] = (
+                        issubclass(cls, DIV)
+                        and cls.xml is DIV.xml
+                        and cls._xml is DIV._xml
+                    )
+                nested = False
+                if (walk and "xml" not in component.__dict__) or component is self:
+                    tagname = component.tag or ""
+                    if tagname[-1:] == "/":
+                        piece = "<%s%s />" % (tagname[:-1], component._xml_attributes())
+                    else:
+                        nested = True
+                        piece = ""
+                        if tagname:
+                            piece = "<%s%s>" % (tagname, component._xml_attributes())
+                            tagname = "</%s>" % tagname
+                        if len(stack) > XML_MAX_DEPTH:
+                            # not a RecursionError, that DIV.xml would retry
+                            raise RuntimeError("helpers nested too deep")
+                        stack.append((iter(component.components), tagname))
+                else:
+                    piece = xmlescape(component)
+                append(piece)
+                if size:
+                    length += len(piece)
+                    if length >= size:
+                        return False
+                if nested:
+                    break
+            else:
+                stack.pop()
+                append(closing)
+                length += len(closing)
+        return True
+
+    def xml_chunks(self, size=XML_BUFFER_SIZE):
+        cls = type(self)
+        if cls.xml is not DIV.xml or cls._xml is not DIV._xml or "xml" in self.__dict__:
+            yield self.xml()
+            return
+        stack = [(iter((self,)), "")]
+        done = False
+        while not done:
+            out = []
+            done = self._xml_walk(stack, out, size)
+            yield "".join(out)
+
     def xml(self):
         """
         generates the xml for this component.
         """
 
-        (fa, co) = self._xml()
+        try:
+            (fa, co) = self._xml()
+        except RecursionError:
+            if type(self)._xml is not DIV._xml:
+                raise
+            # too deep to go on recursively, walk the rest of the tree
+            out = []
+            self._xml_walk([(iter((self,)), "")], out)
+            return "".join(out)
 
         if not self.tag:
             return co
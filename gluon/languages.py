@@ -12,6 +12,7 @@ Translation system
 """
 
 import ast
+import atexit
 import builtins
 import copyreg
 import logging
@@ -19,6 +20,7 @@ import os
 import pkgutil
 import re
 import sys
+import time
 from threading import RLock
 
 from pydal.contrib.portalocker import LockedFile, read_locked
@@ -164,9 +166,11 @@ def read_dict_aux(filename):
         return {"__corrupted__": status}
 
 
-def read_dict(filename):
+def read_dict(filename, check=True):
     """Returns dictionary with translation messages"""
-    return getcfs("lang:" + filename, filename, lambda: read_dict_aux(filename))
+    return getcfs(
+        "lang:" + filename, filename, lambda: read_dict_aux(filename), check
+    )
 
 
 def read_possible_plural_rules():
@@ -275,9 +279,12 @@ def read_possible_languages_aux(langdir):
     return langs
 
 
-def read_possible_languages(langpath):
+def read_possible_languages(langpath, check=True):
     return getcfs(
-        "langs:" + langpath, langpath, lambda: read_possible_languages_aux(langpath)
+        "langs:" + langpath,
+        langpath,
+        lambda: read_possible_languages_aux(langpath),
+        check,
     )
 
 
@@ -292,9 +299,12 @@ def read_plural_dict_aux(filename):
         return {"__corrupted__": status}
 
 
-def read_plural_dict(filename):
+def read_plural_dict(filename, check=True):
     return getcfs(
-        "plurals:" + filename, filename, lambda: read_plural_dict_aux(filename)
+        "plurals:" + filename,
+        filename,
+        lambda: read_plural_dict_aux(filename),
+        check,
     )
 
 
@@ -339,6 +349,58 @@ def write_dict(filename, contents):
             fp.close()
 
 
+# new translations and plural forms, written to their files at most every
+# WRITE_DELAY seconds instead of at every miss:
+# pending_writes:
+# { 'languages/xx.py': (read_dict, write_dict, {"def-message": "xx-message"}),
+#   'languages/plural-xx.py': (read_plural_dict, write_plural_dict, {...}),
+#   ...
+# }
+
+WRITE_DELAY = 5
+
+pending_writes = {}
+last_writes = {}
+missing_translations = {}  # number of misses by language file
+pending_lock = RLock()
+
+
+def write_later(filename, key, value, read=read_dict, write=write_dict):
+    """Buffers a new item of a language (or plural) file, see flush_writes()"""
+    pending_lock.acquire()
+    try:
+        pending_writes.setdefault(filename, (read, write, {}))[2][key] = value
+    finally:
+        pending_lock.release()
+
+
+def flush_writes(delay=WRITE_DELAY):
+    """
+    Writes the buffered items to the files not written in the last *delay*
+    seconds, it is called at the end of each request and at exit
+    """
+    now = time.time()
+    pending_lock.acquire()
+    try:
+        ready = [
+            filename
+            for filename in pending_writes
+            if now - last_writes.get(filename, 0) >= delay
+        ]
+        ready = [(filename, pending_writes.pop(filename)) for filename in ready]
+        for filename, item in ready:
+            last_writes[filename] = now
+    finally:
+        pending_lock.release()
+    for filename, (read, write, items) in ready:
+        contents = dict(read(filename)) if os.path.exists(filename) else {}
+        contents.update(items)
+        write(filename, contents)
+
+
+atexit.register(flush_writes, 0)
+
+
 class lazyT(object):
     """
     Never to be called explicitly, returned by
@@ -462,8 +524,13 @@ class TranslatorFactory(object):
         - en and en-en are considered different languages!
         - if language xx-yy is not found force() probes other similar languages
           using such algorithm: `xx-yy.py -> xx.py -> xx-yy*.py -> xx*.py`
+        - new strings are added to the language files by flush_writes(), in
+          production set `TranslatorFactory.read_only = True` so that language
+          files are neither written nor checked for changes
     """
 
+    read_only = False
+
     def __init__(self, langpath, http_accept_language):
         self.langpath = langpath
         self.http_accept_language = http_accept_language
@@ -491,7 +558,7 @@ class TranslatorFactory(object):
         self.filter = markmin
         self.ftag = "markmin"
         self.ns = None
-        self.is_writable = True
+        self.is_writable = not self.read_only
 
     def get_possible_languages_info(self, lang=None):
         """
@@ -528,7 +595,7 @@ class TranslatorFactory(object):
             lang (str): language
 
         """
-        info = read_possible_languages(self.langpath)
+        info = read_possible_languages(self.langpath, not self.read_only)
         if lang:
             info = info.get(lang)
         return info
@@ -540,7 +607,9 @@ class TranslatorFactory(object):
                 self.current_languages
                 + [
                     lang
-                    for lang in read_possible_languages(self.langpath)
+                    for lang in read_possible_languages(
+                        self.langpath, not self.read_only
+                    )
                     if lang != "default"
                 ]
             )
@@ -564,7 +633,9 @@ class TranslatorFactory(object):
                 self.current_languages = [DEFAULT_LANGUAGE]
             else:
                 self.default_language_file = os.path.join(self.langpath, "default.py")
-                self.default_t = read_dict(self.default_language_file)
+                self.default_t = read_dict(
+                    self.default_language_file, not self.read_only
+                )
                 self.current_languages = [pl_info[0]]  # !langcode!
         else:
             self.current_languages = list(languages)
@@ -606,7 +677,13 @@ class TranslatorFactory(object):
                     forms[id - 1] = form
                     self.plural_dict[word] = forms
                     if self.is_writable and is_writable() and self.plural_file:
-                        write_plural_dict(self.plural_file, self.plural_dict)
+                        write_later(
+                            self.plural_file,
+                            word,
+                            forms,
+                            read_plural_dict,
+                            write_plural_dict,
+                        )
                     return form
         return word
 
@@ -622,7 +699,7 @@ class TranslatorFactory(object):
         default language will be selected if none
         of them matches possible_languages.
         """
-        pl_info = read_possible_languages(self.langpath)
+        pl_info = read_possible_languages(self.langpath, not self.read_only)
 
         def set_plural(language):
             """
@@ -642,7 +719,7 @@ class TranslatorFactory(object):
                 if pname:
                     pname = os.path.join(self.langpath, pname)
                     if pmtime != 0:
-                        pdict = read_plural_dict(pname)
+                        pdict = read_plural_dict(pname, not self.read_only)
                 self.plural_file = pname
                 self.plural_dict = pdict
             else:
@@ -682,7 +759,7 @@ class TranslatorFactory(object):
                     if language in self.current_languages:
                         break
                     self.language_file = os.path.join(self.langpath, language + ".py")
-                    self.t = read_dict(self.language_file)
+                    self.t = read_dict(self.language_file, not self.read_only)
                     self.cache = global_language_cache.setdefault(
                         self.language_file, ({}, RLock())
                     )
@@ -828,13 +905,20 @@ class TranslatorFactory(object):
             message = message.rsplit("##", 1)[0]
         # guess translation same as original
         self.t[key] = mt = self.default_t.get(key, message)
+        pending_lock.acquire()
+        try:
+            missing_translations[self.language_file] = (
+                missing_translations.get(self.language_file, 0) + 1
+            )
+        finally:
+            pending_lock.release()
         # update language file for latter translation
         if (
             self.is_writable
             and is_writable()
             and self.language_file != self.default_language_file
         ):
-            write_dict(self.language_file, self.t)
+            write_later(self.language_file, key, mt)
         return regex_backslash.sub(lambda m: m.group(1).translate(ttab_in), mt)
 
     def params_substitution(self, message, symbols):
@@ -106,6 +106,7 @@ from gluon.contenttype import contenttype
 from gluon.globals import Request, Response, Session
 from gluon.html import URL, xmlescape
 from gluon.http import HTTP, redirect
+from gluon.languages import flush_writes, pending_writes
 from gluon.restricted import RestrictedError
 from gluon.rewrite import THREAD_LOCAL as rwthread
 from gluon.rewrite import fixup_missing_path_info
@@ -585,6 +586,9 @@ def wsgibase(environ, responder):
             response.session_file.close()
 
     session._unlock(response)
+    # write the new strings of language files, if not done recently
+    if pending_writes:
+        flush_writes()
     http_response, new_environ = try_rewrite_on_error(
         http_response, request, environ, ticket
     )
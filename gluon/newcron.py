@@ -12,15 +12,20 @@ Cron-style interface
 """
 
 import datetime
+import heapq
+import io
+import itertools
+import multiprocessing
 import os
 import pickle
+import queue
 import re
-import sched
 import shlex
 import sys
 import threading
 import time
-from functools import reduce
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
 from logging import getLogger
 
 from pydal.contrib import portalocker
@@ -40,6 +45,10 @@ def reset():
 
 _subprocs_lock = threading.RLock()
 _subprocs = []
+_executors = []  # long-lived processes running jobs in-process
+
+JOB_POLL = 1  # seconds between checks that a job process is still alive
+CRONTAB_CHECK = 60  # seconds between checks for crontab changes by hardcron
 
 
 def subprocess_count():
@@ -72,6 +81,12 @@ def stopcron():
                 proc.terminate()
             except Exception:
                 getLogger(logger_name).exception("error in stopcron")
+    with _subprocs_lock:
+        executors = _executors[:]
+        del _executors[:]
+    for process in executors:
+        if process.is_alive():
+            process.terminate()
 
 
 def extcron(applications_parent, apps=None):
@@ -89,19 +104,43 @@ class hardcron(threading.Thread):
         getLogger(logger_name).info("hard cron bootstrap")
         crondance(self.path, "hard", startup=True, apps=self.apps)
 
-    def launch(self):
-        if not _stopping:
-            self.logger.debug("hard cron invocation")
-            crondance(self.path, "hard", startup=False, apps=self.apps)
+    def launch(self, due):
+        if _stopping:
+            return
+        self.logger.debug("hard cron invocation")
+        token = Token(self.path)
+        if not token.acquire():
+            return
+        try:
+            for app, task in due:
+                if _stopping:
+                    break
+                launch(app, task, "hard")
+        finally:
+            token.release()
 
     def run(self):
+        """
+        Sleeps until the next entry is due, looking for crontab changes (a
+        stat of each crontab) every CRONTAB_CHECK seconds
+        """
         self.logger = getLogger(logger_name)
         self.logger.info("hard cron daemon started")
-        s = sched.scheduler(time.time, time.sleep)
+        schedule = CronSchedule(self.path, self.apps)
+        next_check = datetime.datetime.now()
         while not _stopping:
-            now = time.time()
-            s.enter(60 - now % 60, 1, self.launch, ())
-            s.run()
+            now = datetime.datetime.now()
+            if now >= next_check:
+                try:
+                    schedule.refresh(now)
+                except Exception:
+                    self.logger.exception("error reading crontabs")
+                next_check = now + datetime.timedelta(seconds=CRONTAB_CHECK)
+            due = schedule.pop_due(now)
+            if due:
+                self.launch(due)
+            wakeup = min(schedule.next_due() or next_check, next_check)
+            time.sleep(max((wakeup - datetime.datetime.now()).total_seconds(), 0))
 
 
 def softcron(applications_parent, apps=None):
@@ -322,6 +361,162 @@ class SoftWorker(threading.Thread):
                 self.pool.stop(self)
 
 
+def run_job(envs, app, command, models):
+    """
+    Runs the action command of app (a script or a controller[/function], as
+    `web2py.py -S app -R script` would) in the environment of app, built at
+    the first job and kept in envs for the next ones
+    """
+    from pydal import DAL
+
+    from gluon import current
+    from gluon.compileapp import read_pyc
+    from gluon.shell import env, execfile, parse_path_info
+
+    c = f = None
+    if not command.endswith(".py"):
+        a, c, f = parse_path_info("%s/%s" % (app, command))
+        models = True
+    key = (app, c, f, models)
+    if key not in envs:
+        adir = os.path.abspath(os.path.join("applications", app))
+        envs[key] = env(app, import_models=models, c=c, f=f, dir=adir)
+    _env = dict(envs[key])
+    # what the models left in current belongs to the last app built
+    current.globalenv = _env
+    for name in ("request", "response", "session", "T", "cache"):
+        setattr(current, name, _env[name])
+    try:
+        if c:
+            pyfile = os.path.join("applications", app, "controllers", c + ".py")
+            pycfile = os.path.join(
+                "applications", app, "compiled", "controllers.%s.%s.pyc" % (c, f)
+            )
+            if os.path.isfile(pycfile) or not os.path.isfile(pyfile):
+                exec(read_pyc(pycfile), _env)
+            else:
+                execfile(pyfile, _env)
+            if f:
+                exec("print(%s())" % f, _env)
+        else:
+            execfile(command, _env)
+    except BaseException:
+        for value in _env.values():
+            if isinstance(value, DAL):
+                try:
+                    value.rollback()
+                except Exception:
+                    pass
+        raise
+    for value in _env.values():
+        if isinstance(value, DAL):
+            value.commit()
+
+
+def job_executor(jobq, retq):
+    """
+    The function run by the processes of JobWorker: runs the jobs coming
+    through jobq, reporting (success, output) through retq
+    """
+    envs = {}
+    while True:
+        job = jobq.get()
+        if job is None:
+            break
+        output = io.StringIO()
+        with redirect_stdout(output), redirect_stderr(output):
+            try:
+                run_job(envs, *job)
+                success = True
+            except BaseException:
+                # SystemExit included
+                traceback.print_exc()
+                success = False
+        retq.put((success, output.getvalue()))
+
+
+class JobWorker(threading.Thread):
+    """
+    Runs the action jobs (* and ** crontab entries) in a long-lived process,
+    so that the interpreter starts, and the models of each app run, once.
+    The process is replaced after a job fails or takes more than its timeout
+    """
+
+    def __init__(self, pool):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pool = pool
+        self.run_lock = threading.Lock()
+        self.run_lock.acquire()
+        self.payload = None
+        self.process = None
+        self.queues = (None, None)
+
+    def start_process(self):
+        # forking a threaded web server can deadlock the child
+        ctx = multiprocessing.get_context("spawn")
+        self.queues = (ctx.Queue(), ctx.Queue())
+        self.process = ctx.Process(target=job_executor, args=self.queues)
+        self.process.daemon = True
+        self.process.start()
+        with _subprocs_lock:
+            _executors.append(self.process)
+
+    def stop_process(self):
+        process, self.process = self.process, None
+        with _subprocs_lock:
+            if process in _executors:
+                _executors.remove(process)
+        if process.is_alive():
+            process.terminate()
+        process.join(1)
+
+    def execute(self, app, command, models, timeout):
+        logger = getLogger(logger_name)
+        if not (self.process and self.process.is_alive()):
+            self.start_process()
+        jobq, retq = self.queues
+        jobq.put((app, command, models))
+        start = time.time()
+        while True:
+            try:
+                success, output = retq.get(timeout=JOB_POLL)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    success, output = False, "job process died"
+                    break
+                if timeout and time.time() - start > timeout:
+                    success, output = False, "timed out after %ss" % timeout
+                    break
+        if success:
+            logger.debug(
+                "JobWorker %s: %s %r returned success:\n%s",
+                self.name,
+                app,
+                command,
+                output,
+            )
+        else:
+            logger.warning(
+                "JobWorker %s: %s %r failed:\n%s", self.name, app, command, output
+            )
+            self.stop_process()
+
+    def run(self):
+        logger = getLogger(logger_name)
+        logger.info("JobWorker %s: started", self.name)
+        while True:
+            try:
+                with self.run_lock:  # waiting for run_lock.release()
+                    self.execute(*self.payload)
+            except Exception:
+                logger.exception("JobWorker %s: error running job", self.name)
+            finally:
+                self.run_lock.acquire()
+                self.pool.stop(self)
+
+
 class SimplePool(object):
     """
     Very simple thread pool,
@@ -399,74 +594,247 @@ def dancer_size(size):
 _launcher = SimplePool(5)
 
 
+_runner = SimplePool(5, worker_cls=JobWorker)
+
+_in_process = False
+_job_timeout = None
+
+
 def launcher_size(size):
     _launcher.grow(size)
+    _runner.grow(size)
 
 
-def crondance(applications_parent, ctype="hard", startup=False, apps=None):
+def jobs_in_process(enabled=True, timeout=None):
     """
-    Does the periodic job of cron service: read the crontab(s) and launch
-    the various commands.
+    Runs the * and ** crontab entries in long-lived processes keeping the
+    apps environments (see JobWorker), stopping them after timeout seconds
+    """
+    global _in_process, _job_timeout
+    _in_process = enabled
+    _job_timeout = timeout
+
+
+def crontabs(applications_parent, apps=None):
+    """
+    Returns (app, path) of the crontabs of apps (all of them if None),
+    skipping the apps linking to another one
     """
     apppath = os.path.join(applications_parent, "applications")
-    token = Token(applications_parent)
-    cronmaster = token.acquire(startup=startup)
-    if not cronmaster:
-        return
-    try:
-        now_s = time.localtime()
-        checks = (
-            ("min", now_s.tm_min),
-            ("hr", now_s.tm_hour),
-            ("mon", now_s.tm_mon),
-            ("dom", now_s.tm_mday),
-            ("dow", (now_s.tm_wday + 1) % 7),
-        )
+    if not apps:
+        apps = [
+            x for x in os.listdir(apppath) if os.path.isdir(os.path.join(apppath, x))
+        ]
+    full_apath_links = set()
+    tabs = []
+    for app in apps:
+        apath = os.path.join(apppath, app)
+
+        # if app is a symbolic link to other app, skip it
+        full_apath_link = absolute_path_link(apath)
+        if full_apath_link in full_apath_links:
+            continue
+        else:
+            full_apath_links.add(full_apath_link)
+
+        crontab = os.path.join(apath, "cron", "crontab")
+        if os.path.exists(crontab):
+            tabs.append((app, crontab))
+    return tabs
+
+
+_crontabs_lock = threading.RLock()
+_crontabs = {}  # parsed crontabs by path: (version, tasks)
+
+
+def read_crontab(crontab):
+    """
+    Returns (version, tasks) of crontab, parsing it again only when its
+    version (mtime and size) changes
+    """
+    st = os.stat(crontab)
+    version = (st.st_mtime_ns, st.st_size)
+    with _crontabs_lock:
+        cached = _crontabs.get(crontab)
+        if cached and cached[0] == version:
+            return cached
+    cronlines = [line.strip() for line in fileutils.readlines_file(crontab, "rt")]
+    lines = [line for line in cronlines if line and not line.startswith("#")]
+    tasks = [task for task in map(parsecronline, lines) if task]
+    with _crontabs_lock:
+        _crontabs[crontab] = (version, tasks)
+    return version, tasks
+
+
+def is_due(task, now_s):
+    """Tells whether task fires at now_s (a time.struct_time)"""
+    checks = (
+        ("min", now_s.tm_min),
+        ("hr", now_s.tm_hour),
+        ("mon", now_s.tm_mon),
+        ("dom", now_s.tm_mday),
+        ("dow", (now_s.tm_wday + 1) % 7),
+    )
+    return not any(k in task and not v in task[k] for k, v in checks)
+
+
+CRON_RANGES = dict(
+    min=range(60), hr=range(24), dom=range(1, 32), mon=range(1, 13), dow=range(7)
+)
+CRON_HORIZON = datetime.timedelta(days=8 * 366)  # leap days may skip 2100
+
+
+def next_fire(task, after):
+    """
+    Returns the first minute, after the one of datetime after, when task
+    fires (None for @reboot entries and for the ones never firing)
+    """
+    for k, values in CRON_RANGES.items():
+        if k in task and not any(v in values for v in task[k]):
+            return None
+    t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    limit = t + CRON_HORIZON
+    while t < limit:
+        if "mon" in task and t.month not in task["mon"]:
+            t = t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)
+            t = t.replace(day=1)
+        elif ("dom" in task and t.day not in task["dom"]) or (
+            "dow" in task and (t.weekday() + 1) % 7 not in task["dow"]
+        ):
+            t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+        elif "hr" in task and t.hour not in task["hr"]:
+            t = t.replace(minute=0) + datetime.timedelta(hours=1)
+        elif "min" in task and t.minute not in task["min"]:
+            t += datetime.timedelta(minutes=1)
+        else:
+            return t
+    return None
+
+
+class CronSchedule(object):
+    """
+    The crontab entries of the apps in a heap by next fire time, updated
+    when the crontabs change
+    """
+
+    def __init__(self, applications_parent, apps=None):
+        self.path = applications_parent
+        self.apps = apps
+        self.heap = []
+        self.versions = {}  # crontab -> version of its entries in the heap
+        self.counter = itertools.count()  # ties in the heap keep file order
+
+    def refresh(self, now):
+        """Reschedules the entries of the crontabs changed since last time"""
         logger = getLogger(logger_name)
+        versions = {}
+        changed = {}
+        for app, crontab in crontabs(self.path, self.apps):
+            try:
+                version, tasks = read_crontab(crontab)
+            except Exception as e:
+                logger.error("crontab read error %s", e)
+                continue
+            versions[crontab] = version
+            if self.versions.get(crontab) != version:
+                changed[crontab] = (app, tasks)
+        gone = set(self.versions) - set(versions)
+        if not changed and not gone:
+            return False
+        logger.info("crontabs changed: %s", ", ".join(sorted(set(changed) | gone)))
+        self.heap = [e for e in self.heap if e[3] in versions and e[3] not in changed]
+        for crontab, (app, tasks) in changed.items():
+            for task in tasks:
+                fire = next_fire(task, now)
+                if fire:
+                    self.heap.append((fire, next(self.counter), app, crontab, task))
+        heapq.heapify(self.heap)
+        self.versions = versions
+        return True
+
+    def pop_due(self, now):
+        """Returns the (app, task) due at now, scheduling their next fire"""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            fire, count, app, crontab, task = heapq.heappop(self.heap)
+            due.append((app, task))
+            fire = next_fire(task, max(fire, now))
+            if fire:
+                heapq.heappush(self.heap, (fire, count, app, crontab, task))
+        return due
 
-        if not apps:
-            apps = [
-                x
-                for x in os.listdir(apppath)
-                if os.path.isdir(os.path.join(apppath, x))
-            ]
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
 
-        full_apath_links = set()
 
+def launch(app, task, ctype="hard"):
+    """Hands the command of task over to a thread of the pools"""
+    logger = getLogger(logger_name)
+    logger.info(
+        "%s cron: %s executing %r in %s at %s",
+        ctype,
+        app,
+        task.get("cmd"),
+        os.getcwd(),
+        datetime.datetime.now(),
+    )
+    action = models = False
+    command = task["cmd"]
+    if command.startswith("**"):
+        action = True
+        command = command[2:]
+    elif command.startswith("*"):
+        action = models = True
+        command = command[1:]
+
+    launcher = _launcher
+    if action and _in_process:
+        launcher = _runner
+        commands = (app, command, models, _job_timeout)
+    elif action:
         if sys.executable.lower().endswith("pythonservice.exe"):
             _python_exe = os.path.join(sys.exec_prefix, "python.exe")
         else:
             _python_exe = sys.executable
-        base_commands = [_python_exe]
+        commands = [_python_exe]
         w2p_path = fileutils.abspath("web2py.py", gluon=True)
         if os.path.exists(w2p_path):
-            base_commands.append(w2p_path)
-        base_commands.extend(("--cron_job", "--no_banner", "--no_gui", "--plain"))
+            commands.append(w2p_path)
+        commands.extend(("--cron_job", "--no_banner", "--no_gui", "--plain"))
+        if command.endswith(".py"):
+            commands.extend(("-S", app, "-R", command))
+        else:
+            commands.extend(("-S", app + "/" + command))
+        if models:
+            commands.append("-M")
+    else:
+        commands = shlex.split(command)
 
-        for app in apps:
-            if _stopping:
-                break
-            apath = os.path.join(apppath, app)
+    try:
+        if not launcher(commands):
+            logger.warning("no thread available, cannot execute %r", task["cmd"])
+    except Exception:
+        logger.exception("error executing %r", task["cmd"])
 
-            # if app is a symbolic link to other app, skip it
-            full_apath_link = absolute_path_link(apath)
-            if full_apath_link in full_apath_links:
-                continue
-            else:
-                full_apath_links.add(full_apath_link)
 
-            cronpath = os.path.join(apath, "cron")
-            crontab = os.path.join(cronpath, "crontab")
-            if not os.path.exists(crontab):
-                continue
+def crondance(applications_parent, ctype="hard", startup=False, apps=None):
+    """
+    Does the periodic job of cron service: read the crontab(s) and launch
+    the various commands.
+    """
+    token = Token(applications_parent)
+    cronmaster = token.acquire(startup=startup)
+    if not cronmaster:
+        return
+    try:
+        now_s = time.localtime()
+        logger = getLogger(logger_name)
+
+        for app, crontab in crontabs(applications_parent, apps):
+            if _stopping:
+                break
             try:
-                cronlines = [
-                    line.strip() for line in fileutils.readlines_file(crontab, "rt")
-                ]
-                lines = [
-                    line for line in cronlines if line and not line.startswith("#")
-                ]
-                tasks = [parsecronline(cline) for cline in lines]
+                tasks = read_crontab(crontab)[1]
             except Exception as e:
                 logger.error("crontab read error %s", e)
                 continue
@@ -474,49 +842,11 @@ def crondance(applications_parent, ctype="hard", startup=False, apps=None):
             for task in tasks:
                 if _stopping:
                     break
-                if not task:
-                    continue
                 task_min = task.get("min", [])
                 if not startup and task_min == [-1]:
                     continue
-                citems = [(k in task and not v in task[k]) for k, v in checks]
-                if task_min != [-1] and reduce(lambda a, b: a or b, citems):
+                if task_min != [-1] and not is_due(task, now_s):
                     continue
-
-                logger.info(
-                    "%s cron: %s executing %r in %s at %s",
-                    ctype,
-                    app,
-                    task.get("cmd"),
-                    os.getcwd(),
-                    datetime.datetime.now(),
-                )
-                action = models = False
-                command = task["cmd"]
-                if command.startswith("**"):
-                    action = True
-                    command = command[2:]
-                elif command.startswith("*"):
-                    action = models = True
-                    command = command[1:]
-
-                if action:
-                    commands = base_commands[:]
-                    if command.endswith(".py"):
-                        commands.extend(("-S", app, "-R", command))
-                    else:
-                        commands.extend(("-S", app + "/" + command))
-                    if models:
-                        commands.append("-M")
-                else:
-                    commands = shlex.split(command)
-
-                try:
-                    if not _launcher(commands):
-                        logger.warning(
-                            "no thread available, cannot execute %r", task["cmd"]
-                        )
-                except Exception:
-                    logger.exception("error executing %r", task["cmd"])
+                launch(app, task, ctype)
     finally:
         token.release()
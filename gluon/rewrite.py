@@ -39,6 +39,14 @@ REGEX_AT = re.compile(r"(?<!\\)\$[a-zA-Z]\w*")
 REGEX_ANYTHING = re.compile(r"(?<!\\)\$anything")
 REGEX_REDIRECT = re.compile(r"(\d+)->(.*)")
 REGEX_VERSION = re.compile(r"^(_[\d]+\.[\d]+\.[\d]+)$")
+ROUTE_HEAD = "^.*?:https?://[^:/]+:[a-z]+ "  # compile_regex puts it before a path
+REGEX_ROUTE_HEAD = re.compile(ROUTE_HEAD, re.DOTALL)
+# a literal first segment of a path pattern, followed by "/" or the end
+REGEX_ROUTE_SEGMENT = re.compile(r"/([\w~-]+)(?=/(?![*+?{])|\$)")
+# named groups become plain groups when rules are merged into one regex;
+# back references, conditionals and global flags keep a rule on its own
+REGEX_GROUP_NAME = re.compile(r"(?<!\\)\(\?P<\w+>")
+REGEX_UNMERGEABLE = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)")
 
 # pattern to find valid paths in url /application/controller/...
 #   this could be:
@@ -84,6 +92,105 @@ def _router_default():
     return router
 
 
+class CompiledRoutes(tuple):
+    """
+    The (regex, value, env) rules of routes_app/in/out, built once by load()
+
+    match() returns the first rule matching a key, in the order of the rules.
+    Rules on a bare path are indexed by its first segment when it is literal
+    (/blog/$anything), so a key only tries the rules of its own segment and
+    the ones that do not have any. Runs of rules are tried at once, as an
+    alternation of their paths (each followed by an empty group naming the
+    rule) matched after the ROUTE_HEAD of the key.
+    """
+
+    def __init__(self, rules=()):
+        self.paths = []  # pattern after ROUTE_HEAD, None if it cannot merge
+        self.segments = []  # literal first segment of the path, or None
+        for rule in self:
+            pattern = rule[0].pattern
+            if (
+                pattern.startswith(ROUTE_HEAD)
+                and "|" not in pattern
+                and not REGEX_UNMERGEABLE.search(pattern)
+            ):
+                path = pattern[len(ROUTE_HEAD) :]
+                m = REGEX_ROUTE_SEGMENT.match(path)
+                self.paths.append(path)
+                self.segments.append(m and m.group(1))
+            else:
+                self.paths.append(None)
+                self.segments.append(None)
+        self.indexed = set(self.segments)
+        self.dispatch = {}  # segment -> steps of match(), see compile()
+
+    def compile(self, segment=None):
+        """
+        Builds the (regex, rules, merged) steps tried by match() on paths
+        in /segment, or on any other path if segment is None
+        """
+        steps = []
+        run = []
+
+        def merge():
+            if len(run) > 1:
+                try:
+                    regex = re.compile(
+                        "|".join(
+                            "(?:%s)(?P<_r%d>)"
+                            % (REGEX_GROUP_NAME.sub("(?:", self.paths[i]), k)
+                            for k, i in enumerate(run)
+                        ),
+                        re.DOTALL,
+                    )
+                except (re.error, OverflowError, RecursionError):
+                    steps.extend((self[i][0], [self[i]], False) for i in run)
+                else:
+                    steps.append((regex, [self[i] for i in run], True))
+            elif run:
+                steps.append((self[run[0]][0], [self[run[0]]], False))
+            del run[:]
+
+        for i, rule in enumerate(self):
+            if self.paths[i] is None:
+                merge()
+                steps.append((rule[0], [rule], False))
+            elif self.segments[i] in (None, segment):
+                run.append(i)
+        merge()
+        self.dispatch[segment] = steps
+        return steps
+
+    def match(self, key):
+        """Returns the first rule whose regex matches key, or None"""
+        start = key.find(" ") + 1
+        if (
+            not start
+            or key.find(" ", start) >= 0
+            or "\n" in key
+            or not REGEX_ROUTE_HEAD.match(key)
+        ):
+            # the head could end at another space, "$" match before a newline
+            for rule in self:
+                if rule[0].match(key):
+                    return rule
+            return None
+        segment = key[start + 1 :].partition("/")[0]
+        if key[start : start + 1] != "/" or segment not in self.indexed:
+            segment = None
+        steps = self.dispatch.get(segment)
+        if steps is None:
+            steps = self.compile(segment)
+        for regex, rules, merged in steps:
+            if merged:
+                m = regex.match(key, start)
+                if m:
+                    return rules[int(m.lastgroup[2:])]
+            elif regex.match(key):
+                return rules[0]
+        return None
+
+
 def _params_default(app=None):
     """Returns a new copy of default parameters"""
     p = Storage()
@@ -91,9 +198,9 @@ def _params_default(app=None):
     p.default_application = app or "init"
     p.default_controller = "default"
     p.default_function = "index"
-    p.routes_app = []
-    p.routes_in = []
-    p.routes_out = []
+    p.routes_app = CompiledRoutes()
+    p.routes_in = CompiledRoutes()
+    p.routes_out = CompiledRoutes()
     p.routes_onerror = []
     p.routes_apps_raw = []
     p.error_handler = None
@@ -113,6 +220,17 @@ params = _params_default(app=None)  # regex rewrite parameters
 THREAD_LOCAL.routes = params  # default to base regex rewrite parameters
 routers = None
 
+URL_OUT_CACHE_SIZE = 10000
+url_out_cache = dict()  # outgoing rewrites, emptied by load()
+
+
+def cache_url_out(key, value):
+    """Stores an outgoing rewrite, starting over when there are too many"""
+    if len(url_out_cache) >= URL_OUT_CACHE_SIZE:
+        url_out_cache.clear()
+    url_out_cache[key] = value
+    return value
+
 
 def log_rewrite(string):
     """Log rewrite activity under control of routes.py"""
@@ -351,6 +469,7 @@ def load(routes="routes.py", app=None, data=None, rdict=None):
     """
     global params
     global routers
+    url_out_cache.clear()
     if app is None:
         # reinitialize
         global params_apps
@@ -388,8 +507,7 @@ def load(routes="routes.py", app=None, data=None, rdict=None):
 
     for sym in ("routes_app", "routes_in", "routes_out"):
         if sym in symbols:
-            for items in symbols[sym]:
-                p[sym].append(compile_regex(*items))
+            p[sym] = CompiledRoutes(compile_regex(*items) for items in symbols[sym])
     for sym in (
         "routes_onerror",
         "routes_apps_raw",
@@ -480,7 +598,7 @@ def compile_regex(k, v, env=None):
     # if there are no :-separated parts, prepend a catch-all for the IP address
     if k.find(":") < 0:
         # k = '^.*?:%s' % k[1:]
-        k = "^.*?:https?://[^:/]+:[a-z]+ %s" % k[1:]
+        k = ROUTE_HEAD + k[1:]
     # if there's no ://, provide a catch-all for the protocol, host & method
     if k.find("://") < 0:
         i = k.find(":/")
@@ -622,12 +740,13 @@ def regex_uri(e, regexes, tag, default=None):
         e.get("REQUEST_METHOD", "get").lower(),
         path,
     )
-    for regex, value, custom_env in regexes:
-        if regex.match(key):
-            e.update(custom_env)
-            rewritten = regex.sub(value, key)
-            log_rewrite("%s: [%s] [%s] -> %s" % (tag, key, value, rewritten))
-            return rewritten
+    rule = regexes.match(key)
+    if rule:
+        regex, value, custom_env = rule
+        e.update(custom_env)
+        rewritten = regex.sub(value, key)
+        log_rewrite("%s: [%s] [%s] -> %s" % (tag, key, value, rewritten))
+        return rewritten
     log_rewrite("%s: [%s] -> %s (not rewritten)" % (tag, key, default))
     return default
 
@@ -774,11 +893,16 @@ def regex_filter_out(url, e=None):
             )
         else:
             items[0] = ":http://localhost:get %s" % items[0]
-        for regex, value, tmp in routes.routes_out:
-            if regex.match(items[0]):
-                rewritten = "?".join([regex.sub(value, items[0])] + items[1:])
-                log_rewrite("routes_out: [%s] -> %s" % (url, rewritten))
-                return rewritten
+        key = (id(routes), items[0])
+        path = url_out_cache.get(key)
+        if path is None:
+            rule = routes.routes_out.match(items[0])
+            path = rule[0].sub(rule[1], items[0]) if rule else False
+            cache_url_out(key, path)
+        if path is not False:
+            rewritten = "?".join([path] + items[1:])
+            log_rewrite("routes_out: [%s] -> %s" % (url, rewritten))
+            return rewritten
     log_rewrite("routes_out: [%s] not rewritten" % url)
     return url
 
@@ -1555,7 +1679,38 @@ def map_url_out(
     We use [applications] and [controllers] and {functions} to suppress ambiguous omissions.
 
     We assume that language names do not collide with a/c/f names.
+
+    The results are cached by what they depend on: a/c/f, the language, the
+    domain, whether host is given and, when there are args, whether the first
+    one could be mistaken for a/c/f.
     """
+    router = routers[application] if application in routers else routers.BASE
+    domain_application = request and request.env.domain_application
+    if args:
+        if router.exclusive_domain:
+            applications = [domain_application]
+        else:
+            applications = routers.BASE.applications
+        arg0 = (
+            args[0] in router.functions.get(controller, ())
+            or args[0] in router.controllers
+            or args[0] in applications
+        )
+    else:
+        arg0 = None
+    key = (
+        application,
+        controller,
+        function,
+        arg0,
+        language or request and request.uri_language,
+        domain_application,
+        request and request.env.domain_controller,
+        not host,
+    )
+    acf = url_out_cache.get(key)
+    if acf is not None:
+        return acf
     map = MapUrlOut(
         request,
         env,
@@ -1569,7 +1724,7 @@ def map_url_out(
         port,
         language,
     )
-    return map.acf()
+    return cache_url_out(key, map.acf())
 
 
 def get_effective_router(appname):
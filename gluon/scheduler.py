@@ -12,6 +12,7 @@ Background processes made simple
 
 from __future__ import print_function
 
+import bisect
 import builtins
 import datetime
 import logging
@@ -19,6 +20,7 @@ import multiprocessing
 import os
 import queue as Queue
 import re
+import select
 import signal
 import socket
 import sys
@@ -31,6 +33,7 @@ from functools import reduce
 from json import dumps, loads
 
 from pydal.base import DEFAULT
+from pydal.helpers.classes import ExecutionHandler
 from pydal.objects import Query
 from pydal.utils import utcnow
 
@@ -89,7 +92,8 @@ http://127.0.0.1:8000/myapp/appadmin/select/db?query=db.scheduler_worker.id
 
 """
 
-IDENTIFIER = "%s#%s" % (socket.gethostname(), os.getpid())
+HOSTNAME = socket.gethostname()
+IDENTIFIER = "%s#%s" % (HOSTNAME, os.getpid())
 
 logger = logging.getLogger("web2py.scheduler.%s" % IDENTIFIER)
 
@@ -112,6 +116,23 @@ HEARTBEAT = 3 * SECONDS
 MAXHIBERNATION = 10
 CLEAROUT = "!clear!"
 RESULTINFILE = "result_in_file:"
+WAKEUP_QUEUED = b"queued"
+WAKEUP_ASSIGNED = b"assigned"
+WAKEUP_RETRY = 0.05 * SECONDS
+WAKEUP_CACHE = 5 * SECONDS  # how long producers reuse the tickers addresses
+ASSIGN_WINDOW = 50  # tasks per slot assigned to workers not measured yet
+ASSIGN_CHUNK = 500  # ids per UPDATE when assigning
+OUTPUT_BUFFER_SIZE = 4096  # chars buffered by tasks before sending output
+OUTPUT_BUFFER_TIME = 1 * SECONDS  # ...or seconds
+OUTPUT_POLL = 0.1 * SECONDS
+OUTPUT_TRUNCATED = "\n[output truncated]\n"
+RETENTION_BATCH = 500  # rows deleted at a time by the retention policy
+RETENTION_BATCHES = 10  # ...and batches per ticker cycle at most
+RETENTION_STATUSES = (COMPLETED, FAILED, TIMEOUT, STOPPED, EXPIRED)
+METRICS_BUCKETS = {
+    "seconds": (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+    "queries": (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+}
 
 CALLABLETYPES = (
     types.LambdaType,
@@ -131,6 +152,80 @@ def try_rollback(db):
         return False
 
 
+def wakeup_workers(workers_stats, message):
+    """Notifies the workers (the ones running on this host) through their
+    wakeup sockets, as recorded in their worker_stats"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for stats in workers_stats:
+            address = (stats or {}).get("wakeup")
+            if address and address[0] == HOSTNAME:
+                sock.sendto(message, ("127.0.0.1", address[1]))
+    except socket.error:
+        # just a hint, workers will find out at their next heartbeat anyway
+        logger.debug("error sending wakeup notifications", exc_info=True)
+    finally:
+        sock.close()
+
+
+class QueryCounter(ExecutionHandler):
+    """Counts the queries run by each thread"""
+
+    counts = threading.local()
+
+    @classmethod
+    def count(cls):
+        return getattr(cls.counts, "n", 0)
+
+    def after_execute(self, command):
+        self.counts.n = self.count() + 1
+
+
+def histogram(unit="seconds"):
+    """A new histogram of values in unit, with the METRICS_BUCKETS of unit
+    (plus one for the bigger values)"""
+    return dict(
+        unit=unit, buckets=[0] * (len(METRICS_BUCKETS[unit]) + 1), sum=0, count=0
+    )
+
+
+def observe(h, value):
+    h["buckets"][bisect.bisect_left(METRICS_BUCKETS[h["unit"]], value)] += 1
+    h["sum"] += value
+    h["count"] += 1
+
+
+def percentile(h, q):
+    """Estimates the q (0 < q < 1) percentile of h, as the bound of the bucket
+    holding it (None when beyond the last one)"""
+    if not h["count"]:
+        return None
+    bounds = METRICS_BUCKETS[h["unit"]]
+    seen = 0
+    for i, n in enumerate(h["buckets"]):
+        seen += n
+        if seen >= q * h["count"]:
+            return bounds[i] if i < len(bounds) else None
+
+
+def merge_metrics(metrics, other):
+    """Adds the values in other to metrics (nested dicts of histograms and
+    counters)"""
+    for key, value in other.items():
+        if key not in metrics:
+            metrics[key] = loads(dumps(value))
+        elif isinstance(value, dict) and "buckets" in value:
+            h = metrics[key]
+            h["buckets"] = [a + b for a, b in zip(h["buckets"], value["buckets"])]
+            h["sum"] += value["sum"]
+            h["count"] += value["count"]
+        elif isinstance(value, dict):
+            merge_metrics(metrics[key], value)
+        else:
+            metrics[key] += value
+    return metrics
+
+
 class Task(object):
     """Defines a "task" object that gets passed from the main thread to the
     executor's one
@@ -154,6 +249,8 @@ class TaskReport(object):
     thread to the main one
     """
 
+    last = False  # the warm executor process exits after this task
+
     def __init__(self, status, result=None, output=None, tb=None):
         logger.debug("    new task report: %s", status)
         if tb:
@@ -468,75 +565,203 @@ class CronParser(object):
 # borrowed from http://stackoverflow.com/questions/956867/
 
 
-def executor(retq, task, outq):
-    """The function used to execute tasks in the background process."""
-    logger.debug("    task started")
+class LogOutput(object):
+    """Facility to log output at intervals.
 
-    class LogOutput(object):
-        """Facility to log output at intervals."""
-
-        def __init__(self, out_queue):
-            self.out_queue = out_queue
-            self.stdout = sys.stdout
-            self.written = False
-            sys.stdout = self
+    With a buffer_size the output is sent in batches, when the buffer is full
+    or OUTPUT_BUFFER_TIME seconds after the first write, whatever comes first.
+    """
 
-        def close(self):
-            sys.stdout = self.stdout
+    def __init__(self, out_queue, buffer_size=0):
+        self.out_queue = out_queue
+        self.stdout = sys.stdout
+        self.written = False
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.timer = None
+        self.lock = threading.Lock()
+        sys.stdout = self
+
+    def close(self):
+        self.flush()
+        sys.stdout = self.stdout
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.buffer:
+            self.out_queue.put("".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def write(self, data):
+        self.written = True
+        if not self.buffer_size:
+            self.out_queue.put(data)
+            return
+        with self.lock:
+            self.buffer.append(data)
+            self.buffered += len(data)
+            if self.buffered >= self.buffer_size:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(OUTPUT_BUFFER_TIME, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+
+class TaskOutput(object):
+    """The output of a task run, stored while the task runs: as a whole in
+    scheduler_run.run_output or, when chunked, appending the new output to
+    scheduler_run_output.
+
+    At most `limit` chars are kept (the first ones with truncation="head",
+    the last ones with "tail"); chunks are dropped as a whole, so with "tail"
+    a little more may be kept.
+    """
 
-        def flush(self):
-            pass
+    def __init__(self, db, run_id, chunked=False, limit=None, truncation="tail"):
+        self.db = db
+        self.run_id = run_id
+        self.chunked = chunked
+        self.limit = limit
+        self.keep_head = truncation == "head"
+        self.text = ""  # the whole output (when not chunked)
+        self.pending = ""  # the output not saved yet
+        self.cleared = False
+        self.chunks = []  # (id, size) of the saved chunks
+        self.size = 0
+
+    def write(self, data):
+        if CLEAROUT in data:
+            data = data[data.rfind(CLEAROUT) + len(CLEAROUT) :]
+            self.text = self.pending = ""
+            self.cleared = True
+        self.pending += data
+        if not self.chunked:
+            self.text = self.truncate(self.text + data)
+
+    def truncate(self, text):
+        if self.limit and len(text) > self.limit:
+            if self.keep_head:
+                return text[: self.limit] + OUTPUT_TRUNCATED
+            return OUTPUT_TRUNCATED + text[-self.limit :]
+        return text
+
+    def save(self):
+        """Stores the output not saved yet"""
+        if not self.run_id:
+            # results are discarded
+            self.pending = ""
+            return
+        db = self.db
+        try:
+            if self.chunked:
+                self.save_chunk()
+            elif self.pending:
+                db(db.scheduler_run.id == self.run_id).update(run_output=self.text)
+            db.commit()
+        except Exception:
+            logger.exception(" error while saving partial output")
+            try_rollback(db)
+        else:
+            logger.debug(" partial output saved")
+            self.pending = ""
+            self.cleared = False
 
-        def write(self, data):
-            self.out_queue.put(data)
-            self.written = True
+    def save_chunk(self):
+        db = self.db
+        sro = db.scheduler_run_output
+        if self.cleared:
+            db(sro.run_id == self.run_id).delete()
+            self.chunks, self.size = [], 0
+        data = self.pending
+        if self.limit and self.keep_head:
+            if self.size >= self.limit:
+                data = ""
+            elif self.size + len(data) > self.limit:
+                data = data[: self.limit - self.size] + OUTPUT_TRUNCATED
+        elif self.limit and len(data) > self.limit:
+            data = data[-self.limit :]
+        if not data:
+            return
+        chunk_id = sro.insert(run_id=self.run_id, run_output=data)
+        self.chunks.append((chunk_id, len(data)))
+        self.size += len(data)
+        if self.limit and not self.keep_head:
+            dropped = []
+            while len(self.chunks) > 1 and self.size - self.chunks[0][1] >= self.limit:
+                chunk_id, size = self.chunks.pop(0)
+                dropped.append(chunk_id)
+                self.size -= size
+            if dropped:
+                db(sro.id.belongs(dropped)).delete()
+
+
+def task_environment(app):
+    """Builds the environment of the tasks of app, running its models"""
+    from gluon.shell import env, parse_path_info
+
+    ## FIXME: why temporarily change the log level of the root logger?
+    # level = logging.getLogger().getEffectiveLevel()
+    # logging.getLogger().setLevel(logging.WARN)
+    # support for task.app like 'app/controller'
+    (a, c, f) = parse_path_info(app)
+    _env = env(a=a, c=c, import_models=True, extra_request={"is_scheduler": True})
+    # logging.getLogger().setLevel(level)
+    return _env
+
+
+def run_task(task, _env):
+    """Runs task in the environment _env, returns its json result"""
+    from gluon import current
 
     W2P_TASK = Storage({"id": task.task_id, "uuid": task.uuid, "run_id": task.run_id})
-    stdout = LogOutput(outq)
+    f = task.function
+    if hasattr(current, "_scheduler") and hasattr(current._scheduler, "tasks"):
+        functions = current._scheduler.tasks
+    else:
+        functions = None
+    if functions:
+        _function = functions.get(f)
+    else:
+        # look into env
+        _function = _env.get(f)
+    if not isinstance(_function, CALLABLETYPES):
+        raise NameError("name '%s' not found in scheduler's environment" % f)
+    # Inject W2P_TASK into environment
+    _env.update({"W2P_TASK": W2P_TASK})
+    # Inject W2P_TASK into current
+    current.W2P_TASK = W2P_TASK
+    globals().update(_env)
+    args = loads(task.args)
+    vars = loads(task.vars)
+    result = dumps(_function(*args, **vars))
+    if len(result) >= 1024:
+        fd, temp_path = tempfile.mkstemp(suffix=".w2p_sched")
+        with os.fdopen(fd, "w") as f:
+            f.write(result)
+        result = RESULTINFILE + temp_path
+    return result
+
+
+def executor(retq, task, outq, buffer_size=0):
+    """The function used to execute tasks in the background process."""
+    logger.debug("    task started")
+    stdout = LogOutput(outq, buffer_size)
     try:
-        if task.app:
-            from gluon import current
-            from gluon.shell import env, parse_path_info
-
-            ## FIXME: why temporarily change the log level of the root logger?
-            # level = logging.getLogger().getEffectiveLevel()
-            # logging.getLogger().setLevel(logging.WARN)
-            # support for task.app like 'app/controller'
-            (a, c, f) = parse_path_info(task.app)
-            _env = env(
-                a=a, c=c, import_models=True, extra_request={"is_scheduler": True}
-            )
-            # logging.getLogger().setLevel(level)
-            f = task.function
-            if hasattr(current, "_scheduler") and hasattr(current._scheduler, "tasks"):
-                functions = current._scheduler.tasks
-            else:
-                functions = None
-            if functions:
-                _function = functions.get(f)
-            else:
-                # look into env
-                _function = _env.get(f)
-            if not isinstance(_function, CALLABLETYPES):
-                raise NameError("name '%s' not found in scheduler's environment" % f)
-            # Inject W2P_TASK into environment
-            _env.update({"W2P_TASK": W2P_TASK})
-            # Inject W2P_TASK into current
-            current.W2P_TASK = W2P_TASK
-            globals().update(_env)
-            args = loads(task.args)
-            vars = loads(task.vars)
-            result = dumps(_function(*args, **vars))
-        else:
+        if not task.app:
             raise ValueError(
                 "task.application_name is required; cannot execute task '%s' "
                 "without an app context" % task.function
             )
-        if len(result) >= 1024:
-            fd, temp_path = tempfile.mkstemp(suffix=".w2p_sched")
-            with os.fdopen(fd, "w") as f:
-                f.write(result)
-            result = RESULTINFILE + temp_path
+        result = run_task(task, task_environment(task.app))
         retq.put(TaskReport("COMPLETED", result=result))
     except:
         tb = traceback.format_exc()
@@ -545,6 +770,70 @@ def executor(retq, task, outq):
         stdout.close()
 
 
+def memory_usage():
+    """Returns the peak resident memory of the process in MB (0 if unknown)"""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, but bytes on macOS
+    return usage / (1048576.0 if sys.platform == "darwin" else 1024.0)
+
+
+def warm_executor(taskq, outq, max_tasks=0, max_memory_growth=None, buffer_size=0):
+    """
+    The function used to execute many tasks of the same app in a long-lived
+    background process: models run once, and the task reports are sent
+    through outq after the output. The last report before exiting, because
+    of max_tasks or max_memory_growth (MB), has `last` set.
+    """
+    logger.debug("    executor process started")
+    stdout = LogOutput(outq, buffer_size)
+    _env = None
+    count = 0
+    try:
+        while True:
+            task = taskq.get()
+            if task is None:
+                break
+            count += 1
+            try:
+                if not task.app:
+                    raise ValueError(
+                        "task.application_name is required; cannot execute task "
+                        "'%s' without an app context" % task.function
+                    )
+                if _env is None:
+                    _env = task_environment(task.app)
+                    baseline = memory_usage()
+                tr = TaskReport(COMPLETED, result=run_task(task, _env))
+            except SystemExit:
+                # sys.exit() or terminated
+                tr = TaskReport(FAILED, tb=traceback.format_exc())
+                tr.last = True
+            except:
+                tr = TaskReport(FAILED, tb=traceback.format_exc())
+            # a task must not see what the previous one did not commit
+            for value in list((_env or {}).values()):
+                if isinstance(value, DAL):
+                    try_rollback(value)
+            tr.last = bool(
+                tr.last
+                or max_tasks
+                and count >= max_tasks
+                or max_memory_growth
+                and _env is not None
+                and memory_usage() - baseline > max_memory_growth
+            )
+            stdout.flush()
+            outq.put(tr)
+            if tr.last:
+                break
+    finally:
+        stdout.close()
+
+
 class IS_CRONLINE(object):
     """
     Validates cronline
@@ -596,6 +885,25 @@ RUN_STATUS = (RUNNING, COMPLETED, FAILED, TIMEOUT, STOPPED)
 WORKER_STATUS = (ACTIVE, PICK, DISABLED, TERMINATE, KILL, STOP_TASK)
 
 
+class TaskSlot(object):
+    """A place where a worker runs a task, when it runs many at once"""
+
+    def __init__(self, number):
+        self.number = number
+        self.task = None
+        self.thread = None
+        self.process = None  # the background process
+        self.process_queues = (None, None)
+        self.executors = {}  # warm executor processes by app
+
+    def stats(self):
+        if self.task is None:
+            return dict(status=ACTIVE)
+        return dict(
+            status=RUNNING, task_id=self.task.task_id, function=self.task.function
+        )
+
+
 class Scheduler(threading.Thread):
     """Scheduler object
 
@@ -622,6 +930,35 @@ class Scheduler(threading.Thread):
             timezone. Remember to pass `start_time` and `stop_time` to tasks
             accordingly
         use_spawn(bool): use spawn for subprocess (only useable with python3)
+        max_tasks_per_child(int): how many tasks an executor process runs
+            before being replaced. With the default 1 every task gets a new
+            process running the models; otherwise processes are kept warm,
+            with the models run once and the db rolled back after each task
+            (0 for no limit)
+        max_memory_growth(int): MB of memory growth after which a warm
+            executor process is replaced
+        max_concurrency(int): how many tasks the worker runs at the same
+            time, each in its own process with its own timeout and output
+            (processes are started with spawn)
+        wakeup(bool): notify workers through local sockets when tasks are
+            queued or assigned, so that they start without waiting for the
+            next heartbeat. Idle tickers also wake up when the nearest
+            scheduled task is due
+        chunked_output(bool): tasks send their output in batches, and it gets
+            stored appending chunks to scheduler_run_output instead of
+            rewriting the whole scheduler_run.run_output at every sync
+        max_output_size(int): how many chars of output are kept for a run
+        output_truncation(str): what to keep of a longer output: the first
+            chars ("head") or the last ones ("tail")
+        retention(dict): what the ticker keeps of scheduler_run and of the
+            finished tasks, deleting the rest a few batches at a time:
+
+            - max_age: seconds runs (and finished tasks, once they have no
+              runs left) are kept, or a dict status -> seconds
+            - max_runs: how many of the latest runs are kept per task
+            - statuses: the statuses the policy applies to (by default all
+              but RUNNING and QUEUED)
+            - archive: summarize the deleted runs in scheduler_run_archive
     """
 
     def __init__(
@@ -636,11 +973,20 @@ class Scheduler(threading.Thread):
         discard_results=False,
         utc_time=False,
         use_spawn=False,
+        max_tasks_per_child=1,
+        max_memory_growth=None,
+        max_concurrency=1,
+        wakeup=True,
+        chunked_output=False,
+        max_output_size=None,
+        output_truncation="tail",
+        retention=None,
     ):
         threading.Thread.__init__(self)
         self.daemon = True
         self.process = None  # the background process
         self.process_queues = (None, None)
+        self.executors = {}  # warm executor processes by app
         self.have_heartbeat = True  # set to False to kill
         self.empty_runs = 0
 
@@ -662,6 +1008,7 @@ class Scheduler(threading.Thread):
                 status=RUNNING,
                 sleep=heartbeat,
                 total=0,
+                busy=0,
                 errors=0,
                 empty_runs=0,
                 queue=0,
@@ -675,43 +1022,118 @@ class Scheduler(threading.Thread):
         current._scheduler = self
 
         self.define_tables(db, migrate=migrate)
-        self.use_spawn = use_spawn
+        # forking while other threads may hold locks can deadlock the child
+        self.use_spawn = use_spawn or max_concurrency > 1
+        self.max_tasks_per_child = max_tasks_per_child
+        self.max_memory_growth = max_memory_growth
+        self.max_concurrency = max_concurrency
+        self.slots = [TaskSlot(i) for i in range(max_concurrency)]
+        self.slot_freed = threading.Event()
+        self.w_stats.metrics = dict(
+            queue_latency=histogram(),
+            assign_duration=histogram(),
+            assign_queries=histogram("queries"),
+            run_duration={},
+            runs={},
+        )
+        if max_concurrency > 1:
+            self.w_stats.slots = [slot.stats() for slot in self.slots]
+        self.chunked_output = chunked_output
+        self.max_output_size = max_output_size
+        self.output_truncation = output_truncation
+        self.output_buffer = chunked_output and OUTPUT_BUFFER_SIZE or 0
+        self.wakeup = wakeup
+        self.wakeup_socket = None  # bound by the worker loop
+        self.woken_up = False
+        self.next_due = None  # nearest next_run_time, seen by the ticker
+        self.assign_retry = 0
+        self.retention = retention and self.retention_policy(**retention)
+
+    @staticmethod
+    def retention_policy(max_age=None, max_runs=None, statuses=None, archive=False):
+        """Normalizes the retention argument, with max_age as a dict"""
+        statuses = [s for s in statuses or RETENTION_STATUSES if s in TASK_STATUS]
+        if RUNNING in statuses or QUEUED in statuses:
+            raise SyntaxError("Retention can't apply to RUNNING or QUEUED")
+        if max_age is not None and not isinstance(max_age, dict):
+            max_age = dict((status, max_age) for status in statuses)
+        return Storage(
+            max_age=dict(
+                (status, age)
+                for status, age in (max_age or {}).items()
+                if status in statuses
+            ),
+            max_runs=max_runs,
+            statuses=statuses,
+            archive=archive,
+        )
 
-    def execute(self, task):
+    def execute(self, task, slot=None):
         """Start the background process.
 
         Args:
             task : a `Task` object
+            slot : the `TaskSlot` running the task (None if the worker runs
+                one task at a time)
 
         Returns:
             a `TaskReport` object
         """
-        outq = None
-        retq = None
+        slot = slot or self
+        start = time.time()
+        if self.max_tasks_per_child == 1:
+            tr = self.execute_in_new_process(task, slot)
+        else:
+            tr = self.execute_in_warm_process(task, slot)
+        duration = time.time() - start
+        with self.w_stats_lock:
+            # seconds spent on tasks, the ticker figures out the pace with it
+            self.w_stats.busy += duration
+            metrics = self.w_stats.metrics
+            if task.function not in metrics["runs"]:
+                metrics["run_duration"][task.function] = histogram()
+                metrics["runs"][task.function] = {}
+            observe(metrics["run_duration"][task.function], duration)
+            runs = metrics["runs"][task.function]
+            runs[tr.status] = runs.get(tr.status, 0) + 1
+        result = tr.result
+        if result and result.startswith(RESULTINFILE):
+            temp_path = result.replace(RESULTINFILE, "", 1)
+            with open(temp_path) as f:
+                tr.result = f.read()
+            os.unlink(temp_path)
+        return tr
+
+    def task_output(self, task):
+        """Returns the `TaskOutput` collecting the output of task"""
+        return TaskOutput(
+            self.db,
+            task.run_id,
+            self.chunked_output,
+            self.max_output_size,
+            self.output_truncation,
+        )
+
+    def execute_in_new_process(self, task, slot):
         if self.use_spawn:
             ctx = multiprocessing.get_context("spawn")
-            outq = ctx.Queue()
-            retq = ctx.Queue(maxsize=1)
-            self.process = p = ctx.Process(target=executor, args=(retq, task, outq))
         else:
-            outq = multiprocessing.Queue()
-            retq = multiprocessing.Queue(maxsize=1)
-            self.process = p = multiprocessing.Process(
-                target=executor, args=(retq, task, outq)
-            )
+            ctx = multiprocessing
+        outq = ctx.Queue()
+        retq = ctx.Queue(maxsize=1)
+        slot.process = p = ctx.Process(
+            target=executor, args=(retq, task, outq, self.output_buffer)
+        )
 
-        self.process_queues = (retq, outq)
+        slot.process_queues = (retq, outq)
 
         logger.debug("   task starting")
         p.start()
         start = time.time()
 
-        if task.sync_output > 0:
-            run_timeout = task.sync_output
-        else:
-            run_timeout = task.timeout
-        task_output = tout = ""
+        output = self.task_output(task)
         try:
+            last_sync = start
             while p.is_alive() and (
                 not task.timeout or time.time() - start < task.timeout
             ):
@@ -720,54 +1142,33 @@ class Scheduler(threading.Thread):
                 #       see "Joining processes that use queues" section in
                 # https://docs.python.org/2/library/multiprocessing.html#programming-guidelines
                 # https://docs.python.org/3/library/multiprocessing.html#programming-guidelines
-                while True:
-                    try:
-                        tout += outq.get(timeout=2)
-                    except Queue.Empty:
-                        break
-                if tout:
-                    logger.debug(' partial output: "%s"', tout)
-                    if CLEAROUT in tout:
-                        task_output = tout[tout.rfind(CLEAROUT) + len(CLEAROUT) :]
-                    else:
-                        task_output += tout
-                    try:
-                        db = self.db
-                        db(db.scheduler_run.id == task.run_id).update(
-                            run_output=task_output
-                        )
-                        db.commit()
-                        tout = ""
-                        logger.debug(" partial output saved")
-                    except Exception:
-                        logger.exception(" error while saving partial output")
-                        task_output = task_output[: -len(tout)]
-                p.join(timeout=run_timeout)
+                try:
+                    output.write(outq.get(timeout=OUTPUT_POLL))
+                except Queue.Empty:
+                    pass
+                now = time.time()
+                if task.sync_output > 0 and now - last_sync >= task.sync_output:
+                    last_sync = now
+                    output.save()
         except:
             logger.exception("    task stopped by general exception")
-            self.terminate_process()
+            self.terminate_process(slot=slot)
             tr = TaskReport(STOPPED)
         else:
             # Final drain: collect any output written just before the process exited
             # that wasn't picked up in the main loop due to timing.
             while True:
                 try:
-                    tout += outq.get_nowait()
+                    output.write(outq.get_nowait())
                 except Queue.Empty:
                     break
-            if tout:
-                if CLEAROUT in tout:
-                    task_output = tout[tout.rfind(CLEAROUT) + len(CLEAROUT):]
-                else:
-                    task_output += tout
             if p.is_alive():
                 logger.debug("    task timeout")
-                self.terminate_process(flush_ret=False)
+                self.terminate_process(flush_ret=False, slot=slot)
                 try:
                     # we try to get a traceback here
                     tr = retq.get(timeout=2)  # NOTE: risky after terminate
                     tr.status = TIMEOUT
-                    tr.output = task_output
                 except Queue.Empty:
                     tr = TaskReport(TIMEOUT)
             else:
@@ -778,31 +1179,119 @@ class Scheduler(threading.Thread):
                     tr = TaskReport(STOPPED)
                 else:
                     logger.debug("  task completed or failed")
-        result = tr.result
-        if result and result.startswith(RESULTINFILE):
-            temp_path = result.replace(RESULTINFILE, "", 1)
-            with open(temp_path) as f:
-                tr.result = f.read()
-            os.unlink(temp_path)
-        tr.output = task_output
+        if self.chunked_output:
+            output.save()
+        tr.output = output.text
+        return tr
+
+    def get_executor(self, app, slot):
+        """Returns the warm executor process of app, starting it if needed"""
+        executor = slot.executors.get(app)
+        if executor is None or not executor[0].is_alive():
+            if self.use_spawn:
+                ctx = multiprocessing.get_context("spawn")
+            else:
+                ctx = multiprocessing
+            taskq = ctx.Queue()
+            outq = ctx.Queue()
+            p = ctx.Process(
+                target=warm_executor,
+                args=(
+                    taskq,
+                    outq,
+                    self.max_tasks_per_child,
+                    self.max_memory_growth,
+                    self.output_buffer,
+                ),
+            )
+            p.daemon = True
+            p.start()
+            executor = slot.executors[app] = (p, taskq, outq)
+        return executor
+
+    def execute_in_warm_process(self, task, slot):
+        p, taskq, outq = self.get_executor(task.app, slot)
+        slot.process = p
+        slot.process_queues = (outq, outq)
+        logger.debug("   task starting")
+        taskq.put(task)
+        start = time.time()
+
+        output = self.task_output(task)
+        tr = None
+        try:
+            last_sync = start
+            while tr is None and p.is_alive():
+                now = time.time()
+                if task.timeout and now - start >= task.timeout:
+                    break
+                if task.sync_output > 0 and now - last_sync >= task.sync_output:
+                    last_sync = now
+                    output.save()
+                try:
+                    item = outq.get(timeout=OUTPUT_POLL)
+                except Queue.Empty:
+                    continue
+                if isinstance(item, TaskReport):
+                    tr = item
+                else:
+                    output.write(item)
+        except:
+            logger.exception("    task stopped by general exception")
+            self.terminate_process(slot=slot)
+            tr = TaskReport(STOPPED)
+        else:
+            while tr is None:
+                # collect the output written before the timeout or the exit
+                try:
+                    item = outq.get_nowait()
+                except Queue.Empty:
+                    break
+                if isinstance(item, TaskReport):
+                    tr = item
+                else:
+                    output.write(item)
+            if tr is not None:
+                logger.debug("  task completed or failed")
+                if tr.last:
+                    p.join()
+            elif p.is_alive():
+                logger.debug("    task timeout")
+                self.terminate_process(slot=slot)
+                tr = TaskReport(TIMEOUT)
+            else:
+                logger.debug("    task stopped")
+                tr = TaskReport(STOPPED)
+        slot.process = None
+        if self.chunked_output:
+            output.save()
+        tr.output = output.text
         return tr
 
     _terminate_process_lock = threading.RLock()
+    # db uri -> (time, worker_stats) of the tickers seen by notify_queued, shared
+    # by the Scheduler instances that models build at each request
+    wakeup_tickers = {}
 
-    def terminate_process(self, flush_out=True, flush_ret=True):
+    def terminate_process(self, flush_out=True, flush_ret=True, slot=None):
         """Terminate any running tasks (internal use only)"""
-        if self.process is not None:
+        if slot is None and self.max_concurrency > 1:
+            for slot in self.slots:
+                self.terminate_process(flush_out, flush_ret, slot)
+            return
+        slot = slot or self
+        if slot.process is not None:
             # must synchronize since we are called by main and heartbeat thread
             with self._terminate_process_lock:
                 if flush_out:
-                    queue = self.process_queues[1]
+                    queue = slot.process_queues[1]
                     while not queue.empty():  # NOTE: empty() is not reliable
                         try:
                             queue.get_nowait()
                         except Queue.Empty:
                             pass
                 if flush_ret:
-                    queue = self.process_queues[0]
+                    queue = slot.process_queues[0]
                     while not queue.empty():
                         try:
                             queue.get_nowait()
@@ -815,13 +1304,13 @@ class Scheduler(threading.Thread):
                     #       section in
                     # https://docs.python.org/2/library/multiprocessing.html#programming-guidelines
                     # https://docs.python.org/3/library/multiprocessing.html#programming-guidelines
-                    self.process.terminate()
+                    slot.process.terminate()
                     # NOTE: calling join after a terminate is risky,
                     #       as explained in "Avoid terminating processes"
                     #       section this can lead to a deadlock
-                    self.process.join()
+                    slot.process.join()
                 finally:
-                    self.process = None
+                    slot.process = None
 
     def die(self):
         """Forces termination of the worker process along with any running
@@ -829,6 +1318,10 @@ class Scheduler(threading.Thread):
         logger.info("die!")
         self.have_heartbeat = False
         self.terminate_process()
+        for slot in [self] + self.slots:
+            for p, taskq, outq in list(slot.executors.values()):
+                p.terminate()
+            slot.executors.clear()
 
     def give_up(self):
         """Waits for any running task to be executed, then exits the worker
@@ -979,6 +1472,25 @@ class Scheduler(threading.Thread):
             migrate=self.__get_migrate("scheduler_run", migrate),
         )
 
+        db.define_table(
+            "scheduler_run_output",
+            Field("run_id", "reference scheduler_run"),
+            Field("run_output", "text"),
+            migrate=self.__get_migrate("scheduler_run_output", migrate),
+        )
+
+        db.define_table(
+            "scheduler_run_archive",
+            Field("task_id", "integer"),
+            Field("function_name"),
+            Field("status", requires=IS_IN_SET(RUN_STATUS)),
+            Field("runs", "integer", default=0),
+            Field("run_time", "double", default=0, comment="seconds"),
+            Field("first_start", "datetime"),
+            Field("last_stop", "datetime"),
+            migrate=self.__get_migrate("scheduler_run_archive", migrate),
+        )
+
         db.define_table(
             "scheduler_worker",
             Field("worker_name", length=255, unique=True),
@@ -1024,8 +1536,18 @@ class Scheduler(threading.Thread):
           - checks for max_empty_runs
           - sleeps `heartbeat` seconds
 
+        With `max_concurrency` > 1 each task runs in a thread of its own and
+        the worker keeps popping tasks while it has free slots.
         """
         signal.signal(signal.SIGTERM, lambda signum, stack_frame: sys.exit(1))
+        handlers = self.db._adapter.execution_handlers
+        if QueryCounter not in handlers:
+            handlers.append(QueryCounter)
+        if self.wakeup:
+            sock = self.wakeup_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            sock.setblocking(False)
+            self.w_stats.wakeup = [HOSTNAME, sock.getsockname()[1]]
         try:
             self.start_heartbeats()
             while self.have_heartbeat:
@@ -1043,8 +1565,20 @@ class Scheduler(threading.Thread):
                     # I'm a ticker, and 5 loops passed without
                     # reassigning tasks, let's do that
                     self.wrapped_assign_tasks()
+                if self.max_concurrency > 1:
+                    self.slot_freed.clear()
+                    slot = self.free_slot()
+                    if slot is None:
+                        # all slots are busy, wait for a task to complete
+                        self.slot_freed.wait(self.heartbeat)
+                        continue
                 task = self.wrapped_pop_task()
-                if task:
+                if task and self.max_concurrency > 1:
+                    with self.w_stats_lock:
+                        self.w_stats.empty_runs = 0
+                        self.w_stats.total += 1
+                    self.run_in_slot(slot, task)
+                elif task:
                     with self.w_stats_lock:
                         self.w_stats.empty_runs = 0
                         self.w_stats.status = RUNNING
@@ -1062,10 +1596,15 @@ class Scheduler(threading.Thread):
                     # max_empty_runs, otherwise retries can be dropped under
                     # load. Future-scheduled tasks (next_run_time > now) do not
                     # count, so normal idle shutdown is preserved.
-                    has_due_work = self.has_pending_due_tasks()
+                    has_due_work = (
+                        self.has_pending_due_tasks() or self.busy_slots() > 0
+                    )
                     with self.w_stats_lock:
                         if has_due_work:
                             self.w_stats.empty_runs = 0
+                        elif self.woken_up:
+                            # not a full sleep, doesn't count as a run
+                            pass
                         else:
                             self.w_stats.empty_runs += 1
                             if self.max_empty_runs != 0:
@@ -1084,10 +1623,66 @@ class Scheduler(threading.Thread):
                         logger.info("TICKER: greedy loop")
                         self.wrapped_assign_tasks()
                     logger.debug("sleeping...")
-                    self.sleep()
+                    self.wait_for_tasks()
         except (KeyboardInterrupt, SystemExit):
             logger.info("catched")
             self.die()
+        for slot in self.slots:
+            if slot.thread is not None:
+                slot.thread.join()
+        if self.wakeup_socket is not None:
+            self.wakeup_socket.close()
+
+    def free_slot(self):
+        """Returns a slot with no task running in it, if any"""
+        for slot in self.slots:
+            if slot.task is None:
+                return slot
+
+    def busy_slots(self):
+        return len([slot for slot in self.slots if slot.task is not None])
+
+    def update_slots_stats(self):
+        """Reports the state of the slots in w_stats (w_stats_lock must be
+        held)"""
+        self.w_stats.slots = [slot.stats() for slot in self.slots]
+        if self.w_stats.status in (ACTIVE, RUNNING):
+            # a worker with free slots is still available for new tasks
+            self.w_stats.status = RUNNING if self.free_slot() is None else ACTIVE
+
+    def run_in_slot(self, slot, task):
+        """Runs task in a thread of its own, taking slot until it completes"""
+
+        def target():
+            try:
+                self.wrapped_report_task(task, self.execute(task, slot))
+            finally:
+                # each thread got its own database connection
+                self.db._adapter.close()
+                with self.w_stats_lock:
+                    slot.task = None
+                    self.update_slots_stats()
+                self.slot_freed.set()
+
+        with self.w_stats_lock:
+            slot.task = task
+            self.update_slots_stats()
+        slot.thread = threading.Thread(
+            target=target, name="%s:%s" % (self.worker_name, slot.number)
+        )
+        slot.thread.daemon = True
+        slot.thread.start()
+
+    def stop_slot_tasks(self, task_ids):
+        """Terminates the tasks asked to be stopped (by id, see `stop_task`),
+        or the ones of all the slots if no id is given"""
+        running = dict((slot.task.task_id, slot) for slot in self.slots if slot.task)
+        if task_ids:
+            slots = [running[i] for i in task_ids if i in running]
+        else:
+            slots = self.slots
+        for slot in slots:
+            self.terminate_process(slot=slot)
 
     def has_pending_due_tasks(self):
         """Return True if there are enabled tasks already due to run.
@@ -1150,6 +1745,11 @@ class Scheduler(threading.Thread):
             task.update_record(status=RUNNING, last_run_time=now)
             db.commit()
             logger.debug("   work to do %s", task.id)
+            if task.next_run_time:
+                # since the task was due (i.e. queued, if not scheduled)
+                latency = max((now - task.next_run_time).total_seconds(), 0)
+                with self.w_stats_lock:
+                    observe(self.w_stats.metrics["queue_latency"], latency)
         else:
             logger.info("nothing to do")
             return None
@@ -1254,6 +1854,8 @@ class Scheduler(threading.Thread):
                 )
             else:
                 logger.debug(" deleting task report in db because of no result")
+                if self.chunked_output:
+                    db(db.scheduler_run_output.run_id == task.run_id).delete()
                 db(sr.id == task.run_id).delete()
         # if there is a stop_time and the following run would exceed it
         is_expired = task.stop_time and task.next_run_time > task.stop_time or False
@@ -1378,7 +1980,11 @@ class Scheduler(threading.Thread):
                     else:
                         if backed_status == STOP_TASK:
                             logger.info("Asked to kill the current task")
-                            self.terminate_process()
+                            if self.max_concurrency > 1:
+                                stats = row.worker_stats or {}
+                                self.stop_slot_tasks(stats.get("stop_tasks"))
+                            else:
+                                self.terminate_process()
                         logger.debug(
                             "........recording heartbeat (%s)", self.w_stats.status
                         )
@@ -1419,12 +2025,153 @@ class Scheduler(threading.Thread):
                     logger.exception("Error cleaning up")
 
             db.commit()
+            if self.is_a_ticker and self.retention and counter % 5 == 0:
+                try:
+                    self.enforce_retention(db)
+                except:
+                    logger.exception("TICKER: error enforcing retention")
+                    try_rollback(db)
         except:
             logger.exception("Error retrieving status")
             try_rollback(db)
         self.adj_hibernation()
         self.sleep()
 
+    def enforce_retention(self, db=None):
+        """Deletes the runs, and then the finished tasks, that the retention
+        policy doesn't keep, RETENTION_BATCH rows at a time, each batch in a
+        transaction of its own so that no long lock is held on the tables.
+        Stops after RETENTION_BATCHES batches: the ticker carries on at its next
+        cycle. Returns how many rows were deleted
+        """
+        db = db or self.db
+        deleted = batches = 0
+        for expired, delete in (
+            (self.expired_runs, self.delete_runs),
+            (self.expired_tasks, self.delete_tasks),
+        ):
+            while batches < RETENTION_BATCHES:
+                ids = expired(db)
+                if ids:
+                    delete(db, ids)
+                    db.commit()
+                    deleted += len(ids)
+                    batches += 1
+                if len(ids) < RETENTION_BATCH:
+                    break
+        if deleted:
+            logger.info("TICKER: retention deleted %s rows", deleted)
+        return deleted
+
+    def expired_runs(self, db):
+        """Returns up to RETENTION_BATCH ids of runs to delete"""
+        sr = db.scheduler_run
+        policy = self.retention
+        now = self.now()
+        ids = []
+        for status, age in policy.max_age.items():
+            q = sr.status == status
+            q &= sr.stop_time < now - datetime.timedelta(seconds=age)
+            limit = RETENTION_BATCH - len(ids)
+            if limit > 0:
+                rows = db(q).select(sr.id, orderby=sr.id, limitby=(0, limit))
+                ids += [row.id for row in rows]
+        if policy.max_runs is not None:
+            q = sr.status.belongs(policy.statuses)
+            count = sr.id.count()
+            tasks = db(q).select(
+                sr.task_id,
+                groupby=sr.task_id,
+                having=count > policy.max_runs,
+                limitby=(0, RETENTION_BATCH),
+            )
+            seen = set(ids)
+            for task in tasks:
+                limit = RETENTION_BATCH - len(ids)
+                if limit <= 0:
+                    break
+                rows = db(q & (sr.task_id == task.task_id)).select(
+                    sr.id,
+                    orderby=~sr.id,
+                    limitby=(policy.max_runs, policy.max_runs + limit),
+                )
+                ids += [row.id for row in rows if row.id not in seen]
+        return ids
+
+    def delete_runs(self, db, ids):
+        """Deletes the runs in ids (with their output), summarizing them in
+        scheduler_run_archive first if the retention policy says so"""
+        sr = db.scheduler_run
+        if self.retention.archive:
+            st = db.scheduler_task
+            summaries = {}
+            rows = db(sr.id.belongs(ids)).select(
+                sr.task_id,
+                sr.status,
+                sr.start_time,
+                sr.stop_time,
+                st.function_name,
+                left=st.on(st.id == sr.task_id),
+            )
+            for row in rows:
+                run = row.scheduler_run
+                summary = summaries.setdefault(
+                    (run.task_id, run.status),
+                    dict(
+                        task_id=run.task_id,
+                        function_name=row.scheduler_task.function_name,
+                        status=run.status,
+                        runs=0,
+                        run_time=0,
+                        first_start=run.start_time,
+                        last_stop=run.stop_time,
+                    ),
+                )
+                summary["runs"] += 1
+                if run.start_time and run.stop_time:
+                    summary["run_time"] += (
+                        run.stop_time - run.start_time
+                    ).total_seconds()
+                    summary["first_start"] = min(
+                        summary["first_start"] or run.start_time, run.start_time
+                    )
+                    summary["last_stop"] = max(
+                        summary["last_stop"] or run.stop_time, run.stop_time
+                    )
+            db.scheduler_run_archive.bulk_insert(list(summaries.values()))
+        db(db.scheduler_run_output.run_id.belongs(ids)).delete()
+        db(sr.id.belongs(ids)).delete()
+
+    def expired_tasks(self, db):
+        """Returns up to RETENTION_BATCH ids of finished tasks, with no runs
+        left and no parent still waiting for them, to delete"""
+        st = db.scheduler_task
+        sr = db.scheduler_run
+        sd = db.scheduler_task_deps
+        now = self.now()
+        ids = []
+        with_runs = db(sr.id > 0)._select(sr.task_id, distinct=True)
+        # without its dependency rows a parent would become runnable
+        blocking = db(sd.can_visit == False)._select(sd.task_child, distinct=True)
+        for status, age in self.retention.max_age.items():
+            limit = RETENTION_BATCH - len(ids)
+            if limit <= 0:
+                break
+            old = now - datetime.timedelta(seconds=age)
+            q = (st.status == status) & ~st.id.belongs(with_runs)
+            q &= ~st.id.belongs(blocking)
+            q &= (st.last_run_time < old) | (
+                (st.last_run_time == None) & (st.start_time < old)
+            )
+            rows = db(q).select(st.id, orderby=st.id, limitby=(0, limit))
+            ids += [row.id for row in rows]
+        return ids
+
+    def delete_tasks(self, db, ids):
+        sd = db.scheduler_task_deps
+        db(sd.task_child.belongs(ids) | sd.task_parent.belongs(ids)).delete()
+        db(db.scheduler_task.id.belongs(ids)).delete()
+
     def being_a_ticker(self):
         """Elect a TICKER process that assigns tasks to available workers.
 
@@ -1477,8 +2224,13 @@ class Scheduler(threading.Thread):
         db.commit()  # for MySQL only; FIXME: Niphlod, still needed? could avoid when not MySQL?
         for x in range(10):
             try:
+                start, queries = time.time(), QueryCounter.count()
                 self.assign_tasks()
                 db.commit()
+                with self.w_stats_lock:
+                    metrics = self.w_stats.metrics
+                    observe(metrics["assign_duration"], time.time() - start)
+                    observe(metrics["assign_queries"], QueryCounter.count() - queries)
                 logger.debug("Tasks assigned...")
                 break
             except Exception:
@@ -1502,14 +2254,22 @@ class Scheduler(threading.Thread):
         # build workers as dict of groups
         wkgroups = {}
         for w in all_workers:
+            if w.worker_name == self.worker_name:
+                # no need to wait for the heartbeat to know how I'm doing
+                with self.w_stats_lock:
+                    w.worker_stats = dict(self.w_stats)
             if w.worker_stats["status"] == "RUNNING":
                 continue
             group_names = w.group_names
+            # a worker in many groups splits its window among them
+            window = max(self.assign_window(w.worker_stats) // len(group_names), 1)
             for gname in group_names:
+                worker = {"name": w.worker_name, "c": 0, "window": window}
                 if gname not in wkgroups:
-                    wkgroups[gname] = dict(workers=[{"name": w.worker_name, "c": 0}])
+                    wkgroups[gname] = dict(workers=[worker], limit=window)
                 else:
-                    wkgroups[gname]["workers"].append({"name": w.worker_name, "c": 0})
+                    wkgroups[gname]["workers"].append(worker)
+                    wkgroups[gname]["limit"] += window
         # set queued tasks that expired between "runs" (i.e., you turned off
         # the scheduler): then it wasn't expired, but now it is
         db((st.status.belongs((QUEUED, ASSIGNED))) & (st.stop_time < now)).update(
@@ -1541,15 +2301,11 @@ class Scheduler(threading.Thread):
             & (st.id.belongs(no_deps))
         )
 
-        limit = len(all_workers) * (50 / (len(wkgroups) or 1))
-        # if there are a moltitude of tasks, let's figure out a maximum of
-        # tasks per worker. This can be further tuned with some added
-        # intelligence (like esteeming how many tasks will a worker complete
-        # before the ticker reassign them around, but the gain is quite small
-        # 50 is a sweet spot also for fast tasks, with sane heartbeat values
-        # NB: ticker reassign tasks every 5 cycles, so if a worker completes
-        # its 50 tasks in less than heartbeat*5 seconds,
-        # it won't pick new tasks until heartbeat*5 seconds pass.
+        # if there are a moltitude of tasks, each worker gets at most its
+        # window of them (see assign_window), and the group as many as the
+        # windows of its workers.
+        # NB: ticker reassign tasks every 5 cycles (or when new tasks are
+        # queued), so the window is sized to keep the worker busy until then.
 
         # If a worker is currently elaborating a long task, its tasks needs to
         # be reassigned to other workers
@@ -1559,62 +2315,87 @@ class Scheduler(threading.Thread):
         # let's freeze it up
         db.commit()
         tnum = 0
-        for group in wkgroups.keys():
-            tasks = all_available(st.group_name == group).select(
-                limitby=(0, limit), orderby=st.next_run_time
+        limit = 0
+        assigned = set()
+        for gname, ws in wkgroups.items():
+            limit += ws["limit"]
+            tasks = all_available(st.group_name == gname).select(
+                st.id,
+                st.broadcast,
+                limitby=(0, ws["limit"]),
+                orderby=st.next_run_time,
             )
-            # let's break up the queue evenly among workers
+            tnum += len(tasks)
+            # let's break up the queue evenly among workers, filling their
+            # windows in proportion
+            workers = ws["workers"]
+            assignments = dict((worker["name"], []) for worker in workers)
             for task in tasks:
-                tnum += 1
-                gname = task.group_name
-                ws = wkgroups.get(gname)
-                if ws:
-                    if task.broadcast:
-                        for worker in ws["workers"]:
-                            new_task = db.scheduler_task.insert(
-                                application_name=task.application_name,
-                                task_name=task.task_name,
-                                group_name=task.group_name,
-                                status=ASSIGNED,
-                                broadcast=False,
-                                function_name=task.function_name,
-                                args=task.args,
-                                start_time=now,
-                                repeats=1,
-                                retry_failed=task.retry_failed,
-                                sync_output=task.sync_output,
-                                assigned_worker_name=worker["name"],
-                            )
-                        if task.period:
-                            next_run_time = now + datetime.timedelta(
-                                seconds=task.period
-                            )
-                        else:
-                            # must be cronline
-                            cron_recur = CronParser(
-                                task.cronline, now.replace(second=0, microsecond=0)
-                            )
-                            next_run_time = cron_recur.next()
-                        db(st.id == task.id).update(
-                            times_run=task.times_run + 1,
-                            next_run_time=next_run_time,
-                            last_run_time=now,
+                if not task.broadcast:
+                    worker = min(workers, key=lambda w: float(w["c"]) / w["window"])
+                    assignments[worker["name"]].append(task.id)
+                    worker["c"] += 1
+            for worker_name, ids in assignments.items():
+                if ids:
+                    assigned.add(worker_name)
+                for i in range(0, len(ids), ASSIGN_CHUNK):
+                    db(
+                        (st.id.belongs(ids[i : i + ASSIGN_CHUNK]))
+                        & (st.status.belongs((QUEUED, ASSIGNED)))
+                    ).update(status=ASSIGNED, assigned_worker_name=worker_name)
+            broadcasts = [task.id for task in tasks if task.broadcast]
+            if broadcasts:
+                for task in db(st.id.belongs(broadcasts)).select():
+                    for worker in workers:
+                        new_task = db.scheduler_task.insert(
+                            application_name=task.application_name,
+                            task_name=task.task_name,
+                            group_name=task.group_name,
+                            status=ASSIGNED,
+                            broadcast=False,
+                            function_name=task.function_name,
+                            args=task.args,
+                            start_time=now,
+                            repeats=1,
+                            retry_failed=task.retry_failed,
+                            sync_output=task.sync_output,
+                            assigned_worker_name=worker["name"],
+                        )
+                        assigned.add(worker["name"])
+                    if task.period:
+                        next_run_time = now + datetime.timedelta(
+                            seconds=task.period
                         )
-                        db.commit()
                     else:
-                        counter = 0
-                        myw = 0
-                        for i, w in enumerate(ws["workers"]):
-                            if w["c"] < counter:
-                                myw = i
-                            counter = w["c"]
-                        assigned_wn = wkgroups[gname]["workers"][myw]["name"]
-                        d = dict(status=ASSIGNED, assigned_worker_name=assigned_wn)
-                        db(
-                            (st.id == task.id) & (st.status.belongs((QUEUED, ASSIGNED)))
-                        ).update(**d)
-                        wkgroups[gname]["workers"][myw]["c"] += 1
-                db.commit()
+                        # must be cronline
+                        cron_recur = CronParser(
+                            task.cronline, now.replace(second=0, microsecond=0)
+                        )
+                        next_run_time = cron_recur.next()
+                    db(st.id == task.id).update(
+                        times_run=task.times_run + 1,
+                        next_run_time=next_run_time,
+                        last_run_time=now,
+                    )
+            db.commit()
+        if tnum > 0:
+            self.assign_retry = 0
+        assigned.discard(self.worker_name)
+        wakeup_workers(
+            [w.worker_stats for w in all_workers if w.worker_name in assigned],
+            WAKEUP_ASSIGNED,
+        )
+        # tasks scheduled in the future: the ticker will wake up for them
+        next_due = st.next_run_time.min()
+        self.next_due = (
+            db(
+                (st.status.belongs((QUEUED, ASSIGNED)))
+                & (st.next_run_time > now)
+                & (st.enabled == True)
+            )
+            .select(next_due)
+            .first()[next_due]
+        )
         # I didn't report tasks but I'm working nonetheless!!!!
         with self.w_stats_lock:
             if tnum > 0:
@@ -1624,14 +2405,64 @@ class Scheduler(threading.Thread):
             self.w_stats.workers = len(all_workers)
         # I'll be greedy only if tasks assigned are equal to the limit
         # (meaning there could be others ready to be assigned)
-        self.greedy = tnum >= limit
+        self.greedy = limit > 0 and tnum >= limit
         logger.info("TICKER: workers are %s", len(all_workers))
         logger.info("TICKER: tasks are %s", tnum)
 
+    def assign_window(self, stats):
+        """How many tasks can be assigned to a worker, given its worker_stats.
+
+        That's about twice what the worker completes, at the pace measured so
+        far, before the ticker assigns tasks again (every 5 heartbeats); at
+        least a task per slot
+        """
+        slots = len(stats.get("slots") or [None])
+        if not stats.get("total") or not stats.get("busy"):
+            return ASSIGN_WINDOW * slots
+        per_task = float(stats["busy"]) / stats["total"]
+        return max(int(2 * 5 * self.heartbeat * slots / per_task), slots)
+
     def sleep(self):
         """Calculate the number of seconds to sleep."""
         time.sleep(self.w_stats.sleep)
-        # should only sleep until next available task
+
+    def wait_for_tasks(self):
+        """Sleeps until there may be tasks to run.
+
+        That is `w_stats.sleep` seconds at most, less if a wakeup notification
+        comes in or, for the ticker, if a scheduled task gets due. After a
+        task has been queued the ticker retries its assignment a few times,
+        backing off, since the notification may come before the commit
+        """
+        timeout = self.w_stats.sleep
+        is_a_ticker = self.is_a_ticker
+        if is_a_ticker:
+            if self.next_due is not None:
+                due_in = (self.next_due - self.now()).total_seconds()
+                timeout = min(timeout, max(due_in, 0))
+            if self.assign_retry:
+                timeout = min(timeout, self.assign_retry)
+        sock = self.wakeup_socket
+        messages = []
+        if sock is None:
+            time.sleep(timeout)
+        elif select.select([sock], [], [], timeout)[0]:
+            while True:
+                try:
+                    messages.append(sock.recv(64))
+                except socket.error:
+                    break
+        self.woken_up = bool(messages) or timeout < self.w_stats.sleep
+        if not is_a_ticker or not self.woken_up:
+            return
+        if WAKEUP_QUEUED in messages:
+            self.assign_retry = WAKEUP_RETRY
+        elif self.assign_retry:
+            self.assign_retry *= 2
+            if self.assign_retry > self.heartbeat:
+                self.assign_retry = 0
+        self.next_due = None
+        self.wrapped_assign_tasks()
 
     def set_worker_status(
         self,
@@ -1722,13 +2553,135 @@ class Scheduler(threading.Thread):
             ( i.e. some parameters are invalid) both id and uuid will be None,
             and you'll get an "error" dict holding the errors found.
         """
+        immediate = "immediate" in kwargs and kwargs.pop("immediate") or None
+        kwargs = self.task_fields(function, pargs, pvars, kwargs)
+        db = self.db
+        rtn = db.scheduler_task.validate_and_insert(**kwargs)
+        if not rtn.get("errors"):
+            rtn["uuid"] = kwargs["uuid"]
+            self.notify_queued(immediate)
+        else:
+            rtn["uuid"] = None
+        return rtn
+
+    def queue_tasks(self, specs, batch_size=1000, job_name=None):
+        """
+        Queue many tasks at once, with bulk inserts committed every
+        `batch_size` tasks
+
+        Args:
+            specs: an iterable of dicts, each holding the arguments of a
+                `queue_task` call (`function`, `pargs`, `pvars` and any
+                `scheduler_task` column). A spec can also have `depends_on`,
+                the positions in specs of the tasks that must be completed
+                before this one
+            batch_size(int): how many tasks are inserted and committed at once
+            job_name(str): the JobGraph job the dependencies belong to
+
+        Returns:
+            a dict holding the uuids of the queued tasks, in the order of
+            specs (None for the ones not queued), and an "errors" dict
+            holding the errors found by position.
+
+        Note:
+            Every spec is validated, and the uuids are checked against each
+            other and the database, before anything is inserted
+        """
+        db = self.db
+        st = db.scheduler_task
+        specs = [dict(spec) for spec in specs]
+        deps = [set(spec.pop("depends_on", None) or ()) for spec in specs]
+        # dependencies first, no cycles allowed
+        dependents = {}
+        for i, d in enumerate(deps):
+            d.discard(i)  # Ignore self dependencies
+            for j in d:
+                if not 0 <= j < len(specs):
+                    raise SyntaxError("Task %s depends on unknown task %s" % (i, j))
+                dependents.setdefault(j, []).append(i)
+        waiting = [len(d) for d in deps]
+        ready = [i for i, n in enumerate(waiting) if not n]
+        order = []
+        while ready:
+            j = ready.pop()
+            order.append(j)
+            for i in dependents.get(j, ()):
+                waiting[i] -= 1
+                if not waiting[i]:
+                    ready.append(i)
+        if len(order) < len(specs):
+            raise SyntaxError("A cyclic dependency exists amongst the tasks")
+        uuids = [None] * len(specs)
+        errors = {}
+        valid = {}
+        rows = {}
+        enable = []
+        immediate = False
+        for i, spec in enumerate(specs):
+            immediate = spec.pop("immediate", None) or immediate
+            fields = self.task_fields(
+                spec.pop("function"), spec.pop("pargs", []), spec.pop("pvars", {}), spec
+            )
+            # uuids are checked below, all at once instead of a select each
+            uuid = fields.pop("uuid")
+            error, fields = st._validate_fields(fields)
+            fields["uuid"] = uuid
+            if error:
+                errors[i] = error
+            else:
+                valid[i] = fields
+        owners = {}
+        for i in sorted(valid):
+            if owners.setdefault(valid[i]["uuid"], i) != i:
+                errors[i] = {"uuid": "duplicate uuid"}
+        queued = list(owners)
+        for b in range(0, len(queued), ASSIGN_CHUNK):
+            query = st.uuid.belongs(queued[b : b + ASSIGN_CHUNK])
+            for row in db(query).select(st.uuid):
+                errors[owners[row.uuid]] = {"uuid": "uuid already queued"}
+        for i in order:
+            if i in errors:
+                continue
+            elif any(j in errors for j in deps[i]):
+                errors[i] = {"depends_on": "depends on tasks not queued"}
+            else:
+                fields = valid[i]
+                if deps[i] and fields.get("enabled", True):
+                    # enabled only when its dependencies are in place
+                    fields["enabled"] = False
+                    enable.append(i)
+                uuids[i] = fields["uuid"]
+                rows[i] = fields
+        positions = sorted(rows)
+        ids = {}
+        for b in range(0, len(positions), batch_size):
+            batch = positions[b : b + batch_size]
+            ids.update(zip(batch, st.bulk_insert([rows[i] for i in batch])))
+            db.commit()
+        edges = [
+            dict(task_parent=ids[i], task_child=ids[j], job_name=job_name or "job_0")
+            for i in positions
+            for j in deps[i]
+        ]
+        for b in range(0, len(edges), batch_size):
+            db.scheduler_task_deps.bulk_insert(edges[b : b + batch_size])
+            db.commit()
+        enable = [ids[i] for i in enable]
+        for b in range(0, len(enable), ASSIGN_CHUNK):
+            db(st.id.belongs(enable[b : b + ASSIGN_CHUNK])).update(enabled=True)
+            db.commit()
+        if ids:
+            self.notify_queued(immediate)
+        return dict(uuids=uuids, errors=errors)
+
+    def task_fields(self, function, pargs, pvars, kwargs):
+        """Returns the scheduler_task fields of a task to queue"""
         if hasattr(function, "__name__"):
             function = function.__name__
         targs = "args" in kwargs and kwargs.pop("args") or dumps(pargs)
         tvars = "vars" in kwargs and kwargs.pop("vars") or dumps(pvars)
         tuuid = "uuid" in kwargs and kwargs.pop("uuid") or web2py_uuid()
         tname = "task_name" in kwargs and kwargs.pop("task_name") or function
-        immediate = "immediate" in kwargs and kwargs.pop("immediate") or None
         cronline = kwargs.get("cronline")
         kwargs.update(
             function_name=function,
@@ -1746,15 +2699,22 @@ class Scheduler(threading.Thread):
                 pass
         if "start_time" in kwargs and "next_run_time" not in kwargs:
             kwargs.update(next_run_time=kwargs["start_time"])
+        return kwargs
+
+    def notify_queued(self, immediate=False):
+        """Lets the ticker know that tasks have been queued"""
         db = self.db
-        rtn = db.scheduler_task.validate_and_insert(**kwargs)
-        if not rtn.get("errors"):
-            rtn["uuid"] = tuuid
-            if immediate:
-                db((db.scheduler_worker.is_ticker == True)).update(status=PICK)
-        else:
-            rtn["uuid"] = None
-        return rtn
+        sw = db.scheduler_worker
+        if immediate:
+            db((sw.is_ticker == True)).update(status=PICK)
+        if self.wakeup:
+            now = time.time()
+            fetched, tickers = self.wakeup_tickers.get(db._uri, (0, []))
+            if not fetched <= now < fetched + WAKEUP_CACHE:
+                rows = db(sw.is_ticker == True).select(sw.worker_stats)
+                tickers = [row.worker_stats for row in rows]
+                self.wakeup_tickers[db._uri] = (now, tickers)
+            wakeup_workers(tickers, WAKEUP_QUEUED)
 
     def task_status(self, ref, output=False):
         """
@@ -1770,6 +2730,7 @@ class Scheduler(threading.Thread):
                     db.scheduler_task.task_name == 'test1'
 
             output(bool): if `True`, fetch also the scheduler_run record
+                (with the output reassembled, if stored in chunks)
 
         Returns:
             a single Row object, for the last queued task.
@@ -1808,13 +2769,23 @@ class Scheduler(threading.Thread):
                 and loads(row.scheduler_run.run_result)
                 or None
             )
+            if row.scheduler_run.id:
+                # output stored in chunks
+                sro = db.scheduler_run_output
+                chunks = db(sro.run_id == row.scheduler_run.id).select(
+                    sro.run_output, orderby=sro.id
+                )
+                if chunks:
+                    output = "".join(chunk.run_output for chunk in chunks)
+                    row.scheduler_run.run_output = output
         return row
 
     def stop_task(self, ref):
         """Shortcut for task termination.
 
         If the task is RUNNING it will terminate it, meaning that status
-        will be set as FAILED.
+        will be set as FAILED (a worker running many tasks finds which one
+        to terminate in the "stop_tasks" of its worker_stats).
 
         If the task is QUEUED, its stop_time will be set as to "now",
             the enabled flag will be set to False, and the status to STOPPED
@@ -1835,7 +2806,7 @@ class Scheduler(threading.Thread):
         db = self.db
         st = db.scheduler_task
         sw = db.scheduler_worker
-        if isinstance(ref, integer_types):
+        if isinstance(ref, int):
             q = st.id == ref
         elif isinstance(ref, str):
             q = st.uuid == ref
@@ -1848,7 +2819,10 @@ class Scheduler(threading.Thread):
             return rtn
         if task.status == "RUNNING":
             q = sw.worker_name == task.assigned_worker_name
-            rtn = db(q).update(status=STOP_TASK)
+            worker = db(q).select(sw.worker_stats).first()
+            stats = worker and worker.worker_stats or {}
+            stats["stop_tasks"] = (stats.get("stop_tasks") or []) + [task.id]
+            rtn = db(q).update(status=STOP_TASK, worker_stats=stats)
         elif task.status == "QUEUED":
             rtn = db(q).update(stop_time=self.now(), enabled=False, status=STOPPED)
         return rtn
@@ -1876,6 +2850,88 @@ class Scheduler(threading.Thread):
             )
         return all_workers
 
+    def metrics(self, worker_name=None):
+        """Returns the metrics of the registered workers (of worker_name only,
+        if given), summed up: histograms of the time tasks waited to be picked
+        up since due (queue_latency), of the run times per function
+        (run_duration), of the duration and queries of each assignment cycle
+        (assign_duration, assign_queries), and the counts of runs per function
+        and status (runs).
+        Histograms hold the counts per bucket of METRICS_BUCKETS (the last one
+        counting what falls beyond), sum, count and estimates of p50, p95, p99
+        """
+        metrics = dict(
+            queue_latency=histogram(),
+            assign_duration=histogram(),
+            assign_queries=histogram("queries"),
+            run_duration={},
+            runs={},
+        )
+        for name, worker in self.get_workers().items():
+            if worker_name in (None, name) and worker.worker_stats:
+                merge_metrics(metrics, worker.worker_stats.get("metrics") or {})
+        hists = [metrics[key] for key in ("queue_latency", "assign_duration")]
+        hists += [metrics["assign_queries"]] + list(metrics["run_duration"].values())
+        for h in hists:
+            h["bounds"] = list(METRICS_BUCKETS[h["unit"]])
+            for q in (50, 95, 99):
+                h["p%s" % q] = percentile(h, q / 100.0)
+        return metrics
+
+    def prometheus_metrics(self, worker_name=None):
+        """Returns metrics() in the Prometheus text exposition format"""
+        metrics = self.metrics(worker_name)
+        lines = []
+
+        def export(name, help, hists):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s histogram" % name)
+            for labels, h in hists:
+                seen = 0
+                for bound, n in zip(h["bounds"] + ["+Inf"], h["buckets"]):
+                    seen += n
+                    le = 'le="%s"' % bound
+                    lines.append(
+                        "%s_bucket{%s} %s" % (name, ",".join(labels + [le]), seen)
+                    )
+                labels = "{%s}" % ",".join(labels) if labels else ""
+                lines.append("%s_sum%s %s" % (name, labels, h["sum"]))
+                lines.append("%s_count%s %s" % (name, labels, h["count"]))
+
+        prefix = "w2p_scheduler_"
+        export(
+            prefix + "queue_latency_seconds",
+            "Time tasks waited to be picked up since due",
+            [([], metrics["queue_latency"])],
+        )
+        export(
+            prefix + "run_duration_seconds",
+            "Run time of tasks",
+            [
+                (['function="%s"' % function], h)
+                for function, h in sorted(metrics["run_duration"].items())
+            ],
+        )
+        export(
+            prefix + "assign_duration_seconds",
+            "Duration of the assignment cycles",
+            [([], metrics["assign_duration"])],
+        )
+        export(
+            prefix + "assign_queries",
+            "Queries run by the assignment cycles",
+            [([], metrics["assign_queries"])],
+        )
+        name = prefix + "runs_total"
+        lines.append("# HELP %s Runs of tasks by status" % name)
+        lines.append("# TYPE %s counter" % name)
+        for function, runs in sorted(metrics["runs"].items()):
+            for status, n in sorted(runs.items()):
+                lines.append(
+                    '%s{function="%s",status="%s"} %s' % (name, function, status, n)
+                )
+        return "\n".join(lines) + "\n"
+
 
 def main():
     """
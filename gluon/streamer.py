@@ -13,7 +13,7 @@ Facilities to handle file streaming
 import errno
 import os
 import re
-import stat
+import threading
 import time
 
 from gluon.contenttype import contenttype
@@ -25,6 +25,15 @@ regex_stop_range = re.compile(r"(?<=\-)\d+")
 regex_suffix_range = re.compile(r"^bytes=-(\d+)$")
 
 DEFAULT_CHUNK_SIZE = 64 * 1024
+STATIC_CACHE_SIZE = 1000  # files whose metadata is kept by static_info
+STATIC_CACHE_BYTES = 32 * 1024 * 1024  # total size of the bodies kept in RAM
+STATIC_BODY_SIZE = 128 * 1024  # files up to this size are served from RAM
+STATIC_CHECK = 2  # seconds between checks that a cached file did not change
+STATIC_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))  # precompressed variants
+
+static_cache = dict()  # path -> StaticFile, emptied when it grows too large
+static_cache_bytes = 0
+static_cache_lock = threading.Lock()  # guards static_cache and static_cache_bytes
 
 
 def streamer(stream, chunk_size=DEFAULT_CHUNK_SIZE, bytes=None, callback=None):
@@ -48,6 +57,107 @@ def streamer(stream, chunk_size=DEFAULT_CHUNK_SIZE, bytes=None, callback=None):
             callback()
 
 
+def open_static(path, error_message=None):
+    """Opens a static file, raising HTTP 403/404 when it can't be read"""
+    try:
+        return open(path, "rb")
+    except IOError as e:
+        if e.errno == errno.EISDIR:
+            raise HTTP(403, error_message, web2py_error="file is a directory")
+        elif e.errno == errno.EACCES:
+            raise HTTP(403, error_message, web2py_error="inaccessible file")
+        else:
+            raise HTTP(404, error_message, web2py_error="invalid file")
+
+
+def file_stamps(path):
+    """Returns the (mtime, size) of a file and of its compressed variants"""
+    stamps = []
+    for name in [path] + [path + ext for encoding, ext in STATIC_ENCODINGS]:
+        try:
+            st = os.stat(name)
+        except OSError:
+            stamps.append(None)
+        else:
+            stamps.append((st.st_mtime_ns, st.st_size))
+    return tuple(stamps)
+
+
+class StaticFile(object):
+    """
+    What stream_file_or_304_or_206 needs to know about a file: size,
+    Last-Modified, ETag, Content-Type, the compressed variants that are not
+    older than the file and, for small files, the bodies
+    """
+
+    def __init__(self, path, error_message=None):
+        self.path = path
+        self.stamps = file_stamps(path)
+        with open_static(path, error_message) as fp:
+            st = os.fstat(fp.fileno())
+            self.size = st.st_size
+            self.body = fp.read() if self.size <= STATIC_BODY_SIZE else None
+        self.last_modified = unlocalised_http_header_date(time.gmtime(st.st_mtime))
+        self.etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        self.content_type = contenttype(path)
+        self.variants = []  # [(encoding, path, size, body)]
+        for (encoding, ext), stamp in zip(STATIC_ENCODINGS, self.stamps[1:]):
+            if stamp is None or stamp[0] < st.st_mtime_ns:
+                continue
+            body = None
+            if stamp[1] <= STATIC_BODY_SIZE:
+                try:
+                    with open(path + ext, "rb") as fp:
+                        body = fp.read()
+                except IOError:
+                    continue
+            self.variants.append((encoding, path + ext, stamp[1], body))
+        bodies = [self.body] + [variant[3] for variant in self.variants]
+        self.cached = sum(len(body or b"") for body in bodies)
+        self.checked = time.time()
+
+
+def forget_static(path):
+    """Drops the StaticFile of path from static_cache"""
+    global static_cache_bytes
+    with static_cache_lock:
+        info = static_cache.pop(path, None)
+        if info is not None:
+            static_cache_bytes -= info.cached
+
+
+def static_info(path, error_message=None):
+    """
+    Returns the StaticFile of path from static_cache, checking at most every
+    STATIC_CHECK seconds that the file and its variants did not change
+    """
+    global static_cache_bytes
+    info = static_cache.get(path)
+    if info is not None:
+        now = time.time()
+        if now - info.checked < STATIC_CHECK:
+            return info
+        if info.stamps == file_stamps(path):
+            info.checked = now
+            return info
+        forget_static(path)
+    info = StaticFile(path, error_message)
+    with static_cache_lock:
+        # another thread may have read the file meanwhile
+        old = static_cache.pop(path, None)
+        if old is not None:
+            static_cache_bytes -= old.cached
+        if (
+            len(static_cache) >= STATIC_CACHE_SIZE
+            or static_cache_bytes + info.cached > STATIC_CACHE_BYTES
+        ):
+            static_cache.clear()
+            static_cache_bytes = 0
+        static_cache[path] = info
+        static_cache_bytes += info.cached
+    return info
+
+
 def stream_file_or_304_or_206(
     static_file,
     chunk_size=DEFAULT_CHUNK_SIZE,
@@ -59,86 +169,80 @@ def stream_file_or_304_or_206(
     # FIX THIS
     # if error_message is None:
     #     error_message = rewrite.THREAD_LOCAL.routes.error_message % 'invalid request'
-    try:
-        fp = open(static_file, "rb")
-    except IOError as e:
-        if e.errno == errno.EISDIR:
-            raise HTTP(403, error_message, web2py_error="file is a directory")
-        elif e.errno == errno.EACCES:
-            raise HTTP(403, error_message, web2py_error="inaccessible file")
-        else:
-            raise HTTP(404, error_message, web2py_error="invalid file")
-    else:
-        fp.close()
-    stat_file = os.stat(static_file)
-    fsize = stat_file[stat.ST_SIZE]
-    modified = stat_file[stat.ST_MTIME]
-    mtime = unlocalised_http_header_date(time.gmtime(modified))
-    headers.setdefault("Content-Type", contenttype(static_file))
-    headers.setdefault("Last-Modified", mtime)
+    info = static_info(static_file, error_message)
+    env = request.env if request else {}
+    headers.setdefault("Content-Type", info.content_type)
+    headers.setdefault("Last-Modified", info.last_modified)
     headers.setdefault("Pragma", "cache")
     headers.setdefault("Cache-Control", "private")
+    fsize, body, etag = info.size, info.body, info.etag
+    ranged = status == 200 and env.get("http_range")
+    if info.variants and "Content-Encoding" not in headers:
+        headers["Vary"] = "Accept-Encoding"
+        accept = not ranged and env.get("http_accept_encoding")
+        for encoding, path, size, data in accept and info.variants or ():
+            if encoding in accept:
+                static_file, fsize, body = path, size, data
+                etag = '%s-%s"' % (etag[:-1], encoding)
+                headers["Content-Encoding"] = encoding
+                break
 
     # if this is a normal response and not a respnse to an error page
     if status == 200:
-        if request and request.env.http_if_modified_since == mtime:
-            raise HTTP(304, **{"Content-Type": headers["Content-Type"]})
-
-        elif request and request.env.http_range:
-            range_header = request.env.http_range
-            suffix_range = regex_suffix_range.match(range_header)
-            if suffix_range:
-                suffix_length = int(suffix_range.group(1))
-                part = (max(fsize - suffix_length, 0), fsize - 1, fsize)
-            else:
-                start_items = regex_start_range.findall(range_header)
-                if not start_items:
-                    start_items = [0]
-                stop_items = regex_stop_range.findall(range_header)
-                if not stop_items or int(stop_items[0]) > fsize - 1:
-                    stop_items = [fsize - 1]
-                part = (int(start_items[0]), int(stop_items[0]), fsize)
-            if part[0] > part[1]:
-                headers["Content-Range"] = "bytes */%i" % fsize
-                raise HTTP(416, **headers)
-            bytes = part[1] - part[0] + 1
-            try:
-                stream = open(static_file, "rb")
-            except IOError as e:
-                if e.errno in (errno.EISDIR, errno.EACCES):
-                    raise HTTP(403)
-                else:
-                    raise HTTP(404)
-            stream.seek(part[0])
-            headers["Content-Range"] = "bytes %i-%i/%i" % part
-            headers["Content-Length"] = "%i" % bytes
-            status = 206
+        headers.setdefault("ETag", etag)
+        if_none_match = env.get("http_if_none_match")
+        if if_none_match:
+            not_modified = etag in if_none_match or if_none_match.strip() == "*"
+        else:
+            not_modified = env.get("http_if_modified_since") == info.last_modified
+        if not_modified:
+            keys = ("Content-Type", "ETag", "Cache-Control", "Expires", "Vary")
+            raise HTTP(304, **dict((k, headers[k]) for k in keys if k in headers))
+
+    stream = None
+    if body is None:
+        # the cached size can be STATIC_CHECK seconds old, the open file's is not
+        stream = open_static(static_file, error_message)
+        size = os.fstat(stream.fileno()).st_size
+        if size != fsize:
+            forget_static(info.path)
+            fsize = size
+
+    if ranged:
+        range_header = ranged
+        suffix_range = regex_suffix_range.match(range_header)
+        if suffix_range:
+            suffix_length = int(suffix_range.group(1))
+            part = (max(fsize - suffix_length, 0), fsize - 1, fsize)
+        else:
+            start_items = regex_start_range.findall(range_header)
+            if not start_items:
+                start_items = [0]
+            stop_items = regex_stop_range.findall(range_header)
+            if not stop_items or int(stop_items[0]) > fsize - 1:
+                stop_items = [fsize - 1]
+            part = (int(start_items[0]), int(stop_items[0]), fsize)
+        if part[0] > part[1]:
+            if stream is not None:
+                stream.close()
+            headers["Content-Range"] = "bytes */%i" % fsize
+            raise HTTP(416, **headers)
+        bytes = part[1] - part[0] + 1
+        headers["Content-Range"] = "bytes %i-%i/%i" % part
+        headers["Content-Length"] = "%i" % bytes
+        if body is not None:
+            raise HTTP(206, [body[part[0] : part[1] + 1]], **headers)
+        stream.seek(part[0])
+        wrapped = streamer(stream, chunk_size=chunk_size, bytes=bytes)
+        raise HTTP(206, wrapped, **headers)
     # in all the other cases (not 304, not 206, but 200 or error page)
-    if status != 206:
-        enc = request.env.http_accept_encoding
-        if enc and "gzip" in enc and not "Content-Encoding" in headers:
-            gzipped = static_file + ".gz"
-            if os.path.isfile(gzipped) and os.path.getmtime(gzipped) >= modified:
-                static_file = gzipped
-                fsize = os.path.getsize(gzipped)
-                headers["Content-Encoding"] = "gzip"
-                headers["Vary"] = "Accept-Encoding"
-        try:
-            stream = open(static_file, "rb")
-        except IOError as e:
-            # this better not happen when returning an error page ;-)
-            if e.errno in (errno.EISDIR, errno.EACCES):
-                raise HTTP(403)
-            else:
-                raise HTTP(404)
-        headers["Content-Length"] = str(fsize)
-        bytes = None
-    # only hand a bare file object to the wsgi file wrapper for full-content
-    # responses (bytes is None). On a 206 the wrapper streams the seeked file to
-    # EOF, ignoring the range length, so the body would exceed the advertised
-    # Content-Length; fall back to the bounded streamer in that case.
-    if request and request.env.web2py_use_wsgi_file_wrapper and bytes is None:
-        wrapped = request.env.wsgi_file_wrapper(stream, chunk_size)
+    headers["Content-Length"] = str(fsize)
+    if body is not None:
+        raise HTTP(status, [body], **headers)
+    # large files go through the server's wsgi.file_wrapper when enabled, which
+    # lets servers that support it send them with os.sendfile
+    if env.get("web2py_use_wsgi_file_wrapper"):
+        wrapped = env.get("wsgi_file_wrapper")(stream, chunk_size)
     else:
-        wrapped = streamer(stream, chunk_size=chunk_size, bytes=bytes)
+        wrapped = streamer(stream, chunk_size=chunk_size)
     raise HTTP(status, wrapped, **headers)
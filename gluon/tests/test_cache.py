@@ -5,10 +5,19 @@
     Unit tests for gluon.cache
 """
 import os
+import threading
+import time
 import unittest
 
 from gluon import recfile
-from gluon.cache import Cache, CacheInRam, CacheOnDisk
+from gluon.cache import (
+    Cache,
+    CacheInRam,
+    CacheOnDisk,
+    CacheOnSQLite,
+    FileKeyLocks,
+    regex_prefix,
+)
 from gluon.dal import DAL, Field
 from gluon.storage import Storage
 
@@ -97,6 +106,51 @@ class TestCache(unittest.TestCase):
         cache.increment("b")
         self.assertEqual(cache("b", lambda: "x", 100), 1)
 
+    def test_CacheOnSQLite(self):
+        with TemporaryDirectory() as tmpdirname:
+            s = Storage({"application": "admin", "folder": tmpdirname})
+            cache = CacheOnSQLite(s)
+            self.assertEqual(cache("a", lambda: 1, 0), 1)
+            self.assertEqual(cache("a", lambda: 2, 100), 1)
+            cache.clear("b")
+            self.assertEqual(cache("a", lambda: 2, 100), 1)
+            cache.clear("a")
+            self.assertEqual(cache("a", lambda: 2, 100), 2)
+            cache.clear()
+            self.assertEqual(cache("a", lambda: 3, 100), 3)
+            self.assertEqual(cache("a", lambda: 4, 0), 4)
+            # test key deletion
+            cache("a", None)
+            self.assertEqual(cache("a", lambda: 5, 100), 5)
+            # test increment
+            self.assertEqual(cache.increment("a"), 6)
+            self.assertEqual(cache("a", lambda: 1, 100), 6)
+            cache.increment("b")
+            self.assertEqual(cache("b", lambda: "x", 100), 1)
+            # test regex clear
+            for key in ("user:1", "user:2", "users", "item:1"):
+                cache(key, lambda: key, 100)
+            cache.clear(r"user:\d")
+            self.assertEqual(
+                sorted(cache.storage.keys()),
+                ["a", "b", "item:1", "users", "web2py_cache_statistics"],
+            )
+            # test stats
+            self.assertEqual(cache.stats["hit_total"], 14)
+            self.assertEqual(cache.stats["misses"], 9)
+            # test purge of expired values
+            cache.storage.set("old", (0, 1), expire_at=1)
+            cache.storage.purge()
+            self.assertNotIn("old", cache.storage)
+            self.assertIn("users", cache.storage)
+
+    def test_regex_prefix(self):
+        self.assertEqual(regex_prefix("abc"), "abc")
+        self.assertEqual(regex_prefix("^ab.*"), "ab")
+        self.assertEqual(regex_prefix("abc?"), "ab")
+        self.assertEqual(regex_prefix("ab|cd"), "")
+        self.assertEqual(regex_prefix("(?i)ab"), "")
+
     def test_corrupt_CacheOnDsk(self):
         with TemporaryDirectory() as tmpdirname:
             s = Storage({"application": "admin", "folder": tmpdirname})
@@ -114,6 +168,181 @@ class TestCache(unittest.TestCase):
 
             self.assertEqual(cache("a", lambda: 2, 0), 2)
 
+    def test_single_flight(self):
+        cache = CacheInRam()
+        cache.clear()
+        calls = []
+
+        def f():
+            calls.append(1)
+            time.sleep(0.1)
+            return len(calls)
+
+        threads = [
+            threading.Thread(target=cache, args=("sf", f, 100)) for i in range(5)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache("sf", lambda: 0, 100), 1)
+
+    def test_file_key_locks(self):
+        with TemporaryDirectory() as tmpdirname:
+            folder = os.path.join(tmpdirname, ".locks")
+            # two FileKeyLocks on one folder act as two processes
+            first, second = FileKeyLocks(folder), FileKeyLocks(folder)
+            handle = first.acquire("a")
+            self.assertIsNone(second.acquire("a", blocking=False))
+            other = second.acquire("b", blocking=False)
+            self.assertIsNotNone(other)
+            second.release(other)
+            # a waiter on a lock file removed meanwhile locks the new one
+            handles = []
+            t = threading.Thread(target=lambda: handles.append(second.acquire("a")))
+            t.start()
+            time.sleep(0.2)
+            first.release(handle)
+            t.join(5)
+            self.assertEqual(len(handles), 1)
+            self.assertIsNone(first.acquire("a", blocking=False))
+            second.release(handles[0])
+            self.assertEqual(os.listdir(folder), [])
+            # nested calls on different keys never wait for each other
+            s = Storage({"application": "admin", "folder": tmpdirname})
+            for cache in (CacheOnDisk(s), CacheOnSQLite(s)):
+                results = []
+                t = threading.Thread(
+                    target=lambda: results.append(
+                        cache("outer", lambda: cache("inner", lambda: 1, 10), 10)
+                    )
+                )
+                t.daemon = True
+                t.start()
+                t.join(5)
+                self.assertEqual(results, [1])
+
+    def test_stale_ttl(self):
+        with TemporaryDirectory() as tmpdirname:
+            s = Storage({"application": "admin", "folder": tmpdirname})
+            for cache in (CacheInRam(), CacheOnDisk(s)):
+                cache.clear()
+                self.assertEqual(cache("st", lambda: 1, 100), 1)
+                cache.storage["st"] = (time.time() - 110, 1)
+                started, done = threading.Event(), threading.Event()
+
+                def refresh():
+                    started.set()
+                    done.wait(5)
+                    return 2
+
+                t = threading.Thread(
+                    target=lambda: cache("st", refresh, 100, stale_ttl=60)
+                )
+                t.start()
+                started.wait(5)
+                # while refreshing, the stale value is returned
+                self.assertEqual(cache("st", lambda: 3, 100, stale_ttl=60), 1)
+                done.set()
+                t.join()
+                self.assertEqual(cache("st", lambda: 3, 100, stale_ttl=60), 2)
+                # too old to be served stale
+                cache.storage["st"] = (time.time() - 200, 2)
+                self.assertEqual(cache("st", lambda: 4, 100, stale_ttl=60), 4)
+
+    def test_CacheInRam_bounded(self):
+        cache = CacheInRam(Storage(application="_bounded"))
+        cache.shards = 1
+        cache.max_entries = 3
+        for key in "abc":
+            cache(key, lambda: key, 100)
+        # "a" becomes the most recently used
+        self.assertEqual(cache("a", lambda: "x", 100), "a")
+        cache("d", lambda: "d", 100)
+        self.assertEqual(list(cache.storage), ["c", "a", "d"])
+        self.assertEqual(cache.stats["_bounded"]["evictions"], 1)
+        # expired entries are removed first
+        cache("e", lambda: "e", 0)
+        cache.max_entries = None
+        cache.max_bytes = 4000
+        cache("big", lambda: "x" * 1000, 100)
+        cache("small", lambda: 1, 100)
+        self.assertNotIn("e", cache.storage)
+        self.assertLessEqual(cache.storage.bytes, 4000)
+        cache("huge", lambda: "x" * 5000, 100)
+        self.assertEqual(len(cache.storage), 0)
+        self.assertEqual(cache.storage.bytes, 0)
+        cache.clear()
+
+    def test_CacheInRam_bounded_shards(self):
+        cache = CacheInRam(Storage(application="_bounded_shards"))
+        cache.clear()
+        cache.max_entries = 3
+        for i in range(50):
+            cache("k%s" % i, lambda: i, 100)
+            self.assertLessEqual(len(cache.storage), 3)
+        self.assertEqual(cache.stats["_bounded_shards"]["evictions"], 47)
+        cache.max_entries = None
+        cache.max_bytes = 2000
+        for i in range(50):
+            cache("b%s" % i, lambda: "x" * 300, 100)
+            self.assertLessEqual(cache.storage.bytes, 2000)
+        self.assertGreater(len(cache.storage), 1)
+        # the least recently used entries go first, whatever their shard
+        cache.clear()
+        cache.max_bytes = None
+        for i in range(20):
+            cache("k%s" % i, lambda: i, 100)
+        for i in range(10):
+            cache("k%s" % i, lambda: i, 100)
+        cache.max_entries = 10
+        cache("new", lambda: 0, 100)
+        kept = ["k%s" % i for i in range(1, 10)] + ["new"]
+        self.assertEqual(sorted(cache.storage.keys()), sorted(kept))
+        cache.clear()
+
+    def test_CacheInRam_rows(self):
+        cache = CacheInRam(Storage(application="_rows"))
+        cache.clear()
+        cache.max_bytes = 100000
+        db = DAL("sqlite:memory")
+        db.define_table("t_a", Field("f_a"), Field("f_b", "integer"))
+        for i in range(10):
+            db.t_a.insert(f_a="x" * 20, f_b=i)
+        rows = db(db.t_a).select(cache=(cache, 60), cacheable=True)
+        # the size of the rows does not include the DAL they refer to
+        self.assertLess(cache.storage.bytes, 10000)
+        self.assertEqual(len(cache.storage), 1)
+        again = db(db.t_a).select(cache=(cache, 60), cacheable=True)
+        self.assertEqual(again.as_csv(), rows.as_csv())
+        cache.clear()
+        db.close()
+
+    def test_CacheInRam_shards(self):
+        cache = CacheInRam(Storage(application="_shards"))
+        cache.clear()
+        self.assertEqual(len(cache.storage.shards), CacheInRam.shards)
+
+        def incr():
+            for i in range(200):
+                cache.increment("counter")
+
+        threads = [threading.Thread(target=incr) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(cache("counter", lambda: 0, 100), 1000)
+        for i in range(100):
+            cache("k%s" % i, lambda: i, 100)
+        self.assertEqual(len(cache.storage), 101)
+        self.assertEqual(cache.stats["_shards"]["misses"], 100)
+        self.assertEqual(cache.stats["_shards"]["hit_total"], 101)
+        cache.clear("k1")
+        self.assertEqual(len(cache.storage), 90)
+        self.assertIn("counter", cache.storage)
+
     # TODO: def test_CacheAction(self):
 
     # TODO: def test_Cache(self):
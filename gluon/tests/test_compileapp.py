@@ -19,9 +19,17 @@ from gluon.admin import (
     plugin_install,
     safe_deposit_path,
 )
-from gluon.compileapp import TEST_CODE, compile_application, remove_compiled_application
+from gluon.compileapp import (
+    TEST_CODE,
+    compile_application,
+    compile_models,
+    forget_models_manifest,
+    get_models_manifest,
+    get_view_code,
+    remove_compiled_application,
+)
 from gluon.fileutils import create_app, w2p_pack, w2p_unpack
-from gluon.globals import Request
+from gluon.globals import Request, Response
 from gluon.main import global_settings
 
 test_app_name = "_test_compileapp"
@@ -100,6 +108,90 @@ class TestAdminPaths(unittest.TestCase):
         self.assertFalse(os.path.exists(deposit_path))
 
 
+class TestViewCache(unittest.TestCase):
+    """Tests the cache of parsed and compiled views"""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.write("layout.html", "<html>{{include}}</html>")
+        self.write("index.html", "{{extend 'layout.html'}}<p>{{=1}}</p>")
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, name, text, mtime=None):
+        filename = os.path.join(self.path, name)
+        with open(filename, "w") as f:
+            f.write(text)
+        if mtime:
+            os.utime(filename, (mtime, mtime))
+        return filename
+
+    def get_view_code(self, name):
+        filename = os.path.join(self.path, name)
+        return get_view_code(filename, self.path, {"response": Response()})
+
+    def test_cached_until_dependency_changes(self):
+        ccode, scode = self.get_view_code("index.html")
+        self.assertIn("<html>", scode)
+        self.assertIs(self.get_view_code("index.html")[0], ccode)
+        # touching the extended layout invalidates the view
+        self.write("layout.html", "<body>{{include}}</body>", mtime=1)
+        ccode2, scode2 = self.get_view_code("index.html")
+        self.assertIsNot(ccode2, ccode)
+        self.assertIn("<body>", scode2)
+        self.assertIs(self.get_view_code("index.html")[0], ccode2)
+
+    def test_dynamic_extend_not_cached(self):
+        self.write("dynamic.html", "{{extend response.view_layout or 'layout.html'}}x")
+        ccode, scode = self.get_view_code("dynamic.html")
+        self.assertIn("<html>", scode)
+        self.assertIsNot(self.get_view_code("dynamic.html")[0], ccode)
+
+
+class TestModelsManifest(unittest.TestCase):
+    """Tests the cached list of models"""
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.models = os.path.join(self.folder, "models")
+        os.makedirs(os.path.join(self.models, "default"))
+        for name in ("db.py", "menu.py", os.path.join("default", "a.py")):
+            open(os.path.join(self.models, name), "w").close()
+        for path in (self.models, os.path.join(self.models, "default")):
+            os.utime(path, (1, 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_manifest(self):
+        compiled, models = get_models_manifest(self.folder)
+        self.assertFalse(compiled)
+        self.assertEqual(
+            [name for filename, name in models], ["db.py", "menu.py", "default/a.py"]
+        )
+        self.assertIs(get_models_manifest(self.folder)[1], models)
+        forget_models_manifest(self.folder + os.sep)
+        self.assertIsNot(get_models_manifest(self.folder)[1], models)
+
+    def test_forget_on_compile(self):
+        self.assertFalse(get_models_manifest(self.folder)[0])
+        os.mkdir(os.path.join(self.folder, "compiled"))
+        compile_models(self.folder)
+        compiled, models = get_models_manifest(self.folder)
+        self.assertTrue(compiled)
+        self.assertEqual(len(models), 3)
+        remove_compiled_application(self.folder)
+        self.assertFalse(get_models_manifest(self.folder)[0])
+
+    def test_refresh_on_change(self):
+        models = get_models_manifest(self.folder)[1]
+        open(os.path.join(self.models, "default", "b.py"), "w").close()
+        models2 = get_models_manifest(self.folder)[1]
+        self.assertEqual(len(models2), len(models) + 1)
+        self.assertEqual(models2[-1][1], "default/b.py")
+
+
 class TestPack(unittest.TestCase):
     """Tests the compileapp.py module"""
 
@@ -4,6 +4,7 @@
     Unit tests for cron
 """
 
+import datetime
 import os
 import shutil
 import sys
@@ -11,8 +12,9 @@ import time
 import unittest
 
 from gluon.fileutils import create_app, write_file
-from gluon.newcron import (SimplePool, Token, crondance, reset, stopcron,
-                           subprocess_count)
+from gluon.newcron import (CronSchedule, JobWorker, SimplePool, Token,
+                           crondance, jobs_in_process, next_fire, parsecronline,
+                           read_crontab, reset, stopcron, subprocess_count)
 
 test_app_name = "_test_cron"
 appdir = os.path.join("applications", test_app_name)
@@ -101,3 +103,75 @@ class TestCron(unittest.TestCase):
         stopcron()
         time.sleep(1)
         reset()
+
+    def test_4_in_process(self):
+        base = os.path.join(appdir, "cron")
+        write_file(os.path.join(base, "crontab"), TEST_CRONTAB)
+        write_file(os.path.join(base, "test.py"), TEST_SCRIPT1)
+        if os.path.exists(TARGET):
+            os.unlink(TARGET)
+        jobs_in_process()
+        try:
+            crondance(os.getcwd(), "hard", startup=True, apps=[test_app_name])
+        finally:
+            jobs_in_process(False)
+        for i in range(60):
+            if os.path.exists(TARGET):
+                break
+            time.sleep(1)
+        self.assertTrue(os.path.exists(TARGET))
+
+    def test_5_JobWorker(self):
+        script = "applications/%s/cron/test.py" % test_app_name
+        worker = JobWorker(SimplePool(1))
+        write_file(os.path.join(appdir, "cron", "test.py"), TEST_SCRIPT1)
+        if os.path.exists(TARGET):
+            os.unlink(TARGET)
+        worker.execute(test_app_name, script, False, None)
+        self.assertTrue(os.path.exists(TARGET))
+        process = worker.process
+        # the process is kept for the next jobs...
+        worker.execute(test_app_name, script, False, None)
+        self.assertIs(worker.process, process)
+        # ...unless one takes too long
+        write_file(os.path.join(appdir, "cron", "test.py"), TEST_SCRIPT2)
+        worker.execute(test_app_name, script, False, 2)
+        self.assertIsNone(worker.process)
+        self.assertFalse(process.is_alive())
+
+    def test_6_next_fire(self):
+        now = datetime.datetime(2024, 2, 27, 10, 30, 15)
+
+        def fire(line):
+            return next_fire(parsecronline(line + " root cmd"), now)
+
+        self.assertEqual(fire("* * * * *"), datetime.datetime(2024, 2, 27, 10, 31))
+        self.assertEqual(fire("30 * * * *"), datetime.datetime(2024, 2, 27, 11, 30))
+        self.assertEqual(fire("*/15 9 * * *"), datetime.datetime(2024, 2, 28, 9, 0))
+        self.assertEqual(fire("0 0 29 2 *"), datetime.datetime(2024, 2, 29, 0, 0))
+        self.assertEqual(fire("0 0 30 2 *"), None)
+        # sunday
+        self.assertEqual(fire("5 4 * * sun"), datetime.datetime(2024, 3, 3, 4, 5))
+        self.assertEqual(fire("@yearly"), datetime.datetime(2025, 1, 1, 0, 0))
+        self.assertEqual(fire("@reboot"), None)
+
+    def test_7_CronSchedule(self):
+        crontab = os.path.join(os.getcwd(), appdir, "cron", "crontab")
+        write_file(crontab, "*/10 * * * * root **a.py\n0 * * * * root **b.py\n")
+        now = datetime.datetime(2024, 1, 1, 10, 5)
+        schedule = CronSchedule(os.getcwd(), apps=[test_app_name])
+        self.assertTrue(schedule.refresh(now))
+        self.assertFalse(schedule.refresh(now))
+        self.assertIs(read_crontab(crontab), read_crontab(crontab))
+        self.assertEqual(schedule.next_due(), datetime.datetime(2024, 1, 1, 10, 10))
+        self.assertEqual(schedule.pop_due(now), [])
+        due = schedule.pop_due(datetime.datetime(2024, 1, 1, 11, 0))
+        self.assertEqual([task["cmd"] for app, task in due], ["**a.py", "**b.py"])
+        self.assertEqual(schedule.next_due(), datetime.datetime(2024, 1, 1, 11, 10))
+        # changes reschedule the entries of the crontab
+        write_file(crontab, "30 12 * * * root **c.py\n")
+        self.assertTrue(schedule.refresh(now))
+        self.assertEqual(schedule.next_due(), datetime.datetime(2024, 1, 1, 12, 30))
+        os.unlink(crontab)
+        self.assertTrue(schedule.refresh(now))
+        self.assertIsNone(schedule.next_due())
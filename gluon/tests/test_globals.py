@@ -10,6 +10,7 @@ import re
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 from http.cookies import SimpleCookie
 from io import BytesIO
@@ -21,7 +22,9 @@ from gluon.globals import Request, Response, Session
 from gluon.settings import global_settings
 from gluon.http import HTTP
 from gluon.rewrite import regex_url_in
+from gluon import streamer
 from gluon.streamer import stream_file_or_304_or_206
+from gluon.storage import Storage
 
 
 def setup_clean_session():
@@ -694,6 +697,112 @@ class testResponse(unittest.TestCase):
             if os.path.exists(path):
                 os.remove(path)
 
+    def test_stream_file_cache(self):
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "x.js")
+        with open(path, "wb") as fp:
+            fp.write(b"0123456789")
+        with open(path + ".gz", "wb") as fp:
+            fp.write(b"gzipped")
+
+        def serve(**env):
+            request = Request(env={})
+            request.env.update(env)
+            with self.assertRaises(HTTP) as ctx:
+                stream_file_or_304_or_206(path, request=request, headers={})
+            return ctx.exception
+
+        try:
+            http = serve()
+            etag = http.headers["ETag"]
+            self.assertEqual(http.status, 200)
+            self.assertEqual(http.headers["Content-Type"], "application/javascript")
+            self.assertEqual(http.headers["Vary"], "Accept-Encoding")
+            self.assertEqual(b"".join(http.body), b"0123456789")
+            http = serve(http_accept_encoding="gzip, deflate")
+            self.assertEqual(http.headers["Content-Encoding"], "gzip")
+            self.assertEqual(http.headers["ETag"], etag[:-1] + '-gzip"')
+            self.assertEqual(b"".join(http.body), b"gzipped")
+            self.assertEqual(serve(http_if_none_match=etag).status, 304)
+            self.assertEqual(serve(http_if_none_match='"other"').status, 200)
+            self.assertEqual(serve(http_if_none_match="W/" + etag).status, 304)
+            # hot files are served without touching the disk
+            os.rename(path, path + ".moved")
+            self.assertEqual(serve(http_if_none_match=etag).status, 304)
+            self.assertEqual(b"".join(serve(http_range="bytes=2-4").body), b"234")
+            streamer.STATIC_CHECK = 0
+            self.assertEqual(serve().status, 404)
+            # large files are streamed from the disk
+            os.rename(path + ".moved", path)
+            streamer.STATIC_BODY_SIZE = 4
+            http = serve()
+            self.assertIsNone(streamer.static_cache[path].body)
+            self.assertEqual(b"".join(http.body), b"0123456789")
+            self.assertEqual(b"".join(serve(http_range="bytes=-3").body), b"789")
+            # their size comes from the file sent, not from the cached entry
+            streamer.STATIC_CHECK = 60
+            with open(path, "wb") as fp:
+                fp.write(b"0123456789abc")
+            http = serve()
+            self.assertEqual(http.headers["Content-Length"], "13")
+            self.assertEqual(b"".join(http.body), b"0123456789abc")
+            self.assertNotIn(path, streamer.static_cache)
+            http = serve(http_range="bytes=-3")
+            self.assertEqual(http.headers["Content-Range"], "bytes 10-12/13")
+            self.assertEqual(b"".join(http.body), b"abc")
+            # replaced entries give their bytes back
+            streamer.STATIC_CHECK = 0
+            streamer.STATIC_BODY_SIZE = 128 * 1024
+            for data in (b"small", b"smaller", b"x"):
+                with open(path, "wb") as fp:
+                    fp.write(data)
+                os.utime(path, ns=(len(data), len(data)))
+                self.assertEqual(b"".join(serve().body), data)
+                self.assertEqual(
+                    streamer.static_cache_bytes,
+                    sum(info.cached for info in streamer.static_cache.values()),
+                )
+        finally:
+            streamer.STATIC_CHECK = 2
+            streamer.STATIC_BODY_SIZE = 128 * 1024
+            shutil.rmtree(folder)
+
+    def test_static_cache_threads(self):
+        folder = tempfile.mkdtemp()
+        paths = [os.path.join(folder, "%s.css" % i) for i in range(4)]
+        streamer.STATIC_CHECK = 0
+        streamer.static_cache.clear()
+        streamer.static_cache_bytes = 0
+
+        def work(n):
+            for i in range(200):
+                path = paths[(n + i) % len(paths)]
+                if not i % 10:
+                    with open(path, "wb") as fp:
+                        fp.write(b"x" * (n + i))
+                    os.utime(path, ns=(n * 1000 + i, n * 1000 + i))
+                try:
+                    streamer.static_info(path)
+                except HTTP:
+                    pass
+
+        try:
+            for path in paths:
+                with open(path, "wb") as fp:
+                    fp.write(b"")
+            threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(
+                streamer.static_cache_bytes,
+                sum(info.cached for info in streamer.static_cache.values()),
+            )
+        finally:
+            streamer.STATIC_CHECK = 2
+            shutil.rmtree(folder)
+
     def test_include_meta(self):
         response = Response()
         response.meta["web2py"] = "web2py"
@@ -807,6 +916,276 @@ class testSessionCheckClient(unittest.TestCase):
         self.assertEqual(session2.get("auth"), "victim")
 
 
+class testSessionChanges(unittest.TestCase):
+    """an unchanged loaded session must not be pickled nor saved again."""
+
+    def _connect(self, session_id=None, track_changes=True):
+        from gluon.globals import current
+
+        request = Request(env={})
+        request.application = "a"
+        request.controller = "c"
+        request.function = "f"
+        request.folder = self.folder
+        if session_id:
+            cookie = SimpleCookie()
+            cookie["session_id_a"] = session_id
+            request.cookies = cookie
+        response = Response()
+        session = Session()
+        current.request = request
+        current.response = response
+        current.session = session
+        session.connect(request, response, track_changes=track_changes)
+        return request, response, session
+
+    def _loaded(self, track_changes=True):
+        request, response, session = self._connect()
+        session.auth = Storage(user=Storage(id=1, roles=["a"]))
+        session.counter = 1
+        session.secure()
+        session._try_store_in_cookie_or_file(request, response)
+        return self._connect(response.session_id, track_changes)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmpdir, "applications", "a")
+        os.makedirs(os.path.join(self.folder, "sessions"))
+        global_settings.db_sessions.discard("a")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_unchanged(self):
+        for track_changes in (True, False):
+            _, response, session = self._loaded(track_changes)
+            self.assertFalse(response.session_new)
+            self.assertEqual(session.auth.user.roles, ["a"])
+            session.counter = 1
+            session.secure()
+            self.assertTrue(session._unchanged(response))
+
+    def test_assignments(self):
+        _, response, session = self._loaded()
+        session.counter = 2
+        self.assertFalse(session._unchanged(response))
+        _, response, session = self._loaded()
+        del session.counter
+        self.assertFalse(session._unchanged(response))
+        _, response, session = self._loaded()
+        session.update(flag=True)
+        self.assertFalse(session._unchanged(response))
+
+    def test_in_place_changes(self):
+        _, response, session = self._loaded()
+        session.auth.user.roles.append("b")
+        self.assertFalse(session._unchanged(response))
+        _, response, session = self._loaded()
+        session.auth.user.id = 2
+        self.assertFalse(session._unchanged(response))
+        # values whose builtin hash() collide
+        for old, new in ((-1, -2), (2**61 - 1, 0), (0.0, -0.0)):
+            _, response, session = self._loaded()
+            session.auth.user.id = old
+            session._loaded(response)
+            session.auth.user.id = new
+            self.assertFalse(session._unchanged(response))
+
+    def test_changes_are_saved(self):
+        request, response, session = self._loaded()
+        session.auth.user.roles.append("b")
+        session._try_store_in_cookie_or_file(request, response)
+        _, _, session = self._connect(response.session_id)
+        self.assertEqual(session.auth.user.roles, ["a", "b"])
+
+
+class LocalRedis(object):
+    """in-process stand-in for the subset of StrictRedis used by sessions"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.expirations = {}
+        self.reads = 0
+
+    def hmget(self, key, *fields):
+        with self.lock:
+            self.reads += 1
+            values = self.hashes.get(key, {})
+            return [values.get(field) for field in fields]
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.hashes.pop(key, None)
+
+    def expire(self, key, seconds):
+        with self.lock:
+            self.expirations[key] = seconds
+
+    def register_script(self, script):
+        def save(keys, args):
+            # Session.REDIS_SAVE_SCRIPT
+            (key,), (version, new_version, data, expiry) = keys, args
+            with self.lock:
+                values = self.hashes.get(key, {})
+                if values.get("version", b"") != str(version).encode():
+                    return 0
+                values.update(version=str(new_version).encode(), data=data)
+                self.hashes[key] = values
+                if expiry > 0:
+                    self.expirations[key] = expiry
+                return 1
+
+        return save
+
+
+class testRedisSession(unittest.TestCase):
+    def setUp(self):
+        self.redis = LocalRedis()
+
+    def _connect(self, session_id=None, flash=False, session_expiry=None):
+        from gluon.globals import current
+
+        request = Request(env={})
+        request.application = "a"
+        request.controller = "c"
+        request.function = "f"
+        request.folder = "applications/a"
+        cookie = SimpleCookie()
+        if session_id:
+            cookie["session_id_a"] = session_id
+        if flash:
+            cookie["session_flash_a"] = "1"
+        request.cookies = cookie
+        response = Response()
+        session = Session()
+        current.request = request
+        current.response = response
+        current.session = session
+        session.connect(
+            request, response, redis_conn=self.redis, session_expiry=session_expiry
+        )
+        return request, response, session
+
+    def _save(self, request, response, session):
+        return session._try_store_in_cookie_or_file(request, response)
+
+    def _new(self, **data):
+        request, response, session = self._connect()
+        session.update(data)
+        self.assertTrue(self._save(request, response, session))
+        return response.session_id
+
+    def test_lazy_loading(self):
+        session_id = self._new(user_id=1)
+        request, response, session = self._connect(session_id)
+        self.assertEqual(self.redis.reads, 0)
+        self.assertFalse(self._save(request, response, session))
+        session._fixup_before_save()
+        self.assertNotIn(response.session_id_name, response.cookies)
+        self.assertEqual(self.redis.reads, 0)
+
+        request, response, session = self._connect(session_id)
+        self.assertEqual(session.user_id, 1)
+        self.assertEqual(self.redis.reads, 1)
+        self.assertFalse(response.session_new)
+        self.assertFalse(self._save(request, response, session))
+
+    def test_forget_lazy(self):
+        session_id = self._new(user_id=1)
+        request, response, session = self._connect(session_id, session_expiry=60)
+        session.forget(response)
+        self.assertFalse(self._save(request, response, session))
+        session._fixup_before_save()
+        self.assertEqual(self.redis.reads, 0)
+        # used after forget, it is fetched but still not saved
+        session.user_id = 2
+        self.assertEqual(self.redis.reads, 1)
+        self.assertFalse(self._save(request, response, session))
+        _, _, session = self._connect(session_id)
+        self.assertEqual(session.user_id, 1)
+
+    def test_changes_saved(self):
+        session_id = self._new(user_id=1, cart=[])
+        request, response, session = self._connect(session_id)
+        session.cart.append(1)
+        self.assertTrue(self._save(request, response, session))
+        _, _, session = self._connect(session_id)
+        self.assertEqual(session.cart, [1])
+        self.assertEqual(session.user_id, 1)
+
+    def test_concurrent_changes_merged(self):
+        session_id = self._new(user_id=1, a=0, b=0, c=0)
+        request1, response1, session1 = self._connect(session_id)
+        request2, response2, session2 = self._connect(session_id)
+        session1.a = 1
+        del session1.c
+        session2.b = 2
+        self.assertTrue(self._save(request1, response1, session1))
+        self.assertTrue(self._save(request2, response2, session2))
+        _, _, session = self._connect(session_id)
+        self.assertEqual(dict(session), dict(user_id=1, a=1, b=2))
+        # a session deleted meanwhile is not brought back by the merge
+        request1, response1, session1 = self._connect(session_id)
+        request2, response2, session2 = self._connect(session_id)
+        session1.a = 2
+        session2.renew()
+        self.assertTrue(self._save(request2, response2, session2))
+        self.assertFalse(self._save(request1, response1, session1))
+        self.assertEqual(
+            list(self.redis.hashes), ["w2p:session:a:" + response2.session_id]
+        )
+
+    def test_unknown_session_id_not_reused(self):
+        request, response, session = self._connect("1.1.1.1-unknown")
+        session.user_id = 1
+        self.assertTrue(response.session_new)
+        self.assertNotEqual(response.session_id, "1.1.1.1-unknown")
+        self.assertTrue(self._save(request, response, session))
+        _, _, session = self._connect(response.session_id)
+        self.assertEqual(session.user_id, 1)
+
+    def test_flash(self):
+        request, response, session = self._connect()
+        session.flash = "done"
+        self._save(request, response, session)
+        self.assertIn("session_flash_a", response.cookies)
+        request, response, session = self._connect(response.session_id, flash=True)
+        self.assertEqual(self.redis.reads, 1)
+        self.assertEqual(response.flash, "done")
+        self.assertTrue(self._save(request, response, session))
+        self.assertIn("expires", str(response.cookies["session_flash_a"]))
+
+    def test_expiry(self):
+        session_id = self._new(user_id=1)
+        key = "w2p:session:a:" + session_id
+        # without session_expiry keys never expire
+        self.assertNotIn(key, self.redis.expirations)
+        request, response, session = self._connect(session_id, session_expiry=60)
+        self.assertEqual(session.user_id, 1)
+        # reading the session restarts the inactivity timeout
+        self.assertEqual(self.redis.expirations[key], 60)
+        del self.redis.expirations[key]
+        session.user_id = 2
+        self.assertTrue(self._save(request, response, session))
+        self.assertEqual(self.redis.expirations[key], 60)
+
+    def test_clear_and_renew(self):
+        session_id = self._new(user_id=1)
+        request, response, session = self._connect(session_id)
+        session.renew()
+        self.assertEqual(session.user_id, 1)
+        self.assertNotEqual(response.session_id, session_id)
+        self.assertTrue(self._save(request, response, session))
+        self.assertEqual(
+            list(self.redis.hashes), ["w2p:session:a:" + response.session_id]
+        )
+        request, response, session = self._connect(response.session_id)
+        session.clear()
+        self.assertEqual(self.redis.hashes, {})
+
+
 class testFileUpload(unittest.TestCase):
     BOUNDARY = b"testboundary"
 
@@ -896,6 +1275,29 @@ class testFileUpload(unittest.TestCase):
         self.assertIn("a.txt", filenames)
         self.assertIn("b.txt", filenames)
 
+    def test_large_file_spooled_to_disk(self):
+        content = b"x" * (64 * 1024 + 1)
+        body = self._build_multipart(files={"upload": ("big.bin", content)})
+        r = self._make_request(body)
+        upload = r.post_vars["upload"]
+        self.assertNotIsInstance(upload.file, BytesIO)
+        self.assertEqual(upload.file.read(), content)
+        upload.file.close()
+
+    def test_multipart_streaming(self):
+        content = b"y" * (64 * 1024 + 1)
+        body = self._build_multipart(
+            fields={"description": "streamed"}, files={"upload": ("big.bin", content)}
+        )
+        r = self._make_request(body)
+        r.multipart_streaming = True
+        self.assertEqual(r.post_vars["description"], "streamed")
+        self.assertEqual(r.post_vars["upload"].file.read(), content)
+        r.post_vars["upload"].file.close()
+        # the body was not copied
+        self.assertEqual(r.body.read(), b"")
+        self.assertEqual(r.env["wsgi.input"].tell(), len(body))
+
     def _make_request_with_content_type(self, body, content_type):
         env = {
             "request_method": "POST",
@@ -443,6 +443,97 @@ class TestBareHelpers(unittest.TestCase):
         # CAT('')
         self.assertEqual(CAT("").xml(), "")
 
+    def test_xml_chunks(self):
+        tree = DIV(
+            TABLE(*[TR(TD(A(i, _href="#%s" % i)), TD("<%s>" % i)) for i in range(99)]),
+            CAT("a", BR(), SPAN(_class="x", data=dict(y="z"))),
+            XML("<b>c</b>"),
+            FORM(INPUT(_name="d")),
+            _id="t",
+        )
+        xml = tree.xml()
+        self.assertEqual("".join(tree.xml_chunks()), xml)
+        stream = list(tree.xml_stream(1024))
+        self.assertTrue(len(stream) > 3)
+        self.assertEqual(b"".join(stream).decode("utf8"), xml)
+        self.assertEqual("".join(XML("<i>").xml_chunks()), "<i>")
+        # helpers nested deeper than the recursion limit
+        tree = SPAN("x")
+        for i in range(5000):
+            tree = DIV(tree)
+        xml = "<div>" * 5000 + "<span>x</span>" + "</div>" * 5000
+        self.assertEqual(tree.xml(), xml)
+        response = Response()
+        response.write(tree)
+        self.assertEqual(response.body.getvalue(), tree.xml())
+        # xml() overridden on an instance
+        inner = SPAN("y")
+        inner.xml = lambda: "<em>z</em>"
+        tree = DIV(DIV(inner))
+        self.assertEqual(tree.xml(), "<div><div><em>z</em></div></div>")
+        self.assertEqual("".join(tree.xml_chunks()), tree.xml())
+        # a helper containing itself is an error, not an endless walk
+        loop = DIV()
+        loop.components.append(loop)
+        self.assertRaises(RuntimeError, loop.xml)
+
+    def test_freeze(self):
+        from gluon.cache import CacheInRam
+        from gluon.html import FrozenXML, cached_fragment
+
+        menu = UL(LI(A("home", _href="/")), LI("<about>"))
+        frozen = menu.freeze()
+        self.assertIsInstance(frozen, FrozenXML)
+        self.assertEqual(frozen.xml(), menu.xml())
+        self.assertEqual(frozen.hash, menu.freeze().hash)
+        self.assertNotEqual(frozen.hash, UL().freeze().hash)
+        # it composes with the other helpers
+        self.assertEqual(DIV(frozen, "<x>").xml(), DIV(menu, "<x>").xml())
+        calls = []
+        state = dict(lang="en")
+
+        @cached_fragment(vary=lambda: state["lang"], cache_model=CacheInRam())
+        def navbar(active):
+            calls.append(active)
+            return DIV(SPAN(active), _class=state["lang"])
+
+        self.assertEqual(navbar("a").xml(), '<div class="en"><span>a</span></div>')
+        self.assertIs(navbar("a"), navbar("a"))
+        self.assertEqual(calls, ["a"])
+        navbar("b")
+        state["lang"] = "it"
+        self.assertEqual(navbar("a").xml(), '<div class="it"><span>a</span></div>')
+        self.assertEqual(calls, ["a", "b", "a"])
+
+    def test_freeze_csp_nonce(self):
+        from gluon.cache import CacheInRam
+        from gluon.html import cached_fragment
+
+        @cached_fragment(cache_model=CacheInRam())
+        def scripts():
+            return DIV(SCRIPT("go()"), STYLE("p {}"))
+
+        current.request = Request(env={})
+        current.response = Response()
+        current.response.enable_csp()
+        first = current.response.nonce
+        frozen = DIV(SCRIPT("go()")).freeze()
+        self.assertEqual(scripts().xml().count('nonce="%s"' % first), 2)
+        self.assertIn('nonce="%s"' % first, frozen.xml())
+        # the next request gets the fragment cached by the first one
+        current.response = Response()
+        current.response.enable_csp()
+        second = current.response.nonce
+        self.assertNotEqual(first, second)
+        for xml in (scripts().xml(), str(scripts()), DIV(frozen).xml()):
+            self.assertNotIn(first, xml)
+            self.assertIn('nonce="%s"' % second, xml)
+        self.assertEqual(frozen.hash, DIV(SCRIPT("go()")).freeze().hash)
+        # and a response without CSP gets no nonce at all
+        current.response = Response()
+        self.assertEqual(scripts().xml(), DIV(SCRIPT("go()"), STYLE("p {}")).xml())
+        self.assertNotIn("nonce", scripts().xml())
+
     def test_csp_nonce_injection(self):
         # setup request/response
         current.request = Request(env={})
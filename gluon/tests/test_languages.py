@@ -197,6 +197,51 @@ class TestTranslations(unittest.TestCase):
         self.assertEqual(str(T("Hello World")), "Salve Mondo")
 
 
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.langpath = tempfile.mkdtemp()
+        self.filename = os.path.join(self.langpath, "it.py")
+        languages.write_dict(self.filename, {"hello": "ciao"})
+
+    def tearDown(self):
+        languages.pending_writes.clear()
+        languages.TranslatorFactory.read_only = False
+        shutil.rmtree(self.langpath)
+
+    def test_buffered_writes(self):
+        T = languages.TranslatorFactory(self.langpath, "it")
+        self.assertEqual(str(T("hello")), "ciao")
+        misses = languages.missing_translations.get(self.filename, 0)
+        self.assertEqual(str(T("world")), "world")
+        self.assertEqual(str(T("world")), "world")
+        self.assertEqual(str(T("moon")), "moon")
+        self.assertEqual(languages.missing_translations[self.filename], misses + 2)
+        self.assertNotIn("world", languages.read_dict_aux(self.filename))
+        languages.flush_writes(0)
+        self.assertEqual(
+            languages.read_dict_aux(self.filename),
+            {"hello": "ciao", "world": "world", "moon": "moon"},
+        )
+        # the file is not rewritten before the delay
+        T("sun").xml()
+        languages.flush_writes(60)
+        self.assertNotIn("sun", languages.read_dict_aux(self.filename))
+        self.assertIn(self.filename, languages.pending_writes)
+
+    def test_read_only(self):
+        languages.TranslatorFactory.read_only = True
+        T = languages.TranslatorFactory(self.langpath, "it")
+        self.assertEqual(str(T("world")), "world")
+        self.assertNotIn(self.filename, languages.pending_writes)
+        # the language file is not checked for changes
+        languages.write_dict(self.filename, {"hello": "salve"})
+        T = languages.TranslatorFactory(self.langpath, "it")
+        self.assertEqual(str(T("hello")), "ciao")
+        languages.TranslatorFactory.read_only = False
+        T = languages.TranslatorFactory(self.langpath, "it")
+        self.assertEqual(str(T("hello")), "salve")
+
+
 class TestDummyApp(unittest.TestCase):
     def setUp(self):
         pjoin = os.path.join
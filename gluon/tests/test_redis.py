@@ -6,6 +6,7 @@
 import pickle
 import unittest
 from datetime import datetime
+from http.cookies import SimpleCookie
 
 from gluon.globals import Request, Response, Session, current
 from gluon.storage import Storage
@@ -129,3 +130,73 @@ class TestRedis(unittest.TestCase):
 
         empty_sessions = db(table.id > 0).select()
         self.assertEqual(empty_sessions, [], "no sessions left")
+
+
+class TestRedisSessionConnect(unittest.TestCase):
+    """Tests sessions stored with session.connect(redis_conn=...)"""
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import redis
+
+            cls.redis = redis.StrictRedis(host="localhost")
+            cls.redis.ping()
+        except Exception:
+            raise unittest.SkipTest("Redis not available")
+
+    def setUp(self):
+        self.keys = set()
+
+    def tearDown(self):
+        if self.keys:
+            self.redis.delete(*self.keys)
+
+    def _connect(self, session_id=None):
+        request = Request(env={})
+        request.application = "a"
+        request.controller = "c"
+        request.function = "f"
+        request.folder = "applications/admin"
+        if session_id:
+            request.cookies = SimpleCookie()
+            request.cookies["session_id_a"] = session_id
+        response = Response()
+        session = Session()
+        current.request = request
+        current.response = response
+        current.session = session
+        session.connect(request, response, redis_conn=self.redis, session_expiry=60)
+        self.keys.add("w2p:session:a:%s" % response.session_id)
+        return request, response, session
+
+    def _save(self, request, response, session):
+        return session._try_store_in_cookie_or_file(request, response)
+
+    def test_concurrent_changes_merged(self):
+        request, response, session = self._connect()
+        session.update(user_id=1, a=0, b=0)
+        self.assertTrue(self._save(request, response, session))
+        session_id = response.session_id
+        request1, response1, session1 = self._connect(session_id)
+        request2, response2, session2 = self._connect(session_id)
+        session1.a = 1
+        session2.b = 2
+        self.assertTrue(self._save(request1, response1, session1))
+        # the compare-and-set script refuses the stale version, then merges
+        self.assertTrue(self._save(request2, response2, session2))
+        self.assertEqual(response2.session_version, 3)
+        _, _, session = self._connect(session_id)
+        self.assertEqual(dict(session), dict(user_id=1, a=1, b=2))
+
+    def test_expiry(self):
+        request, response, session = self._connect()
+        session.user_id = 1
+        self.assertTrue(self._save(request, response, session))
+        key = "w2p:session:a:%s" % response.session_id
+        self.assertTrue(0 < self.redis.ttl(key) <= 60)
+        self.redis.expire(key, 5)
+        _, _, session = self._connect(response.session_id)
+        self.assertEqual(session.user_id, 1)
+        # reading the session restarts the inactivity timeout
+        self.assertGreater(self.redis.ttl(key), 5)
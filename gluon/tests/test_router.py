@@ -1187,6 +1187,40 @@ class TestRouter(unittest.TestCase):
             "/init/static/index",
         )
 
+    def test_router_out_cache(self):
+        """
+        Test the cache of outgoing routing
+        """
+        from gluon import rewrite
+
+        router_out = dict(BASE=dict(), init=dict(controllers=["default", "ctr"]))
+        load(rdict=router_out)
+        self.assertEqual(rewrite.url_out_cache, {})
+        self.assertEqual(
+            filter_url("https://domain.com/init/ctr/fcn/1", out=True), "/ctr/fcn/1"
+        )
+        self.assertEqual(
+            filter_url("https://domain.com/init/ctr/fcn/2", out=True), "/ctr/fcn/2"
+        )
+        # ambiguous args are kept apart
+        self.assertEqual(
+            filter_url("https://domain.com/init/default/index/ctr", out=True),
+            "/index/ctr",
+        )
+        self.assertEqual(
+            filter_url("https://domain.com/init/default/index/x", out=True),
+            "/index/x",
+        )
+        self.assertEqual(len(rewrite.url_out_cache), 3)
+        # reloading the routes empties it
+        router_out["BASE"]["default_application"] = "other"
+        load(rdict=router_out)
+        self.assertEqual(rewrite.url_out_cache, {})
+        self.assertEqual(
+            filter_url("https://domain.com/init/ctr/fcn/1", out=True),
+            "/init/ctr/fcn/1",
+        )
+
     def test_router_functions(self):
         """
         Test function-omission with functions=[something]
@@ -10,6 +10,8 @@ import unittest
 from gluon.html import URL
 from gluon.http import HTTP
 from gluon.rewrite import (
+    CompiledRoutes,
+    compile_regex,
     filter_err,
     filter_url,
     load,
@@ -526,6 +528,80 @@ routes_out = [
             "/init/default/index/a bc",
         )
 
+    def test_routes_compiled(self):
+        """
+        Test that merged rules keep their precedence and own substitutions
+        """
+        rules = CompiledRoutes(
+            compile_regex(*items)
+            for items in (
+                ("/(?P<a>x+)", "/init/default/first/\\g<a>"),
+                ("/$c/$f", "/init/$c/$f"),
+                ("/(\\w)\\1", "/init/default/double"),
+                ("/$anything", "/init/default/any/$anything"),
+            )
+        )
+        self.assertEqual([len(r) for x, r, m in rules.compile()], [2, 1, 1])
+        self.assertEqual(rules.match(":http://localhost:get /xx"), rules[0])
+        self.assertEqual(rules.match(":http://localhost:get /a/b"), rules[1])
+        self.assertEqual(rules.match(":http://localhost:get /aa"), rules[2])
+        self.assertEqual(rules.match(":http://localhost:get /a/b/c"), rules[3])
+        self.assertIsNone(rules.match("nomatch"))
+        # rules with a literal first segment only go with keys in that segment
+        rules = CompiledRoutes(
+            compile_regex(*items)
+            for items in (
+                ("/old/$anything", "/init/default/old/$anything"),
+                ("/$c/page.html", "/init/$c/page"),
+                ("/new/x y", "/init/default/space"),
+                ("/new", "/init/default/new"),
+                ("/new/$anything", "/init/default/new/$anything"),
+                ("/old/?", "/init/default/never"),
+                ("1.2.3.4:/$anything", "/init/default/local/$anything"),
+                ("/(?P<x>new|old)", "/init/default/\\g<x>"),
+                ("/$anything", "/init/default/$anything"),
+            )
+        )
+        self.assertEqual(
+            rules.segments, ["old", None, "new", "new", "new", None, None, None, None]
+        )
+        for path, expected in (
+            ("/old/a", 0),
+            ("/old", 5),
+            ("/new/page.html", 1),
+            ("/new/x y", 2),
+            ("/new", 3),
+            ("/new\n", 3),
+            ("/new/a/b", 4),
+            ("/other", 8),
+            ("/other/page.html", 1),
+        ):
+            key = ":http://localhost:get %s" % path
+            self.assertIs(rules.match(key), rules[expected], key)
+        self.assertIs(rules.match("1.2.3.4:http://localhost:get /other"), rules[6])
+        for address in ("", "1.2.3.4", "a b"):
+            for path in ("/old/a", "/old", "/new/x y", "/new\n", "/x/page.html", ""):
+                key = "%s:http://localhost:get %s" % (address, path)
+                linear = next((rule for rule in rules if rule[0].match(key)), None)
+                self.assertIs(rules.match(key), linear, key)
+        self.assertEqual(sorted(rules.dispatch, key=str), [None, "new", "old"])
+        data = r"""routes_in = [
+    ('/(?P<a>x+)', '/init/default/first/\g<a>'),
+    ('/$c/$f', '/init/$c/$f'),
+    (r'/(\w)\1', '/init/default/double'),
+    ('/$anything', '/init/default/any/$anything'),
+    ]
+"""
+        load(data=data)
+        self.assertEqual(
+            filter_url("http://domain.com/xx"), "/init/default/first ['xx']"
+        )
+        self.assertEqual(filter_url("http://domain.com/ab/cd"), "/init/ab/cd")
+        self.assertEqual(filter_url("http://domain.com/aa"), "/init/default/double")
+        self.assertEqual(
+            filter_url("http://domain.com/a/b/c"), "/init/default/any ['a', 'b', 'c']"
+        )
+
     def test_static_traversal_prefix_sibling(self):
         """A sibling directory whose name shares the 'static' prefix must
         not be reachable from /<app>/static/... — the boundary check must
@@ -582,6 +582,62 @@ class TestsForSchedulerAPIs(BaseTestScheduler):
         isnotqueued(s.queue_task(fname, uuid="a"))
         # # #FIXME add here every parameter
 
+    def testNotifyQueued(self):
+        s = Scheduler(self.db)
+        self.db.scheduler_worker.insert(
+            worker_name="ticker", is_ticker=True, worker_stats={}
+        )
+        Scheduler.wakeup_tickers.clear()
+        timings = self.db._timings
+        del timings[:]
+        for i in range(5):
+            s.queue_task("foo")
+        timings = list(timings)
+        self.db.commit()
+        # as models do, with a new db and Scheduler at each request
+        for i in range(3):
+            db = DAL(self.db._uri, folder=self.db._folder)
+            del db._timings[:]
+            Scheduler(db).queue_task("foo")
+            timings.extend(db._timings)
+            db.commit()
+            db.close()
+        selects = [
+            sql
+            for sql, t in timings
+            if sql.startswith("SELECT") and "scheduler_worker" in sql
+        ]
+        # the tickers addresses are fetched once and reused for a while
+        self.assertEqual(len(selects), 1)
+        Scheduler.wakeup_tickers[self.db._uri] = (0, [])
+        s.queue_task("foo")
+        self.assertGreater(Scheduler.wakeup_tickers[self.db._uri][0], 0)
+
+    def testStop_Task(self):
+        s = Scheduler(self.db, max_concurrency=2)
+        st, sw = self.db.scheduler_task, self.db.scheduler_worker
+        sw.insert(worker_name="w", status="ACTIVE", worker_stats={"slots": []})
+        ids = [
+            st.insert(function_name="foo", status="RUNNING", assigned_worker_name="w")
+            for i in range(3)
+        ]
+        s.stop_task(ids[0])
+        s.stop_task(ids[1])
+        # the tasks stay RUNNING, the worker is told which ones to terminate
+        self.assertEqual(self.db(st.status == "RUNNING").count(), 3)
+        worker = self.db(sw.worker_name == "w").select().first()
+        self.assertEqual(worker.status, "STOP_TASK")
+        self.assertEqual(worker.worker_stats["stop_tasks"], ids[:2])
+        slots = [Storage(task=Storage(task_id=i)) for i in ids] + [Storage(task=None)]
+        s.slots = slots
+        terminated = []
+        s.terminate_process = lambda slot: terminated.append(slot)
+        s.stop_slot_tasks(worker.worker_stats["stop_tasks"] + [99])
+        self.assertEqual(terminated, slots[:2])
+        del terminated[:]
+        s.stop_slot_tasks(None)
+        self.assertEqual(terminated, slots)
+
     def testTask_Status(self):
         s = Scheduler(self.db)
         fname = "foo"
@@ -602,6 +658,222 @@ class TestsForSchedulerAPIs(BaseTestScheduler):
             set(rtn.keys()), set(["scheduler_run", "scheduler_task", "result"])
         )
 
+    def testQueue_Tasks(self):
+        s = Scheduler(self.db)
+        st = self.db.scheduler_task
+        sd = self.db.scheduler_task_deps
+        specs = [dict(function="foo", pargs=[i]) for i in range(2500)]
+        # the last ones need the first ones to complete
+        specs[-1]["depends_on"] = [0, 1]
+        specs[-2]["depends_on"] = [2499]
+        specs[-3].update(enabled=False, depends_on=[0])
+        # an invalid one, and one depending on it
+        specs.append(dict(function="foo", repeats=-1))
+        specs.append(dict(function="foo", depends_on=[2500]))
+        rtn = s.queue_tasks(specs, batch_size=1000, job_name="bulk")
+        self.assertEqual(len(rtn["uuids"]), 2502)
+        self.assertEqual(rtn["uuids"][2500:], [None, None])
+        self.assertEqual(sorted(rtn["errors"]), [2500, 2501])
+        self.assertIn("repeats", rtn["errors"][2500])
+        self.assertEqual(self.db(st).count(), 2500)
+        self.assertEqual(self.db(st.enabled == False).count(), 1)
+        first = self.db(st.uuid == rtn["uuids"][0]).select().first()
+        self.assertEqual(first.args, "[0]")
+        self.assertEqual(self.db(sd.job_name == "bulk").count(), 4)
+        self.assertEqual(len(JobGraph(self.db, "bulk").validate("bulk")), 3)
+        self.assertRaises(
+            SyntaxError,
+            s.queue_tasks,
+            [
+                dict(function="foo", depends_on=[1]),
+                dict(function="foo", depends_on=[0]),
+            ],
+        )
+        # every spec is validated and converted, uuids before any insert
+        specs = [
+            dict(function="foo", uuid="u1", start_time="2030-01-02 03:04:05"),
+            dict(function="foo", uuid="u2", cronline="* * * * *"),
+            dict(function="foo", uuid="u3", cronline="not a cronline"),
+            dict(function="foo", uuid="u1"),
+            dict(function="foo", uuid=rtn["uuids"][0]),
+            dict(function="foo", uuid="u4", depends_on=[3]),
+        ]
+        rtn = s.queue_tasks(specs)
+        self.assertEqual(rtn["uuids"], ["u1", "u2", None, None, None, None])
+        self.assertEqual(sorted(rtn["errors"]), [2, 3, 4, 5])
+        self.assertIn("cronline", rtn["errors"][2])
+        self.assertEqual(rtn["errors"][3], {"uuid": "duplicate uuid"})
+        self.assertEqual(rtn["errors"][4], {"uuid": "uuid already queued"})
+        self.assertIn("depends_on", rtn["errors"][5])
+        u1 = self.db(st.uuid == "u1").select().first()
+        self.assertEqual(u1.start_time, datetime.datetime(2030, 1, 2, 3, 4, 5))
+        self.assertEqual(self.db(st).count(), 2502)
+
+    def testTask_Output(self):
+        from gluon.scheduler import TaskOutput
+
+        s = Scheduler(self.db)
+        sr = self.db.scheduler_run
+        sro = self.db.scheduler_run_output
+        task = s.queue_task("foo")
+        run_id = sr.insert(task_id=task["id"], status="RUNNING")
+        # as a whole
+        output = TaskOutput(self.db, run_id, limit=10)
+        output.write("12345")
+        output.save()
+        self.assertEqual(sr[run_id].run_output, "12345")
+        output.write("67890abc")
+        output.save()
+        self.assertTrue(sr[run_id].run_output.endswith("4567890abc"))
+        self.assertEqual(self.db(sro).count(), 0)
+        # in chunks, keeping the last ones
+        output = TaskOutput(self.db, run_id, chunked=True, limit=10)
+        for data in ("aaaa", "bbbb", "cccc", "dddd"):
+            output.write(data)
+            output.save()
+        self.assertEqual(self.db(sro).count(), 3)
+        status = s.task_status(task["id"], output=True)
+        self.assertEqual(status.scheduler_run.run_output, "bbbbccccdddd")
+        output.write("old!clear!new")
+        output.save()
+        status = s.task_status(task["id"], output=True)
+        self.assertEqual(status.scheduler_run.run_output, "new")
+        # in chunks, keeping the first ones
+        output = TaskOutput(self.db, run_id, chunked=True, limit=6, truncation="head")
+        output.write("!clear!aaaa")
+        output.save()
+        output.write("bbbb")
+        output.save()
+        output.write("cccc")
+        output.save()
+        status = s.task_status(task["id"], output=True)
+        self.assertEqual(
+            status.scheduler_run.run_output, "aaaabb\n[output truncated]\n"
+        )
+
+    def testMetrics(self):
+        from gluon.scheduler import QueryCounter, histogram, observe
+
+        s = Scheduler(self.db)
+        sw = self.db.scheduler_worker
+        for name, latency, duration in (("w1", 0.2, 3), ("w2", 40, 7)):
+            metrics = s.w_stats.metrics = dict(
+                queue_latency=histogram(),
+                assign_duration=histogram(),
+                assign_queries=histogram("queries"),
+                run_duration=dict(foo=histogram()),
+                runs=dict(foo=dict(COMPLETED=1)),
+            )
+            observe(metrics["queue_latency"], latency)
+            observe(metrics["run_duration"]["foo"], duration)
+            sw.insert(worker_name=name, status="ACTIVE", worker_stats=s.w_stats)
+        metrics = s.metrics()
+        self.assertEqual(metrics["queue_latency"]["count"], 2)
+        self.assertEqual(metrics["queue_latency"]["p50"], 0.5)
+        self.assertEqual(metrics["queue_latency"]["p99"], 60)
+        self.assertEqual(metrics["run_duration"]["foo"]["sum"], 10)
+        self.assertEqual(metrics["runs"], dict(foo=dict(COMPLETED=2)))
+        self.assertEqual(s.metrics("w1")["runs"], dict(foo=dict(COMPLETED=1)))
+        text = s.prometheus_metrics()
+        self.assertIn(
+            'w2p_scheduler_run_duration_seconds_count{function="foo"} 2', text
+        )
+        self.assertIn('w2p_scheduler_queue_latency_seconds_bucket{le="+Inf"} 2', text)
+        self.assertIn(
+            'w2p_scheduler_runs_total{function="foo",status="COMPLETED"} 2', text
+        )
+        # queries are counted per thread, once the handler is installed
+        self.db._adapter.execution_handlers.append(QueryCounter)
+        queries = QueryCounter.count()
+        self.db(sw).count()
+        self.assertEqual(QueryCounter.count(), queries + 1)
+
+    def testRetention(self):
+        retention = dict(max_age={"COMPLETED": 3600}, max_runs=2, archive=True)
+        s = Scheduler(self.db, retention=retention)
+        st = self.db.scheduler_task
+        sr = self.db.scheduler_run
+        sra = self.db.scheduler_run_archive
+        now = s.now()
+        old = now - datetime.timedelta(hours=2)
+        done = s.queue_task("foo")["id"]
+        st[done] = dict(status="COMPLETED", last_run_time=old)
+        for i in range(3):
+            sr.insert(task_id=done, status="COMPLETED", start_time=old, stop_time=old)
+        repeating = s.queue_task("foo")["id"]
+        for i in range(5):
+            sr.insert(
+                task_id=repeating, status="FAILED", start_time=old, stop_time=now
+            )
+        sr.insert(task_id=repeating, status="RUNNING", start_time=old)
+        self.db.commit()
+        self.assertEqual(s.enforce_retention(), 3 + 3 + 1)
+        # the old runs went, with their task, and 2 of the recent ones are kept
+        self.assertEqual(self.db(st).count(), 1)
+        self.assertEqual(self.db(sr.status == "FAILED").count(), 2)
+        self.assertEqual(self.db(sr.status == "RUNNING").count(), 1)
+        summary = self.db(sra.status == "FAILED").select().first()
+        self.assertEqual((summary.task_id, summary.runs), (repeating, 3))
+        self.assertEqual(summary.run_time, 3 * 7200)
+        self.assertEqual(self.db(sra.status == "COMPLETED").select().first().runs, 3)
+        self.assertEqual(s.enforce_retention(), 0)
+        # a failed child is kept while its parent waits for it
+        s.retention = s.retention_policy(max_age=3600)
+        parent = s.queue_task("foo")["id"]
+        child = s.queue_task("foo")["id"]
+        self.db.scheduler_task_deps.insert(
+            job_name="job", task_parent=parent, task_child=child
+        )
+        st[child] = dict(status="FAILED", last_run_time=old)
+        self.db.commit()
+        s.enforce_retention()
+        self.assertIsNotNone(st[child])
+        self.assertEqual(self.db(self.db.scheduler_task_deps).count(), 1)
+        self.db.scheduler_worker.insert(
+            worker_name="w", status="ACTIVE", worker_stats=dict(status="ACTIVE")
+        )
+        s.assign_tasks()
+        self.assertEqual(st[parent].status, "QUEUED")
+        # once the parent is purged, its dependencies go too, freeing the child
+        st[parent] = dict(status="COMPLETED", last_run_time=old)
+        self.db.commit()
+        s.enforce_retention()
+        self.assertIsNone(st[parent])
+        self.assertEqual(self.db(self.db.scheduler_task_deps).count(), 0)
+        s.enforce_retention()
+        self.assertIsNone(st[child])
+        retention = dict(statuses=["RUNNING"])
+        self.assertRaises(SyntaxError, Scheduler, self.db, retention=retention)
+
+    def testAssign_Tasks(self):
+        s = Scheduler(self.db)
+        sw = self.db.scheduler_worker
+        st = self.db.scheduler_task
+        workers = dict(
+            fast=dict(status="ACTIVE", total=100, busy=10),
+            slow=dict(status="ACTIVE", total=10, busy=600),
+            new=dict(status="ACTIVE", total=0, busy=0),
+            busy=dict(status="RUNNING", total=10, busy=10),
+        )
+        for name, stats in workers.items():
+            sw.insert(worker_name=name, status="ACTIVE", worker_stats=stats)
+        for i in range(200):
+            s.queue_task("foo")
+        self.db.commit()
+        s.assign_tasks()
+        count = st.id.count()
+        assigned = dict(
+            (row.scheduler_task.assigned_worker_name, row[count])
+            for row in self.db(st.status == "ASSIGNED").select(
+                st.assigned_worker_name, count, groupby=st.assigned_worker_name
+            )
+        )
+        self.assertEqual(sum(assigned.values()), 200)
+        # one task at a time for slow workers, many more for fast ones
+        self.assertEqual(assigned["slow"], 1)
+        self.assertTrue(assigned["fast"] > assigned["new"] > 1)
+        self.assertNotIn("busy", assigned)
+
 
 class testForSchedulerRunnerBase(BaseTestScheduler):
     def inner_teardown(self):
@@ -982,6 +1254,186 @@ def issue_1485():
         ]
         self.exec_asserts(res, "issue_1485")
 
+    def testWarmExecutor(self):
+        s = Scheduler(self.db)
+        pids = [s.queue_task("demo11") for i in range(3)]
+        failed = s.queue_task("demo2")
+        timeout = s.queue_task("demo4", timeout=3)
+        self.db.commit()
+        self.writefunction(
+            r"""
+def demo2():
+    1/0
+
+def demo4():
+    time.sleep(15)
+    return 1
+
+def demo11():
+    print('pid')
+    return os.getpid()
+""",
+            initlines="""
+import os
+import time
+from gluon.scheduler import Scheduler
+db_dal = os.path.abspath(os.path.join(request.folder, 'databases', 'dummy2.db'))
+sched_dal = DAL('sqlite://%s' % db_dal, folder=os.path.dirname(db_dal))
+sched = Scheduler(sched_dal, max_empty_runs=5, migrate=False, heartbeat=1,
+                  max_tasks_per_child=2)
+""",
+        )
+        ret = self.exec_sched()
+        self.assertEqual(ret, 0)
+        tasks = [s.task_status(task.get("id"), output=True) for task in pids]
+        results = [task.result for task in tasks]
+        res = [
+            (
+                "tasks completed",
+                all(task.scheduler_task.status == "COMPLETED" for task in tasks),
+            ),
+            ("output captured", tasks[0].scheduler_run.run_output.strip() == "pid"),
+            ("processes reused", len(set(results)) < 3),
+            ("processes recycled", len(set(results)) > 1),
+        ]
+        self.exec_asserts(res, "WARM")
+        task, task_run = self.fetch_results(s, failed)
+        timeout = s.task_status(timeout.get("id"))
+        res = [
+            ("task failed", task.status == "FAILED"),
+            ("traceback saved", "ZeroDivisionError" in task_run[0].traceback),
+            ("task timeoutted", timeout.status == "TIMEOUT"),
+        ]
+        self.exec_asserts(res, "WARM_FAILURES")
+
+    def testConcurrentSlots(self):
+        s = Scheduler(self.db)
+        sleepers = [s.queue_task("demo3", [i]) for i in range(3)]
+        timeout = s.queue_task("demo4", timeout=3)
+        self.db.commit()
+        self.writefunction(
+            r"""
+def demo3(i):
+    print('slept %s' % i)
+    time.sleep(4)
+    return i
+
+def demo4():
+    time.sleep(15)
+    return 1
+""",
+            initlines="""
+import os
+import time
+from gluon.scheduler import Scheduler
+db_dal = os.path.abspath(os.path.join(request.folder, 'databases', 'dummy2.db'))
+sched_dal = DAL('sqlite://%s' % db_dal, folder=os.path.dirname(db_dal))
+sched = Scheduler(sched_dal, max_empty_runs=5, migrate=False, heartbeat=1,
+                  max_concurrency=3)
+""",
+        )
+        ret = self.exec_sched()
+        self.assertEqual(ret, 0)
+        runs = [self.fetch_results(s, task) for task in sleepers]
+        starts = [task_run[0].start_time for task, task_run in runs]
+        stops = [task_run[0].stop_time for task, task_run in runs]
+        timeout = s.task_status(timeout.get("id"))
+        res = [
+            ("tasks completed", all(task.status == "COMPLETED" for task, _ in runs)),
+            (
+                "output captured",
+                [task_run[0].run_output.strip() for _, task_run in runs]
+                == ["slept %s" % i for i in range(3)],
+            ),
+            ("tasks overlapped", max(starts) < min(stops)),
+            ("task timeoutted", timeout.status == "TIMEOUT"),
+        ]
+        self.exec_asserts(res, "CONCURRENT")
+
+    def testWakeup(self):
+        s = Scheduler(self.db)
+        queuer = s.queue_task("demo5")
+        soon = datetime.datetime.now() + datetime.timedelta(seconds=15)
+        scheduled = s.queue_task("demo1", start_time=soon)
+        self.db.commit()
+        self.writefunction(
+            r"""
+def demo1():
+    return 1
+
+def demo5():
+    sched.queue_task(demo1, task_name='queued_by_task')
+    sched_dal.commit()
+    return 1
+""",
+            initlines="""
+import os
+import time
+from gluon.scheduler import Scheduler
+db_dal = os.path.abspath(os.path.join(request.folder, 'databases', 'dummy2.db'))
+sched_dal = DAL('sqlite://%s' % db_dal, folder=os.path.dirname(db_dal))
+sched = Scheduler(sched_dal, max_empty_runs=5, migrate=False, heartbeat=4)
+""",
+        )
+        ret = self.exec_sched()
+        self.assertEqual(ret, 0)
+        queuer_run = self.fetch_results(s, queuer)[1][0]
+        st = self.db.scheduler_task
+        child = self.db(st.task_name == "queued_by_task").select().first()
+        child_run = self.fetch_results(s, child)[1]
+        scheduled_run = self.fetch_results(s, scheduled)[1]
+        res = [
+            ("queued task run", child.status == "COMPLETED"),
+            (
+                "queued task started at once",
+                (child_run[0].start_time - queuer_run.stop_time).total_seconds() < 2,
+            ),
+            ("scheduled task run", len(scheduled_run) == 1),
+            (
+                "scheduled task started on time",
+                abs((scheduled_run[0].start_time - soon).total_seconds()) < 2,
+            ),
+        ]
+        self.exec_asserts(res, "WAKEUP")
+
+    def testChunkedOutput(self):
+        s = Scheduler(self.db)
+        chatty = s.queue_task("demo6", sync_output=1)
+        self.db.commit()
+        self.writefunction(
+            r"""
+def demo6():
+    for i in range(5000):
+        print('line %s' % i)
+        if i % 1000 == 0:
+            time.sleep(1.5)
+    return 1
+""",
+            initlines="""
+import os
+import time
+from gluon.scheduler import Scheduler
+db_dal = os.path.abspath(os.path.join(request.folder, 'databases', 'dummy2.db'))
+sched_dal = DAL('sqlite://%s' % db_dal, folder=os.path.dirname(db_dal))
+sched = Scheduler(sched_dal, max_empty_runs=3, migrate=False, heartbeat=1,
+                  chunked_output=True, max_output_size=20000)
+""",
+        )
+        ret = self.exec_sched()
+        self.assertEqual(ret, 0)
+        task = s.task_status(chatty.get("id"), output=True)
+        task_run = self.fetch_results(s, chatty)[1]
+        output = task.scheduler_run.run_output
+        chunks = self.db(self.db.scheduler_run_output).count()
+        res = [
+            ("task completed", task.scheduler_task.status == "COMPLETED"),
+            ("output stored in chunks", chunks > 1),
+            ("output not rewritten in scheduler_run", not task_run[0].run_output),
+            ("output truncated", 20000 <= len(output) < 30000),
+            ("last lines kept", output.endswith("line 4999\n")),
+        ]
+        self.exec_asserts(res, "CHUNKED")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -759,6 +759,8 @@ def start():
     # set size of cron thread pools
     newcron.dancer_size(options.min_threads)
     newcron.launcher_size(options.cron_threads)
+    if options.cron_in_process:
+        newcron.jobs_in_process(timeout=options.cron_timeout)
 
     if options.cron_run:
         # run cron (extcron) and exit
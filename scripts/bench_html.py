@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+bench_html.py
+
+Times rendering trees of gluon.html helpers with DIV.xml() and with the
+iterative walker behind DIV.xml_chunks(), on a table with spans, a plain
+table and nested menus
+
+Typical usage (from the web2py folder):
+
+    python scripts/bench_html.py
+    python scripts/bench_html.py --rows 5000 --repeat 3
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gluon.html import A, DIV, LI, SPAN, TABLE, TD, TR, UL
+
+
+def span_table(rows):
+    return TABLE(
+        *[
+            TR(
+                TD(SPAN(i, _class="id")),
+                TD(A("row %s" % i, _href="/row/%s" % i)),
+                TD(SPAN("<%s>" % i, _title="x")),
+                _class="odd" if i % 2 else "even",
+            )
+            for i in range(rows)
+        ]
+    )
+
+
+def plain_table(rows):
+    return TABLE(*[TR(TD(i), TD("row %s" % i), TD(i * 2)) for i in range(rows)])
+
+
+def menus(rows):
+    def menu(depth):
+        if not depth:
+            return A("leaf", _href="#")
+        return UL(*[LI(A("item", _href="#"), menu(depth - 1)) for i in range(3)])
+
+    return DIV(*[menu(4) for i in range(rows // 120 or 1)], _class="menus")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    options = parser.parse_args()
+    print("%-12s %10s %10s" % ("tree", "xml(s)", "chunks(s)"))
+    for name, build in (
+        ("span table", span_table),
+        ("plain table", plain_table),
+        ("menus", menus),
+    ):
+        tree = build(options.rows)
+        assert "".join(tree.xml_chunks()) == tree.xml()
+        times = [
+            min(timeit.repeat(render, number=1, repeat=options.repeat))
+            for render in (tree.xml, lambda: "".join(tree.xml_chunks()))
+        ]
+        print("%-12s %10.4f %10.4f" % (name, times[0], times[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+bench_routes.py
+
+Compares matching incoming paths against regex routes one rule at a time
+with the indexed, merged dispatch of gluon.rewrite.CompiledRoutes, on rule
+sets shaped like the ones in gluon/tests/test_routes.py: three quarters
+with a literal first segment, one quarter of regexes, and a catch-all
+
+Typical usage (from the web2py folder):
+
+    python scripts/bench_routes.py
+    python scripts/bench_routes.py --rules 50 200 1000 --number 2000
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gluon.rewrite import CompiledRoutes, compile_regex
+
+
+def make_rules(count):
+    """Returns count routes_in rules, with a catch-all last"""
+    items = []
+    for i in range(count - 1):
+        kind = i % 4
+        if kind == 0:
+            items.append(("/page%d" % i, "/init/default/page%d" % i))
+        elif kind == 1:
+            items.append(("/app%d/$c/$f" % i, "/app%d/$c/$f" % i))
+        elif kind == 2:
+            items.append(("/static%d/$anything" % i, "/init/static/$anything"))
+        else:
+            items.append((r"/(?P<y>\d{4})/blog%d/(?P<s>\w+)" % i, r"/b/\g<s>/\g<y>"))
+    items.append(("/$anything", "/init/default/$anything"))
+    return CompiledRoutes(compile_regex(*item) for item in items)
+
+
+def linear(rules, key):
+    for rule in rules:
+        if rule[0].match(key):
+            return rule
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--rules", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--number", type=int, default=1000)
+    options = parser.parse_args()
+    print("%8s %12s %12s %8s" % ("rules", "linear(us)", "merged(us)", "speedup"))
+    for count in options.rules:
+        rules = make_rules(count)
+        keys = [
+            ":http://localhost:get /page0",
+            ":http://localhost:get /app%d/default/index" % (count // 2 | 1),
+            ":http://localhost:get /nothing/else/matches",
+        ]
+        for key in keys:
+            assert linear(rules, key) is rules.match(key), key
+        old = min(
+            timeit.repeat(
+                lambda: [linear(rules, key) for key in keys],
+                number=options.number,
+                repeat=3,
+            )
+        )
+        new = min(
+            timeit.repeat(
+                lambda: [rules.match(key) for key in keys],
+                number=options.number,
+                repeat=3,
+            )
+        )
+        scale = 1e6 / options.number / len(keys)
+        print("%8d %12.2f %12.2f %7.1fx" % (count, old * scale, new * scale, old / new))
+
+
+if __name__ == "__main__":
+    main()